@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmark environment
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Points minitwit at a throwaway sqlite database before importing it, so that the
+    benchmarks never touch /var/minitwit/minitwit.db.
+"""
+import importlib
+import os
+import sys
+import tempfile
+
+
+def import_minitwit():
+    """:return: the minitwit module, configured with a fresh sqlite database"""
+    db_file = os.path.join(tempfile.mkdtemp(), 'minitwit-bench.db')
+
+    # The settings file must be in place before minitwit is imported
+    with open(db_file + '.cfg', 'w') as settings:
+        settings.write("LOCAL_DATABASE_URL = 'sqlite:///%s'\n" % db_file)
+    os.environ['MINITWIT_SETTINGS'] = db_file + '.cfg'
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    return importlib.import_module('minitwit')
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+    Cold start benchmark
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Measures how long a fresh worker takes to import minitwit and be ready to serve
+    in each STARTUP_MODE, the first worker probing the cloud metadata and the next
+    ones reading the results cached by the first.
+
+    python benchmarks/cold_start.py --modes sync concurrent background --workers 3
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# Run in the child: imports the app and reports what it measured itself
+CHILD = '''
+import json, minitwit
+print(json.dumps(minitwit.app.config['STARTUP']))
+'''
+
+
+def start_worker(settings_file):
+    """:return: the wall seconds to start a python importing minitwit, and the STARTUP config it reported"""
+    app_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', CHILD], cwd=app_dir, check=True, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, universal_newlines=True,
+                            env=dict(os.environ, MINITWIT_SETTINGS=settings_file)).stdout
+    return time.perf_counter() - start, json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs='+', default=['sync', 'concurrent', 'background'])
+    parser.add_argument('--workers', type=int, default=3, help='workers started one after the other per mode')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    print('%-12s %-8s %-8s %12s %12s %12s' % ('mode', 'worker', 'source', 'wall s', 'cold start s', 'probe s'))
+    for mode in args.modes:
+        cache_file = os.path.join(work_dir, mode + '-startup.json')
+        settings_file = os.path.join(work_dir, mode + '.cfg')
+        with open(settings_file, 'w') as settings:
+            settings.write("LOCAL_DATABASE_URL = 'sqlite:///%s'\n" % os.path.join(work_dir, 'minitwit.db'))
+            settings.write("STARTUP_MODE = %r\nSTARTUP_CACHE_FILE = %r\n" % (mode, cache_file))
+
+        for worker in range(args.workers):
+            wall, startup = start_worker(settings_file)
+            print('%-12s %-8d %-8s %12.3f %12.3f %12s' % (
+                mode, worker, startup['source'], wall, startup['cold_start_seconds'], startup.get('probe_seconds', '')))
+
+
+if __name__ == '__main__':
+    main()
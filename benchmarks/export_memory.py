@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+    Export memory benchmark
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Streams the NDJSON export of a user with many messages and reports the rows per
+    second and how much the peak RSS of the process grew while streaming.
+
+    python benchmarks/export_memory.py --messages 1000000
+"""
+import argparse
+import resource
+import time
+
+from sqlalchemy.sql import text
+
+from bench_env import import_minitwit
+
+
+def peak_rss_mb():
+    """:return: the peak resident set size of the process, in MB (Linux reports KB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=200000)
+    args = parser.parse_args()
+
+    minitwit = import_minitwit()
+    with minitwit.app.app_context():
+        minitwit.init_db()
+        the_db = minitwit.get_db()
+        with the_db.begin():
+            the_db.execute(text('insert into user (username, email, pw_hash) values (:username, :email, :pwhash)'),
+                           dict(username='bench', email='bench@example.com', pwhash='x'))
+            for offset in range(0, args.messages, 10000):
+                the_db.execute(text('insert into message (author_id, text, pub_date) values (1, :text, :pubdate)'), [
+                    dict(text='message %d' % index, pubdate=index)
+                    for index in range(offset, min(offset + 10000, args.messages))])
+
+    client = minitwit.app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    response = client.get('/api/users/bench/export/messages', buffered=False)
+    rows = sum(chunk.count(b'\n') for chunk in response.response)
+    response.close()
+    elapsed = time.perf_counter() - start
+
+    print('exported %d rows in %.1f s (%.0f rows/s), peak RSS %.1f MB -> %.1f MB' % (
+        rows, elapsed, rows / elapsed, rss_before, peak_rss_mb()))
+
+
+if __name__ == '__main__':
+    main()
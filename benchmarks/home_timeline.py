@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+    Home timeline benchmark
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compares the fan-out-on-read home timeline (the join in timeline()) with the
+    fan-out-on-write one (HOME_TIMELINE_FANOUT) on a throwaway sqlite database.
+
+    python benchmarks/home_timeline.py --users 500 --follows 50 --messages 20
+"""
+import argparse
+import random
+import time
+
+from sqlalchemy.sql import text
+
+from bench_env import import_minitwit
+
+minitwit = import_minitwit()  # pylint: disable=invalid-name
+
+
+def seed(users, follows, messages):
+    """Creates the users, the follower graph and the messages"""
+    random.seed(42)
+    the_db = minitwit.get_db()
+    with the_db.begin():
+        the_db.execute(text('insert into user (username, email, pw_hash) values (:username, :email, :pwhash)'), [
+            dict(username='user%d' % i, email='user%d@example.com' % i, pwhash='x') for i in range(users)])
+        the_db.execute(text('insert into follower (who_id, whom_id) values (:whoid, :whomid)'), [
+            dict(whoid=who, whomid=whom) for who in range(1, users + 1)
+            for whom in random.sample(range(1, users + 1), follows) if whom != who])
+        the_db.execute(text('insert into message (author_id, text, pub_date) values (:authorid, :text, :pubdate)'), [
+            dict(authorid=random.randint(1, users), text='message %d' % i, pubdate=1000000 + i)
+            for i in range(users * messages)])
+
+
+def measure(users, requests_count, fn):
+    """:return: the average milliseconds per call of fn(user_id)"""
+    start = time.perf_counter()
+    for i in range(requests_count):
+        fn(1 + i % users)
+    return (time.perf_counter() - start) * 1000 / requests_count
+
+
+def as_user(client, user_id):
+    """Logs the test client in as the given user"""
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+    return client
+
+
+def read_home_timeline(user_id):
+    """Runs only the home timeline queries of the current strategy, without rendering"""
+    if minitwit.app.config['HOME_TIMELINE_FANOUT']:
+        minitwit.query_timeline(
+            minitwit.TimelineSource(minitwit.MATERIALIZED_HOME_TIMELINE_QUERY, {'userid': user_id}, 'home_timeline'),
+            minitwit.TimelineSource(minitwit.FANOUT_ON_READ_HOME_TIMELINE_QUERY, {'whoid': user_id}))
+    else:
+        minitwit.query_timeline(
+            minitwit.TimelineSource(minitwit.HOME_TIMELINE_QUERY, {'userid': user_id, 'whoid': user_id}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--follows', type=int, default=50, help='followed authors per user')
+    parser.add_argument('--messages', type=int, default=20, help='messages per user')
+    parser.add_argument('--requests', type=int, default=500)
+    args = parser.parse_args()
+
+    with minitwit.app.app_context():
+        minitwit.init_db()
+        seed(args.users, args.follows, args.messages)
+        start = time.perf_counter()
+        minitwit.rebuild_home_timelines()
+        rebuild_ms = (time.perf_counter() - start) * 1000
+
+    client = minitwit.app.test_client()
+    print('%d users following %d each, %d messages, home timelines rebuilt in %.0f ms' % (
+        args.users, args.follows, args.users * args.messages, rebuild_ms))
+    print('%-16s %12s %12s %12s' % ('strategy', 'query ms', 'page ms', 'post ms'))
+    for fanout in (False, True):
+        minitwit.app.config['HOME_TIMELINE_FANOUT'] = fanout
+        with minitwit.app.test_request_context('/'):
+            query_ms = measure(args.users, args.requests, read_home_timeline)
+        page_ms = measure(args.users, args.requests,
+                          lambda user_id: as_user(client, user_id).get('/'))
+        write_ms = measure(args.users, args.requests,
+                           lambda user_id: as_user(client, user_id).post('/add_message', data={'text': 'bench'}))
+        print('%-16s %12.3f %12.3f %12.3f' % (
+            'fan-out-on-write' if fanout else 'fan-out-on-read', query_ms, page_ms, write_ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+    Message ingestion benchmark
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compares the messages per second recorded through the form-based /add_message
+    route, one message per request, with the batched JSON /api/messages route.
+
+    python benchmarks/message_ingestion.py --messages 2000 --batch-sizes 10 100 500
+"""
+import argparse
+import time
+
+from bench_env import import_minitwit
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=2000, help='messages recorded per run')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[10, 100, 500])
+    args = parser.parse_args()
+
+    minitwit = import_minitwit()
+    with minitwit.app.app_context():
+        minitwit.init_db()
+        minitwit.exec_db('insert into user (username, email, pw_hash) values (:username, :email, :pwhash)', dict(
+            username='bench', email='bench@example.com', pwhash='x'))
+
+    client = minitwit.app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+
+    print('%-20s %14s' % ('endpoint', 'messages/s'))
+    start = time.perf_counter()
+    for index in range(args.messages):
+        client.post('/add_message', data={'text': 'message %d' % index})
+    print('%-20s %14.1f' % ('/add_message', args.messages / (time.perf_counter() - start)))
+
+    for batch_size in args.batch_sizes:
+        batch = {'messages': [{'text': 'message %d' % index} for index in range(batch_size)]}
+        start = time.perf_counter()
+        for _ in range(args.messages // batch_size):
+            response = client.post('/api/messages', json=batch)
+            assert response.status_code == 201, response.data
+        recorded = args.messages // batch_size * batch_size
+        print('%-20s %14.1f' % ('/api/messages x%d' % batch_size, recorded / (time.perf_counter() - start)))
+
+
+if __name__ == '__main__':
+    main()
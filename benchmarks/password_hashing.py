@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+    Password hashing benchmark
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Measures the logins per second of concurrent clients for several sizes of the
+    password hashing pool (PASSWORD_HASH_POOL_SIZE, 0 hashes on the request thread),
+    and the latency of /public requests served meanwhile.
+
+    python benchmarks/password_hashing.py --pool-sizes 0 1 2 4 --threads 8 --logins 20
+"""
+import argparse
+import statistics
+import threading
+import time
+
+from bench_env import import_minitwit
+
+
+def login_burst(minitwit, threads, logins):
+    """:return: the logins per second of the threads, and the /public latencies meanwhile"""
+    done = threading.Event()
+    public_ms = []
+
+    def log_in():
+        client = minitwit.app.test_client()
+        for _ in range(logins):
+            client.post('/login', data={'username': 'bench', 'password': 'default'})
+            client.get('/logout')
+
+    def read_public():
+        client = minitwit.app.test_client()
+        while not done.is_set():
+            start = time.perf_counter()
+            client.get('/public')
+            public_ms.append((time.perf_counter() - start) * 1000)
+
+    reader = threading.Thread(target=read_public)
+    reader.start()
+    workers = [threading.Thread(target=log_in) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    done.set()
+    reader.join()
+
+    return threads * logins / elapsed, statistics.median(public_ms) if public_ms else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pool-sizes', type=int, nargs='+', default=[0, 1, 2, 4])
+    parser.add_argument('--threads', type=int, default=8, help='concurrent clients logging in')
+    parser.add_argument('--logins', type=int, default=20, help='logins per client')
+    parser.add_argument('--method', default=None, help='werkzeug hash method, PASSWORD_HASH_METHOD by default')
+    args = parser.parse_args()
+
+    minitwit = import_minitwit()
+    # Avoid serving every /public from the cache, so that it has to compete for the CPU
+    minitwit.PUBLIC_TIMELINE_CACHE.ttl = 0
+    method = minitwit.PasswordHasher(args.method or minitwit.app.config['PASSWORD_HASH_METHOD'], 0).method
+    with minitwit.app.app_context():
+        minitwit.init_db()
+        minitwit.exec_db('insert into user (username, email, pw_hash) values (:username, :email, :pwhash)', dict(
+            username='bench', email='bench@example.com',
+            pwhash=minitwit.PasswordHasher(method, 0).hash('default')))
+
+    print('%s, %d clients logging in %d times each' % (method, args.threads, args.logins))
+    print('%-10s %12s %16s' % ('pool size', 'logins/s', 'public p50 ms'))
+    for pool_size in args.pool_sizes:
+        minitwit.PASSWORD_HASHER = minitwit.PasswordHasher(method, pool_size)
+        # Start the worker processes before measuring
+        minitwit.PASSWORD_HASHER.hash('warm up')
+        logins_per_second, public_p50 = login_burst(minitwit, args.threads, args.logins)
+        minitwit.PASSWORD_HASHER.shutdown()
+        print('%-10d %12.1f %16.3f' % (pool_size, logins_per_second, public_p50 or 0))
+
+
+if __name__ == '__main__':
+    main()
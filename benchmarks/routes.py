@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+    Route benchmark
+    ~~~~~~~~~~~~~~~
+
+    Replays a weighted mix of the MiniTwit routes against a seeded, throwaway sqlite
+    database, in-process or through a local WSGI server, and reports the throughput
+    and the p50/p95/p99 latencies of each route. Results are saved as JSON, and the
+    compare mode flags the routes that regressed between two runs.
+
+    python benchmarks/routes.py run --requests 5000 --concurrency 4 --output before.json
+    python benchmarks/routes.py run --server --output after.json
+    python benchmarks/routes.py compare before.json after.json --threshold 0.10
+"""
+import argparse
+import json
+import logging
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+
+# The share of each route in the replayed traffic, reads dominate like in production
+MIX = {
+    'public': 25,
+    'home': 30,
+    'user': 20,
+    'add_message': 10,
+    'follow': 6,
+    'unfollow': 6,
+    'login': 3,
+}
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(sorted_values, pct):
+    """:return: the nearest-rank percentile of the sorted values"""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values) + 0.5 - 1e-9)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(latencies, errors, elapsed):
+    """:return: the throughput and latency statistics of one route, latencies in seconds"""
+    latencies = sorted(latencies)
+    summary = {
+        'count': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'mean_ms': round(sum(latencies) * 1000 / len(latencies), 3) if latencies else None,
+    }
+    for pct in PERCENTILES:
+        value = percentile(latencies, pct)
+        summary['p%d_ms' % pct] = round(value * 1000, 3) if value is not None else None
+    return summary
+
+
+class InProcessClient:
+    """Sends the requests of one virtual user through the Flask test client"""
+
+    def __init__(self, app):
+        self.app = app
+        self.client = app.test_client()
+
+    def anonymous(self):
+        """:return: a client without a session"""
+        return InProcessClient(self.app)
+
+    def get(self, path):
+        return self.client.get(path).status_code
+
+    def post(self, path, data):
+        return self.client.post(path, data=data).status_code
+
+
+class HttpClient:
+    """Sends the requests of one virtual user to a server over HTTP, with a keep-alive session"""
+
+    def __init__(self, base_url):
+        import requests  # pylint: disable=import-outside-toplevel
+        self.base_url = base_url
+        self.session = requests.Session()
+
+    def anonymous(self):
+        """:return: a client without a session"""
+        return HttpClient(self.base_url)
+
+    def get(self, path):
+        return self.session.get(self.base_url + path, allow_redirects=False).status_code
+
+    def post(self, path, data):
+        return self.session.post(self.base_url + path, data=data, allow_redirects=False).status_code
+
+
+def run_operation(name, client, rng, usernames, password):
+    """Sends one request of the named route. :return: the status code"""
+    if name == 'public':
+        return client.get('/public')
+    if name == 'home':
+        return client.get('/')
+    if name == 'user':
+        return client.get('/' + rng.choice(usernames))
+    if name == 'add_message':
+        return client.post('/add_message', {'text': 'benchmark message %d' % rng.randint(0, 1 << 30)})
+    if name == 'follow':
+        return client.get('/%s/follow' % rng.choice(usernames))
+    if name == 'unfollow':
+        return client.get('/%s/unfollow' % rng.choice(usernames))
+    if name == 'login':
+        return client.anonymous().post('/login', {'username': rng.choice(usernames), 'password': password})
+    raise ValueError('Unknown route %s' % name)
+
+
+def worker(index, make_client, args, usernames, password, results, lock):
+    """Replays this virtual user's share of the mix, logged in as one of the seeded users"""
+    rng = random.Random(args.seed + index)
+    client = make_client()
+    assert client.post('/login', {'username': usernames[index % len(usernames)], 'password': password}) == 302
+
+    names = sorted(MIX)
+    weights = [MIX[name] for name in names]
+    latencies = {name: [] for name in names}
+    errors = dict.fromkeys(names, 0)
+    for number in range(args.warmup + args.requests // args.concurrency):
+        name = rng.choices(names, weights)[0]
+        start = time.perf_counter()
+        status = run_operation(name, client, rng, usernames, password)
+        elapsed = time.perf_counter() - start
+        if number < args.warmup:
+            continue
+        if status >= 400:
+            errors[name] += 1
+        latencies[name].append(elapsed)
+
+    with lock:
+        for name in names:
+            results['latencies'][name].extend(latencies[name])
+            results['errors'][name] += errors[name]
+
+
+def git_revision():
+    """:return: the commit being benchmarked, if any"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    from bench_env import import_minitwit  # pylint: disable=import-outside-toplevel
+    minitwit = import_minitwit()
+
+    with minitwit.app.app_context():
+        minitwit.init_db()
+        minitwit.seed_db(args.users, args.follows, args.messages, 365, args.seed, 1.1, 1700000000)
+        usernames = [row[0] for row in minitwit.query_db('select username from user order by user_id')]
+
+    server = None
+    if args.server:
+        from werkzeug.serving import make_server  # pylint: disable=import-outside-toplevel
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        server = make_server('127.0.0.1', 0, minitwit.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = 'http://127.0.0.1:%d' % server.server_port
+        make_client = lambda: HttpClient(base_url)
+    else:
+        make_client = lambda: InProcessClient(minitwit.app)
+
+    results = {'latencies': {name: [] for name in MIX}, 'errors': dict.fromkeys(MIX, 0)}
+    lock = threading.Lock()
+    threads = [threading.Thread(target=worker, args=(
+        index, make_client, args, usernames, minitwit.SEED_PASSWORD, results, lock)) for index in range(args.concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    if server is not None:
+        server.shutdown()
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': int(time.time()),
+            'python': platform.python_version(),
+            'mode': 'server' if args.server else 'in-process',
+            'users': args.users,
+            'follows': args.follows,
+            'messages': args.messages,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'seed': args.seed,
+            'elapsed_s': round(elapsed, 3),
+        },
+        'routes': {name: summarize(results['latencies'][name], results['errors'][name], elapsed)
+                   for name in sorted(MIX)},
+        'total': summarize([value for values in results['latencies'].values() for value in values],
+                           sum(results['errors'].values()), elapsed),
+    }
+
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+        print('Results saved to %s' % args.output)
+    return 1 if report['total']['errors'] else 0
+
+
+def print_report(report):
+    print('%-12s %8s %7s %10s %10s %10s %10s' % ('route', 'count', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for name, summary in list(report['routes'].items()) + [('total', report['total'])]:
+        if not summary['count']:
+            continue
+        print('%-12s %8d %7d %10.1f %10.3f %10.3f %10.3f' % (
+            name, summary['count'], summary['errors'], summary['throughput_rps'],
+            summary['p50_ms'], summary['p95_ms'], summary['p99_ms']))
+
+
+def compare(args):
+    """Flags the routes whose latency percentiles grew, or throughput dropped, by more than the threshold"""
+    with open(args.baseline) as baseline_file, open(args.candidate) as candidate_file:
+        baseline, candidate = json.load(baseline_file), json.load(candidate_file)
+
+    # Runs are only comparable with the same data, mix and load
+    for key in ('mode', 'users', 'follows', 'messages', 'requests', 'concurrency', 'seed'):
+        if baseline['meta'].get(key) != candidate['meta'].get(key):
+            print('Warning: the runs differ in %s: %s and %s' % (
+                key, baseline['meta'].get(key), candidate['meta'].get(key)))
+
+    regressions = 0
+    print('%-12s %-14s %12s %12s %9s' % ('route', 'metric', 'baseline', 'candidate', 'change'))
+    for name in sorted(set(baseline['routes']) & set(candidate['routes'])) + ['total']:
+        before = baseline['total'] if name == 'total' else baseline['routes'][name]
+        after = candidate['total'] if name == 'total' else candidate['routes'][name]
+        for metric in ['p%d_ms' % pct for pct in PERCENTILES] + ['throughput_rps']:
+            if not before.get(metric) or after.get(metric) is None:
+                continue
+            change = (after[metric] - before[metric]) / before[metric]
+            # Lower latencies and higher throughputs are better
+            worse = -change if metric == 'throughput_rps' else change
+            flag = ''
+            if worse > args.threshold:
+                flag = 'REGRESSION'
+                regressions += 1
+            print('%-12s %-14s %12.3f %12.3f %+8.1f%% %s' % (
+                name, metric, before[metric], after[metric], change * 100, flag))
+
+    print('%d regression(s) above %.0f%%' % (regressions, args.threshold * 100))
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='benchmark the routes')
+    run_parser.add_argument('--users', type=int, default=1000)
+    run_parser.add_argument('--follows', type=int, default=50, help='average followed users per user')
+    run_parser.add_argument('--messages', type=int, default=100000)
+    run_parser.add_argument('--requests', type=int, default=5000, help='measured requests, across all workers')
+    run_parser.add_argument('--warmup', type=int, default=20, help='unmeasured requests per worker')
+    run_parser.add_argument('--concurrency', type=int, default=4, help='virtual users sending requests at once')
+    run_parser.add_argument('--seed', type=int, default=42)
+    run_parser.add_argument('--server', action='store_true', help='go through a local threaded WSGI server')
+    run_parser.add_argument('--output', help='JSON file the results are saved to')
+
+    compare_parser = subparsers.add_parser('compare', help='flag the regressions between two runs')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--threshold', type=float, default=0.10, help='relative change flagged, 0.10 is 10%%')
+
+    args = parser.parse_args()
+    if args.command == 'compare':
+        return compare(args)
+    if args.command == 'run':
+        return run(args)
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
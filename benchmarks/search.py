@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+    Search benchmark
+    ~~~~~~~~~~~~~~~~
+
+    Measures /api/search on throwaway sqlite databases of growing sizes, for words found in
+    about half of the messages, for a word found in none, and for the LIKE '%word%' scan the
+    text index replaces.
+
+    python benchmarks/search.py --sizes 100000 300000 1000000
+"""
+import argparse
+import time
+
+from sqlalchemy.sql import text
+
+from bench_env import import_minitwit
+
+minitwit = import_minitwit()  # pylint: disable=invalid-name
+
+LIKE_QUERY = '''select message.*, user.* from message, user
+    where message.author_id = user.user_id and message.text like :pattern
+    order by message.pub_date desc, message.message_id desc limit 30'''
+
+
+def measure(requests_count, fn):
+    """:return: the average milliseconds per call of fn()"""
+    start = time.perf_counter()
+    for _ in range(requests_count):
+        fn()
+    return (time.perf_counter() - start) * 1000 / requests_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[100000, 300000, 1000000])
+    parser.add_argument('--requests', type=int, default=50)
+    args = parser.parse_args()
+
+    client = minitwit.app.test_client()
+    print('%10s %14s %14s %14s %14s' % ('messages', 'common ms', 'two words ms', 'no match ms', 'like ms'))
+    for size in args.sizes:
+        with minitwit.app.app_context():
+            minitwit.init_db()
+            minitwit.seed_db(1000, 10, size, 365, 42, 1.1, 1700000000)
+            the_db = minitwit.get_db()
+            like_ms = measure(max(1, args.requests // 10), lambda: the_db.execute(
+                text(LIKE_QUERY), pattern='%zebra%').fetchall())
+
+        print('%10d %14.2f %14.2f %14.2f %14.2f' % (
+            size,
+            measure(args.requests, lambda: client.get('/api/search?q=python')),
+            measure(args.requests, lambda: client.get('/api/search?q=python+cloud')),
+            measure(args.requests, lambda: client.get('/api/search?q=zebra')),
+            like_ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+    Serving benchmark
+    ~~~~~~~~~~~~~~~~~
+
+    Serves a seeded, throwaway sqlite database with the threaded Flask server (flask run
+    --with-threads), the pre-fork gunicorn server and the ASGI app on uvicorn, then holds
+    growing numbers of concurrent keep-alive connections against each, every connection
+    reading the public and user timelines back to back, and reports the throughput, the
+    p50/p99 latencies, the failed requests and the peak threads and memory of the server
+    processes at each concurrency.
+
+    python benchmarks/serving.py --concurrency 10 100 500 --seconds 10
+"""
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import time
+import urllib.request
+
+from bench_env import import_minitwit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+SERVERS = {
+    'flask-threads': [sys.executable, '-m', 'flask', '--app', 'minitwit', 'run', '--with-threads', '--no-debugger',
+                      '--no-reload', '--port', '{port}'],
+    'gunicorn': [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', '127.0.0.1:{port}',
+                 '--access-logfile', '/dev/null'],
+    'uvicorn': [sys.executable, '-m', 'uvicorn', 'minitwit_asgi:app', '--port', '{port}', '--log-level', 'warning',
+                '--backlog', '4096'],
+}
+
+
+def percentile(sorted_values, pct):
+    """:return: the nearest-rank percentile of the sorted values"""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values), max(1, int(round(pct / 100.0 * len(sorted_values))))) - 1]
+
+
+async def read_response(reader):
+    """:return: the status and whether the server keeps the connection open"""
+    status = int((await reader.readline()).split()[1])
+    length, keep_alive = 0, True
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+        elif name.lower() == 'connection' and value.strip().lower() == 'close':
+            keep_alive = False
+    await reader.readexactly(length)
+    return status, keep_alive
+
+
+async def connection(port, paths, deadline, latencies, errors):
+    """Sends requests back to back over one keep-alive connection until the deadline"""
+    rng = random.Random()
+    reader = writer = None
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(('GET %s HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n' % rng.choice(paths)).encode())
+            status, keep_alive = await asyncio.wait_for(read_response(reader), 30)
+            if status != 200:
+                errors.append(status)
+            else:
+                latencies.append(time.perf_counter() - start)
+            if not keep_alive:
+                writer.close()
+                writer = None
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, IndexError) as error:
+            errors.append(type(error).__name__)
+            if writer is not None:
+                writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+
+def process_status(pid):
+    """:return: the threads and the resident memory in MiB of the process and its children, from /proc"""
+    status = {}
+    with open('/proc/%d/status' % pid) as status_file:
+        for line in status_file:
+            name, _, value = line.partition(':')
+            status[name] = value.strip()
+    threads, rss = int(status['Threads']), int(status['VmRSS'].split()[0]) / 1024.0
+
+    with open('/proc/%d/task/%d/children' % (pid, pid)) as children_file:
+        for child in children_file.read().split():
+            try:
+                child_threads, child_rss = process_status(int(child))
+            except OSError:
+                # The child exited meanwhile
+                continue
+            threads, rss = threads + child_threads, rss + child_rss
+    return threads, rss
+
+
+async def sample_peak(pid, deadline, peak):
+    """Keeps the peak threads and memory of the server in peak until the deadline"""
+    while time.monotonic() < deadline:
+        threads, rss = process_status(pid)
+        peak[0], peak[1] = max(peak[0], threads), max(peak[1], rss)
+        await asyncio.sleep(0.2)
+
+
+async def load(server, port, paths, concurrency, seconds):
+    """:return: the latencies of the requests served, the errors and the peak threads and memory of the
+    server, for concurrency connections"""
+    latencies, errors, peak = [], [], [0, 0.0]
+    deadline = time.monotonic() + seconds
+    await asyncio.gather(sample_peak(server.pid, deadline, peak),
+                         *(connection(port, paths, deadline, latencies, errors) for _ in range(concurrency)))
+    return latencies, errors, peak
+
+
+def start_server(name, port):
+    """Starts the server and waits until it answers"""
+    command = [part.format(port=port) for part in SERVERS[name]]
+    server = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            urllib.request.urlopen('http://127.0.0.1:%d/healthcheck/liveness' % port, timeout=1).read()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError('%s did not start' % name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[10, 100, 500])
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--port', type=int, default=5077)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=100000)
+    args = parser.parse_args()
+
+    minitwit = import_minitwit()
+    with minitwit.app.app_context():
+        minitwit.init_db()
+        minitwit.seed_db(args.users, 10, args.messages, 365, 42, 1.1, 1700000000)
+        usernames = [row['username'] for row in minitwit.query_db('select username from user limit 100')]
+    paths = ['/public'] + ['/' + username for username in usernames]
+
+    print('%-14s %12s %12s %10s %10s %8s %8s %8s' % (
+        'server', 'connections', 'requests/s', 'p50 ms', 'p99 ms', 'errors', 'threads', 'rss MiB'))
+    for name in SERVERS:
+        server = start_server(name, args.port)
+        try:
+            for concurrency in args.concurrency:
+                latencies, errors, peak = asyncio.run(load(server, args.port, paths, concurrency, args.seconds))
+                latencies.sort()
+                print('%-14s %12d %12.1f %10.1f %10.1f %8d %8d %8.1f' % (
+                    name, concurrency, len(latencies) / args.seconds,
+                    (percentile(latencies, 50) or 0) * 1000, (percentile(latencies, 99) or 0) * 1000, len(errors),
+                    peak[0], peak[1]))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
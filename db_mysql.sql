@@ -1,3 +1,6 @@
+drop table if exists schema_version;
+drop table if exists home_timeline;
+
 # TODO
 
 drop table if exists user;
@@ -1,3 +1,7 @@
+drop table if exists schema_version;
+drop table if exists home_timeline;
+drop table if exists message_search;
+
 drop table if exists user;
 create table user (
   user_id integer primary key autoincrement,
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+    MiniTwit pre-fork server
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Settings of gunicorn serving MiniTwit on every core: the app is imported once in the
+    master, then forked into WEB_WORKERS processes of WEB_THREADS threads each. The workers
+    inherit the bootstrapped cloud metadata and config, and rebuild their database pools
+    and instance metadata sessions after the fork. Each worker runs its own readiness
+    checks, the master none.
+
+    gunicorn -c gunicorn.conf.py
+"""
+import multiprocessing
+import os
+
+import minitwit
+from viasat.platform.cloud.startup_service import StartupService
+
+wsgi_app = 'minitwit:app'  #pylint: disable=invalid-name
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', '5000'))  #pylint: disable=invalid-name
+
+# minitwit is already imported above, the workers are forked from it
+preload_app = True  #pylint: disable=invalid-name
+workers = minitwit.app.config['WEB_WORKERS'] or multiprocessing.cpu_count()  #pylint: disable=invalid-name
+worker_class = 'gthread'  #pylint: disable=invalid-name
+threads = minitwit.app.config['WEB_THREADS']  #pylint: disable=invalid-name
+
+# Requests on stderr, like flask run
+accesslog = '-'  #pylint: disable=invalid-name
+
+
+def when_ready(_server):
+    """Forks the workers once the metadata probed in the background, if any, is in the config"""
+    StartupService.wait(minitwit.app.config['STARTUP_PROBE_DEADLINE'])
+
+
+def post_worker_init(_worker):
+    """Starts the readiness checks of the worker before it serves its first probe"""
+    minitwit.READINESS.start()
@@ -0,0 +1,22 @@
+alter table user modify username varchar(255) not null;
+
+create unique index user_username on user (username);
+
+create index message_author_pub_date on message (author_id, pub_date);
+
+create index message_pub_date on message (pub_date);
+
+create table follower_new (
+  who_id integer not null,
+  whom_id integer not null,
+  primary key (who_id, whom_id)
+);
+
+insert ignore into follower_new (who_id, whom_id)
+  select who_id, whom_id from follower where who_id is not null and whom_id is not null;
+
+drop table follower;
+
+rename table follower_new to follower;
+
+create index follower_whom on follower (whom_id, who_id);
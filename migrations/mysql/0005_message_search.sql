@@ -0,0 +1,2 @@
+-- The full-text index of the messages, maintained by InnoDB with each write
+create fulltext index message_text_fulltext on message (text);
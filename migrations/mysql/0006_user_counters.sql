@@ -0,0 +1,10 @@
+alter table user add column follower_count integer not null default 0;
+
+alter table user add column following_count integer not null default 0;
+
+alter table user add column message_count integer not null default 0;
+
+update user set
+  follower_count = (select count(*) from follower where follower.whom_id = user.user_id),
+  following_count = (select count(*) from follower where follower.who_id = user.user_id),
+  message_count = (select count(*) from message where message.author_id = user.user_id);
@@ -0,0 +1,3 @@
+alter table user rename column follow_version to home_timeline_version;
+
+create index user_fanout_on_read on user (fanout_on_read);
@@ -0,0 +1,20 @@
+create unique index user_username on user (username);
+
+create index message_author_pub_date on message (author_id, pub_date);
+
+create index message_pub_date on message (pub_date);
+
+create table follower_new (
+  who_id integer not null,
+  whom_id integer not null,
+  primary key (who_id, whom_id)
+);
+
+insert or ignore into follower_new (who_id, whom_id)
+  select who_id, whom_id from follower where who_id is not null and whom_id is not null;
+
+drop table follower;
+
+alter table follower_new rename to follower;
+
+create index follower_whom on follower (whom_id, who_id);
@@ -0,0 +1,11 @@
+alter table user add column fanout_on_read integer not null default 0;
+
+create table home_timeline (
+  user_id integer not null,
+  message_id integer not null,
+  author_id integer not null,
+  pub_date integer not null,
+  primary key (user_id, pub_date, message_id)
+) without rowid;
+
+create index home_timeline_author on home_timeline (user_id, author_id);
@@ -0,0 +1 @@
+alter table user add column avatar_hash char(32);
@@ -0,0 +1 @@
+alter table user add column follow_version integer not null default 0;
@@ -0,0 +1,19 @@
+-- The full-text index of the messages, reading their text from the message table itself
+create virtual table message_search using fts5(text, content='message', content_rowid='message_id');
+
+-- Kept in sync with the messages in the same transaction
+create trigger message_search_insert after insert on message begin
+  insert into message_search (rowid, text) values (new.message_id, new.text);
+end;
+
+create trigger message_search_delete after delete on message begin
+  insert into message_search (message_search, rowid, text) values ('delete', old.message_id, old.text);
+end;
+
+create trigger message_search_update after update of text on message begin
+  insert into message_search (message_search, rowid, text) values ('delete', old.message_id, old.text);
+  insert into message_search (rowid, text) values (new.message_id, new.text);
+end;
+
+-- Indexes the existing messages
+insert into message_search (message_search) values ('rebuild');
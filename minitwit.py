@@ -9,17 +9,32 @@
     :license: BSD, see LICENSE for more details.
 """
 
-from collections import namedtuple
 import time
+
+# The cold start is measured from here to the app ready to serve, see app.config['STARTUP']
+IMPORT_STARTED_AT = time.perf_counter()
+
+#pylint: disable=wrong-import-position
+from collections import Counter, namedtuple
+import itertools
+import random
 import json
 import os
+import re
+import unicodedata
 
+import click
+from functools import lru_cache
+import hashlib
 from hashlib import md5
+import hmac
 from datetime import datetime
 from flask import Flask, request, session, url_for, redirect
-from flask import render_template, abort, g, flash
-from werkzeug.security import check_password_hash, generate_password_hash
+from flask import render_template, abort, g, flash, has_request_context
+from markupsafe import Markup
+from flask import stream_with_context, before_render_template, template_rendered
 import sqlalchemy as db
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.sql import text
 import requests
 import boto3
@@ -27,11 +42,25 @@ import botocore
 
 from viasat.platform.cloud.host_service import HostService
 from viasat.platform.cloud.config_service import ConfigService
+from viasat.platform.cloud.startup_service import StartupService
+from viasat.platform.core.fragment_cache import FragmentCache
 from viasat.platform.core.http_response_decorator import HttpResponseDecorator
+from viasat.platform.core.password_hasher import PasswordHasher
+from viasat.platform.core.ttl_cache import TtlCache, invalidate_all_caches
+from viasat.platform.db.bulk_loader import BulkLoader
+from viasat.platform.db.migration_service import MigrationService
+from viasat.platform.db.pool_telemetry import POOLS, PoolTelemetry
+from viasat.platform.db.query_metrics import QueryMetrics
+from viasat.platform.db.replica_router import ReplicaRouter
+from viasat.platform.db.query_plan_service import QueryPlanService
+from viasat.platform.db.slow_query_log import SlowQueryLog
 
 # https://stackoverflow.com/questions/11994325/how-to-divide-flask-app-into-multiple-py-files
 from viasat.platform.observability.healthcheck_routes import healthcheck_api
 from viasat.platform.observability.admin_routes import admin_api
+from viasat.platform.observability.metrics import METRICS
+from viasat.platform.observability.metrics_routes import metrics_api
+from viasat.platform.observability.readiness import READINESS
 
 #======================================================================
 # Database settings
@@ -49,6 +78,9 @@ SCHEMAS = {
     DB_TYPE_MYSQL: 'db_mysql.sql',
 }
 
+# Versioned migrations applied on top of the schema files, one directory per db type
+MIGRATIONS_DIR = 'migrations'
+
 #======================================================================
 # configuration
 
@@ -81,16 +113,117 @@ SECRET_PASSWORD = 'password'
 CONFIG_DB_USER = 'DB_USER'
 CONFIG_DB_PASSWORD = 'DB_PASSWORD'
 
+# Connection pool settings, used for every db type. Size them for the worker threads.
+CONFIG_DB_POOL_SIZE = 'DB_POOL_SIZE'            # Connections kept open (default 5)
+CONFIG_DB_MAX_OVERFLOW = 'DB_MAX_OVERFLOW'      # Extra connections opened under load (default 10)
+CONFIG_DB_POOL_TIMEOUT = 'DB_POOL_TIMEOUT'      # Seconds to wait for a free connection (default 30)
+CONFIG_DB_POOL_RECYCLE = 'DB_POOL_RECYCLE'      # Seconds before a connection is replaced (default -1, never)
+CONFIG_DB_POOL_PRE_PING = 'DB_POOL_PRE_PING'    # Whether to test connections on checkout (default False)
+
+# Read replicas serving the query_db reads, writes always go to the primary.
+CONFIG_DB_REPLICA_ENDPOINTS = 'DB_REPLICA_ENDPOINTS'                # The RDS DNS names of the replicas
+CONFIG_LOCAL_REPLICA_DATABASE_URLS = 'LOCAL_REPLICA_DATABASE_URLS'  # sqlite files standing in for replicas
+
+# The url of a DB_TYPE_MYSQL database
+DB_URL_FORMAT = '{}://{}:{}@{}:3306/{}'
+
 #======================================================================
 # other constants
 
 PER_PAGE = 30
 DEBUG = True
 
+# When enabled, messages are pushed to the home_timeline table of every follower when
+# they are posted, so that the home page is a single range read. Run
+# "flask rebuild-home-timelines" after enabling it on an existing database.
+HOME_TIMELINE_FANOUT = False
+
+# Authors with more followers than this are not fanned out, their messages are merged
+# into the home timelines when they are read instead.
+FANOUT_MAX_FOLLOWERS = 1000
+
+# The public timeline pages are cached in-process, keyed by cursor. add_message invalidates
+# them, the TTL bounds how long other processes serve a page without the new message.
+PUBLIC_TIMELINE_CACHE_SIZE = 64
+PUBLIC_TIMELINE_CACHE_TTL = 10
+
+# The display fields of the logged in users are cached in-process, keyed by user id,
+# so that authenticated requests do not read the user row every time.
+IDENTITY_CACHE_SIZE = 10000
+IDENTITY_CACHE_TTL = 30
+
+# The rendered message lists of the timeline pages are cached in-process, keyed by the page's
+# messages, so that every viewer of a page reuses one render. The least recently used lists
+# are evicted beyond this many bytes.
+MESSAGE_LIST_CACHE_BYTES = 16 * 1024 * 1024
+
+# The users authenticated by HTTP basic auth on the API are remembered for this long, so that
+# pollers do not pay a password check on every request.
+API_CREDENTIALS_CACHE_SIZE = 10000
+API_CREDENTIALS_CACHE_TTL = 60
+
+# The avatar hash is stored on the user row. Rows that are not backfilled yet
+# ("flask backfill-avatar-hashes") are hashed through a memo of this size.
+AVATAR_HASH_CACHE_SIZE = 4096
+
+GRAVATAR_URL = 'https://www.gravatar.com/avatar/%s?d=identicon&s=%d'
+
+# Passwords are hashed with this werkzeug method and cost, e.g. 'pbkdf2:sha256:1000000', None
+# uses werkzeug's default. Hashes made with another method, or a lower cost, are upgraded on
+# the next successful login.
+PASSWORD_HASH_METHOD = None
+
+# Number of processes hashing passwords off the request threads, 0 hashes on the request thread
+PASSWORD_HASH_POOL_SIZE = 2
+
+# Limits of the batched message ingestion API
+API_MAX_BATCH_MESSAGES = 500
+API_MAX_BODY_BYTES = 1024 * 1024
+
+# Rows fetched at a time from the server-side cursor of the NDJSON exports
+EXPORT_CHUNK_SIZE = 1000
+
+# Statements slower than this are logged with their query plan, None disables the log.
+# The most recent ones are kept for /admin/db/slow-queries.
+SLOW_QUERY_THRESHOLD_MS = 100
+SLOW_QUERY_LOG_SIZE = 100
+
 # The key used to encrypt session keys
 SECRET_KEY = 'development key'
 
 DB_STASH = 'db'
+REPLICA_DB_STASH = 'replica_db'
+
+# Seconds a user reads from the primary after a write, so they see their own writes
+READ_YOUR_WRITES_SECONDS = 5
+PRIMARY_PIN = 'primary_until'
+
+# Seconds a failed replica is left out of the rotation
+REPLICA_RETRY_AFTER = 30
+
+# How the cloud metadata is bootstrapped at import time: 'sync' probes one url after the other,
+# 'concurrent' probes them all at once within STARTUP_PROBE_DEADLINE seconds, and 'background'
+# serves as off-cloud right away while they are probed. The results are cached in
+# STARTUP_CACHE_FILE for STARTUP_CACHE_TTL seconds, so that the next workers skip the probes.
+# It defaults to startup.json in the instance folder, and is only read if owned by the app's user.
+STARTUP_MODE = 'concurrent'
+STARTUP_PROBE_DEADLINE = 2
+STARTUP_CACHE_FILE = None
+STARTUP_CACHE_TTL = 300
+
+# Seconds between two refreshes of the readiness state, which the probes read from memory
+READINESS_INTERVAL = 5
+
+# Worker processes of the pre-fork server, 0 is one per core, and threads serving requests in each,
+# see gunicorn.conf.py
+WEB_WORKERS = 0
+WEB_THREADS = 4
+
+# Longest window, in seconds, that /admin/profile samples the requests for
+PROFILE_MAX_SECONDS = 60
+
+# Most words a search looks for. Run "flask rebuild-search-index" to index existing messages.
+SEARCH_MAX_WORDS = 10
 
 
 #======================================================================
@@ -106,10 +239,12 @@ app.config.from_envvar('MINITWIT_SETTINGS', silent=True)
 
 # Just add an extra config to see if it's in the cloud
 app.config['IN_CLOUD'] = None
-app.config["LOCAL_DATABASE_URL"] = LOCAL_DB_TYPE + ':////var/minitwit/minitwit.db'
+app.config.setdefault("LOCAL_DATABASE_URL", LOCAL_DB_TYPE + ':////var/minitwit/minitwit.db')
+app.config['STARTUP_CACHE_FILE'] = app.config['STARTUP_CACHE_FILE'] or os.path.join(app.instance_path, 'startup.json')
 
 # Just bootstrap the logs as soon as it loads, as other methods may need cloud metadata
-ConfigService.bootstrap_cloud_metadata(app)
+StartupService.bootstrap(app, app.config['STARTUP_MODE'], app.config['STARTUP_PROBE_DEADLINE'],
+                         app.config['STARTUP_CACHE_FILE'], app.config['STARTUP_CACHE_TTL'])
 
 def get_db_credentials():
     ''' If we are configured to do so, retrieve the db username and password
@@ -118,8 +253,11 @@ def get_db_credentials():
     secret_arn = app.config.get(CONFIG_DB_SECRET_ARN)
     app.logger.info('%s=%s', CONFIG_DB_SECRET_ARN, secret_arn) #pylint: disable=no-member
 
+    # The region comes from the cloud metadata, which may still be probed in the background
+    StartupService.wait(app.config['STARTUP_PROBE_DEADLINE'])
+
     # just making sure it's in AWS
-    region = "" if not HostService.is_running_in_the_cloud(app) else app.config["IN_CLOUD"]["metadata"]["region"]
+    region = "" if not HostService.is_running_in_the_cloud(app) else app.config["IN_CLOUD"]["metadata"].get("region", "")
 
     try:
         client = boto3.client(
@@ -165,29 +303,193 @@ def make_db_engine():
         credentials = get_db_credentials()
         secrets_used = credentials.secrets_used
 
-        db_url = '{}://{}:{}@{}:3306/{}'.format(
+        db_url = DB_URL_FORMAT.format(
             db_type, credentials.username, credentials.password, endpoint, name)
 
         app.logger.info( #pylint: disable=no-member
             'db_type=%s endpoint=%s db=%s username=%s using_secret=%s',
             db_type, endpoint, name, credentials.username,  str(secrets_used))
 
-    return (db.create_engine(db_url), secrets_used)
+    return (db.create_engine(db_url, **get_pool_options(db_type)), secrets_used)
+
+
+def get_pool_options(db_type):
+    ''' The connection pool settings from the config, with the SQLAlchemy defaults
+    '''
+    options = dict(
+        poolclass=QueuePool,
+        pool_size=app.config.get(CONFIG_DB_POOL_SIZE, 5),
+        max_overflow=app.config.get(CONFIG_DB_MAX_OVERFLOW, 10),
+        pool_timeout=app.config.get(CONFIG_DB_POOL_TIMEOUT, 30),
+        pool_recycle=app.config.get(CONFIG_DB_POOL_RECYCLE, -1),
+        pool_pre_ping=app.config.get(CONFIG_DB_POOL_PRE_PING, False))
+
+    if db_type == DB_TYPE_SQLITE:
+        # Pooled sqlite connections are handed to one request thread at a time
+        options['connect_args'] = {'check_same_thread': False}
+
+    app.logger.info('Connection pool %s', #pylint: disable=no-member
+                    {k: v for k, v in options.items() if k.startswith('pool') or k == 'max_overflow'})
+    return options
+
+
+def make_replica_engines():
+    ''' Create an engine for each configured read replica
+    '''
+    db_type = app.config.get(CONFIG_DB_TYPE, LOCAL_DB_TYPE)
+
+    if db_type == LOCAL_DB_TYPE:
+        db_urls = app.config.get(CONFIG_LOCAL_REPLICA_DATABASE_URLS) or []
+
+    else:
+        endpoints = app.config.get(CONFIG_DB_REPLICA_ENDPOINTS) or []
+        name = app.config.get(CONFIG_DB_NAME)
+        credentials = get_db_credentials() if endpoints else None
+        db_urls = [DB_URL_FORMAT.format(db_type, credentials.username, credentials.password, endpoint, name)
+                   for endpoint in endpoints]
+
+        app.logger.info('db_type=%s replicas=%s', db_type, endpoints) #pylint: disable=no-member
+
+    return [db.create_engine(db_url, **get_pool_options(db_type)) for db_url in db_urls]
 
 
 DB_ENGINE, SECRETS_USED = make_db_engine()
 
+POOL_TELEMETRY = PoolTelemetry('primary', DB_ENGINE)
+
+READ_REPLICAS = ReplicaRouter('replica', make_replica_engines(), app.config['REPLICA_RETRY_AFTER'])
+
+PUBLIC_TIMELINE_CACHE = TtlCache(
+    'public_timeline', app.config['PUBLIC_TIMELINE_CACHE_SIZE'], app.config['PUBLIC_TIMELINE_CACHE_TTL'])
+
+IDENTITY_CACHE = TtlCache('identity', app.config['IDENTITY_CACHE_SIZE'], app.config['IDENTITY_CACHE_TTL'])
+
+MESSAGE_LIST_CACHE = FragmentCache('message_list', app.config['MESSAGE_LIST_CACHE_BYTES'])
+
+API_CREDENTIALS_CACHE = TtlCache(
+    'api_credentials', app.config['API_CREDENTIALS_CACHE_SIZE'], app.config['API_CREDENTIALS_CACHE_TTL'])
+
+# Keys the cached API credentials, so that the passwords are not kept in memory in the clear
+API_CREDENTIALS_KEY = os.urandom(32)
+
+PASSWORD_HASHER = PasswordHasher(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_HASH_POOL_SIZE'])
+
+SLOW_QUERY_LOG = SlowQueryLog(
+    'queries', app.config['SLOW_QUERY_THRESHOLD_MS'], app.config['SLOW_QUERY_LOG_SIZE'], app.logger,
+    lambda: (request.endpoint or request.path) if has_request_context() else 'cli')
+SLOW_QUERY_LOG.watch(DB_ENGINE)
+for _replica in READ_REPLICAS.replicas:
+    SLOW_QUERY_LOG.watch(_replica.engine)
+
+
+def pool_connections():
+    """Reads the connections of every pool by state, for the metrics"""
+    connections = []
+    for name, telemetry in POOLS.items():
+        pool = telemetry.engine.pool
+        # Only the queue pools keep connections
+        if hasattr(pool, 'checkedout'):
+            connections.append(({'pool': name, 'state': 'checked_in'}, pool.checkedin()))
+            connections.append(({'pool': name, 'state': 'checked_out'}, pool.checkedout()))
+            connections.append(({'pool': name, 'state': 'overflow'}, max(0, pool.overflow())))
+    return connections
+
+
+METRICS.counter('minitwit_http_requests_total', 'Requests served, by endpoint, method and status.')
+METRICS.histogram('minitwit_http_request_duration_seconds', 'Duration of the requests, by endpoint, in seconds.')
+METRICS.histogram('minitwit_template_render_duration_seconds', 'Duration of the template renders, in seconds.')
+METRICS.gauge('minitwit_db_pool_connections', 'Connections of the database pools, by state.', pool_connections)
+QueryMetrics.declare()
+QueryMetrics('primary', DB_ENGINE)
+for _replica in READ_REPLICAS.replicas:
+    QueryMetrics(_replica.name, _replica.engine)
+
+
+def check_database_readiness():
+    """Times a round trip through the primary pool, for the readiness probe"""
+    start = time.perf_counter()
+    with DB_ENGINE.connect() as conn:
+        conn.execute(text('select 1')).scalar()
+    return {
+        "status": 200,
+        "type": DB_ENGINE.dialect.name,
+        "resource": DB_ENGINE.url.render_as_string(hide_password=True),
+        "latency_ms": round((time.perf_counter() - start) * 1000, 3),
+    }
+
+
+def check_schema_readiness():
+    """Checks that every migration is applied, for the readiness probe"""
+    expected_version = max((version for version, _, _ in MigrationService.list_migrations(
+        os.path.join(app.root_path, MIGRATIONS_DIR), app.config.get(CONFIG_DB_TYPE, LOCAL_DB_TYPE))), default=0)
+    # A database whose schema was never initialized has no version table, and is reported as not ready
+    with DB_ENGINE.connect() as conn:
+        version = conn.execute(text('select max(version) from {}'.format(MigrationService.VERSION_TABLE))).scalar()
+    return {"status": 200 if (version or 0) >= expected_version else 503,
+            "version": version or 0, "expected_version": expected_version}
+
+
+READINESS.add_check('database', check_database_readiness)
+READINESS.add_check('schema', check_schema_readiness)
+READINESS.configure(app.config['READINESS_INTERVAL'], app.logger)
+
+
+def reset_after_fork():
+    """Gives a forked worker database pools of its own. The connections inherited from the parent
+    are dropped without being closed, which would close the parent's sockets too.
+    """
+    DB_ENGINE.dispose(close=False)
+    for replica in READ_REPLICAS.replicas:
+        replica.engine.dispose(close=False)
+
+
+# Whatever forks the app, a pre-fork server or a multiprocessing pool
+os.register_at_fork(after_in_child=reset_after_fork)
+
 
 def get_db():
     """Opens a new database connection if there is none yet for the
     current request.
     """
     if DB_STASH not in g:
-        g.db = DB_ENGINE.connect() #pylint: disable=assigning-non-slot
+        g.db = POOL_TELEMETRY.connect() #pylint: disable=assigning-non-slot
 
     return g.db
 
 
+def get_read_db():
+    """Opens a connection to a read replica if there is none yet for the current
+    request. Falls back to the primary when no replica is configured or healthy, outside
+    of requests, inside a transaction, and while the user is pinned to the primary.
+    """
+    if not READ_REPLICAS.replicas or not has_request_context() or is_pinned_to_primary() or \
+            (DB_STASH in g and g.db.in_transaction()):
+        return get_db()
+
+    if REPLICA_DB_STASH not in g:
+        g.replica_db = READ_REPLICAS.connect() #pylint: disable=assigning-non-slot
+
+    _, the_db = g.replica_db
+    return the_db if the_db is not None else get_db()
+
+
+def pin_to_primary():
+    """Sends the reads of the logged in user to the primary for a few seconds after a write.
+    Anonymous and API requests have no session to pin, and are not sent a cookie for it.
+    """
+    if not READ_REPLICAS.replicas or not has_request_context() or 'user_id' not in session:
+        return
+    # The session is only written again once half of the window is over, not on every statement
+    window = app.config['READ_YOUR_WRITES_SECONDS']
+    if session.get(PRIMARY_PIN, 0) < time.time() + window / 2:
+        session[PRIMARY_PIN] = time.time() + window
+
+
+def is_pinned_to_primary():
+    """Whether the current user wrote within the last READ_YOUR_WRITES_SECONDS."""
+    return session.get(PRIMARY_PIN, 0) > time.time()
+
+
 @app.teardown_appcontext
 def close_database(_exception):
     """Closes the database again at the end of the request."""
@@ -196,6 +498,11 @@ def close_database(_exception):
     if the_db is not None:
         the_db.close()
 
+    _, replica_db = g.pop(REPLICA_DB_STASH, (None, None))
+
+    if replica_db is not None:
+        replica_db.close()
+
 
 def init_db():
     """Initializes the database."""
@@ -211,6 +518,51 @@ def init_db():
             if len(query.strip()) > 0:
                 the_db.execute(query.strip() + ';')
 
+    # A new database always starts at the latest schema version
+    migrate_db()
+    invalidate_all_caches()
+
+
+def migrate_db(target_version=None):
+    """Upgrades the database schema in place."""
+    return MigrationService.migrate(
+        app, get_db(), app.config.get(CONFIG_DB_TYPE, LOCAL_DB_TYPE),
+        os.path.join(app.root_path, MIGRATIONS_DIR), target_version)
+
+
+def check_query_plans():
+    """Returns the timeline queries whose plans still show a full table scan."""
+    return QueryPlanService.find_full_scans(
+        get_db(), app.config.get(CONFIG_DB_TYPE, LOCAL_DB_TYPE), {
+            'user_id': (USER_ID_QUERY, {'username': 'user'}),
+            'user_by_username': (USER_BY_USERNAME_QUERY, {'username': 'user'}),
+            'followed': (FOLLOWED_QUERY, {'whoid': 1, 'whomid': 2}),
+            'home_timeline': (timeline_query(HOME_TIMELINE_QUERY), {'userid': 1, 'whoid': 1, 'limit': PER_PAGE}),
+            'home_timeline_older': (timeline_query(HOME_TIMELINE_QUERY, CURSOR_OLDER), dict(
+                userid=1, whoid=1, cursor_pub_date=0, cursor_message_id=0, limit=PER_PAGE)),
+            'public_timeline': (timeline_query(PUBLIC_TIMELINE_QUERY), {'limit': PER_PAGE}),
+            'public_timeline_older': (timeline_query(PUBLIC_TIMELINE_QUERY, CURSOR_OLDER), dict(
+                cursor_pub_date=0, cursor_message_id=0, limit=PER_PAGE)),
+            'public_timeline_newer': (timeline_query(PUBLIC_TIMELINE_QUERY, CURSOR_NEWER), dict(
+                cursor_pub_date=0, cursor_message_id=0, limit=PER_PAGE)),
+            'user_timeline': (timeline_query(USER_TIMELINE_QUERY), {'userid': 1, 'limit': PER_PAGE}),
+            'user_timeline_older': (timeline_query(USER_TIMELINE_QUERY, CURSOR_OLDER), dict(
+                userid=1, cursor_pub_date=0, cursor_message_id=0, limit=PER_PAGE)),
+            'materialized_home_timeline': (timeline_query(
+                MATERIALIZED_HOME_TIMELINE_QUERY, key='home_timeline'), {'userid': 1, 'limit': PER_PAGE}),
+            'materialized_home_timeline_older': (timeline_query(
+                MATERIALIZED_HOME_TIMELINE_QUERY, CURSOR_OLDER, 'home_timeline'), dict(
+                    userid=1, cursor_pub_date=0, cursor_message_id=0, limit=PER_PAGE)),
+            'fanout_on_read_home_timeline': (timeline_query(FANOUT_ON_READ_HOME_TIMELINE_QUERY), dict(
+                whoid=1, limit=PER_PAGE)),
+            'home_timeline_version': (HOME_TIMELINE_VERSION_QUERY, {'userid': 1}),
+            'public_timeline_version': (PUBLIC_TIMELINE_VERSION_QUERY, {}),
+            'user_timeline_version': (USER_TIMELINE_VERSION_QUERY, {'userid': 1}),
+            'followers': (FOLLOW_LIST_QUERIES['followers'], {'userid': 1, 'after': 0, 'limit': PER_PAGE}),
+            'following': (FOLLOW_LIST_QUERIES['following'], {'userid': 1, 'after': 0, 'limit': PER_PAGE}),
+        })
+
+
 @app.cli.command('initdb')
 def initdb_command():
     """Creates the database tables."""
@@ -218,27 +570,739 @@ def initdb_command():
     print('Initialized the database.')
 
 
+@app.cli.command('rebuild-home-timelines')
+def rebuild_home_timelines_command():
+    """Fills the fan-out-on-write home timelines from the existing messages."""
+    rebuild_home_timelines()
+    print('Rebuilt the home timelines.')
+
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Indexes the existing messages for the full-text search."""
+    rebuild_search_index()
+    print('Rebuilt the search index.')
+
+
+@app.cli.command('backfill-avatar-hashes')
+def backfill_avatar_hashes_command():
+    """Stores the avatar hash of the existing users."""
+    print('Backfilled the avatar hash of %d users.' % backfill_avatar_hashes())
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Recounts the followers, following and messages of every user, repairing the counters that drifted."""
+    print('Repaired the counters of %d users.' % reconcile_counters())
+
+
+@app.cli.command('seed')
+@click.option('--users', type=int, default=1000, help='Number of users to create.')
+@click.option('--follows', type=int, default=50, help='Average number of users followed.')
+@click.option('--messages', type=int, default=100000, help='Number of messages to create.')
+@click.option('--days', type=int, default=365, help='Days over which the messages are spread.')
+@click.option('--seed', type=int, default=42, help='Seed of the random generator.')
+@click.option('--exponent', type=float, default=1.1,
+              help='Exponent of the power laws of the user popularity and activity.')
+@click.option('--end', type=int, default=1700000000, help='Timestamp of the newest message.')
+def seed_command(users, follows, messages, days, seed, exponent, end):
+    """Loads a synthetic social graph for performance work, deterministic for a given seed."""
+    # The follows and messages are drawn among the seeded users only
+    if users < 1 and (follows > 0 or messages > 0):
+        raise click.BadParameter('must be at least 1 to seed follows or messages', param_hint='--users')
+    start = time.time()
+    loaded = seed_db(users, follows, messages, days, seed, exponent, end)
+    print('Loaded %d users, %d follows and %d messages in %.1f s. The password of every user is "%s".' % (
+        loaded + (time.time() - start, SEED_PASSWORD)))
+
+
+@app.cli.command('migrate')
+@click.option('--target-version', type=int, default=None, help='Stop at this schema version.')
+def migrate_command(target_version):
+    """Upgrades an existing database to the latest schema version."""
+    applied = migrate_db(target_version)
+    for version, name in applied:
+        print('Applied migration %04d_%s' % (version, name))
+    print('The database is at schema version %d.' % MigrationService.get_current_version(get_db()))
+
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fails if any timeline query plan still shows a full table scan."""
+    offenders = check_query_plans()
+    for name, steps in offenders.items():
+        print('%s: %s' % (name, '; '.join(steps)))
+    if offenders:
+        raise click.ClickException('Full table scans found in %d queries.' % len(offenders))
+    print('No full table scans found.')
+
+
 def query_db(query, args=None, one=False):
     """Queries the database and returns a list of dictionaries."""
 
-    values = list(exec_db(query, args))
+    the_db = get_read_db()
+    try:
+        values = list(execute_db(the_db, query, args))
+
+    except db.exc.OperationalError:
+        if the_db is g.get(DB_STASH):
+            raise
+
+        # The replica failed: leave it out of the rotation and read from the primary
+        name, replica_db = g.pop(REPLICA_DB_STASH)
+        replica_db.close()
+        READ_REPLICAS.mark_down(name)
+        g.replica_db = (None, None) #pylint: disable=assigning-non-slot
+        values = list(execute_db(get_db(), query, args))
+
     return (values[0] if values else None) if one else values
 
 
 def exec_db(query, args=None):
-    """Queries the database and return the result as is."""
+    """Runs a statement on the primary database and return the result as is."""
+
+    pin_to_primary()
+    return execute_db(get_db(), query, args)
+
+
+def execute_db(the_db, query, args=None):
+    """Queries the given database connection and return the result as is."""
 
     if args is None:
         args = dict()
 
     stmt = text(query)
-    return get_db().execute(stmt, **args)
+    return the_db.execute(stmt, **args)
+
+
+#======================================================================
+# Hot queries, shared by the routes and the query plan check
+
+USER_ID_QUERY = 'select user_id from user where username = :username'
+
+USER_BY_USERNAME_QUERY = 'select * from user where username = :username'
+
+IDENTITY_QUERY = 'select user_id, username, email from user where user_id = :userid'
+
+INSERT_USER_QUERY = '''insert into user (
+                username, email, pw_hash, avatar_hash) values (:username, :email, :pwhash, :avatarhash)'''
+
+UPDATE_PW_HASH_QUERY = 'update user set pw_hash = :pwhash where user_id = :userid'
+
+FOLLOWED_QUERY = '''select 1 from follower where
+            follower.who_id = :whoid and follower.whom_id = :whomid'''
+
+# The timeline queries are keyset paginated on (pub_date, message_id): {cursor} is replaced by
+# one of the CURSOR_CONDITIONS and {order} by the matching sort direction, see query_timeline().
+# The {key} of the conditions is the table holding the sort columns, message unless noted.
+HOME_TIMELINE_QUERY = '''
+        select message.*, user.* from message, user
+        where message.author_id = user.user_id and (
+            user.user_id = :userid or
+            user.user_id in (select whom_id from follower
+                                    where who_id = :whoid)) {cursor}
+        order by message.pub_date {order}, message.message_id {order} limit :limit'''
+
+PUBLIC_TIMELINE_QUERY = '''
+        select message.*, user.* from message, user
+        where message.author_id = user.user_id {cursor}
+        order by message.pub_date {order}, message.message_id {order} limit :limit'''
+
+USER_TIMELINE_QUERY = '''select message.*, user.* from message, user where
+            user.user_id = message.author_id and user.user_id = :userid {cursor}
+            order by message.pub_date {order}, message.message_id {order} limit :limit'''
+
+# Used with HOME_TIMELINE_FANOUT: the fanned out messages, keyed on home_timeline ...
+MATERIALIZED_HOME_TIMELINE_QUERY = '''
+        select message.*, user.* from home_timeline, message, user
+        where home_timeline.user_id = :userid and
+            message.message_id = home_timeline.message_id and
+            user.user_id = message.author_id {cursor}
+        order by home_timeline.pub_date {order}, home_timeline.message_id {order} limit :limit'''
+
+# ... merged with the messages of the followed authors that are not fanned out
+FANOUT_ON_READ_HOME_TIMELINE_QUERY = '''
+        select message.*, user.* from message, user
+        where message.author_id = user.user_id and user.fanout_on_read = 1 and
+            user.user_id in (select whom_id from follower
+                                    where who_id = :whoid) {cursor}
+        order by message.pub_date {order}, message.message_id {order} limit :limit'''
+
+# The versions of the timelines for their ETags: the newest message id, and for the home
+# timeline the version bumped by the follows and the messages written to it, along with the
+# newest message of the followed authors read at read time, see bump_home_timeline_versions().
+# Those authors are the few with more than FANOUT_MAX_FOLLOWERS followers, so the lookup
+# costs the same however many users are followed.
+HOME_TIMELINE_VERSION_QUERY = '''select (select home_timeline_version from user where user_id = :userid), max(newest)
+        from (
+            select (select message_id from message where author_id = author.user_id
+                    order by pub_date desc, message_id desc limit 1) as newest
+            from user as author
+            where author.fanout_on_read = 1 and exists (
+                select 1 from follower where follower.who_id = :userid and follower.whom_id = author.user_id)
+        ) as read_time'''
+
+PUBLIC_TIMELINE_VERSION_QUERY = 'select max(message_id) from message'
+
+USER_TIMELINE_VERSION_QUERY = '''select message_id from message where author_id = :userid
+        order by pub_date desc, message_id desc limit 1'''
+
+# The pages of the followers and of the followed users of a user, in user id order from the
+# follower table's indexes, so that a page costs the same however many there are
+FOLLOW_LIST_QUERIES = {
+    'followers': '''select user.user_id, user.username, user.email, user.avatar_hash from follower, user
+        where follower.whom_id = :userid and follower.who_id > :after and user.user_id = follower.who_id
+        order by follower.who_id limit :limit''',
+    'following': '''select user.user_id, user.username, user.email, user.avatar_hash from follower, user
+        where follower.who_id = :userid and follower.whom_id > :after and user.user_id = follower.whom_id
+        order by follower.whom_id limit :limit''',
+}
+
+# The counters kept on the user row, and how to count them from scratch
+USER_COUNTERS = {
+    'follower_count': 'select count(*) from follower where follower.whom_id = user.user_id',
+    'following_count': 'select count(*) from follower where follower.who_id = user.user_id',
+    'message_count': 'select count(*) from message where message.author_id = user.user_id',
+}
+
+# The NDJSON exports of a user's account, streamed in the index order
+EXPORT_QUERIES = {
+    'messages': '''select message_id, text, pub_date from message
+        where author_id = :userid order by pub_date, message_id''',
+    'followers': '''select user.user_id, user.username from follower, user
+        where follower.whom_id = :userid and user.user_id = follower.who_id''',
+    'following': '''select user.user_id, user.username from follower, user
+        where follower.who_id = :userid and user.user_id = follower.whom_id''',
+}
+
+# The full-text search, keyset paginated on message_id: a page holds the newest matches older
+# than the {cursor}, read from the text index in message id order, so that it costs the same
+# however many messages match and never repeats nor skips one as new messages arrive. Each
+# page is then ranked by search_page(). On MySQL every word is required, as in FTS5.
+SEARCH_QUERIES = {
+    DB_TYPE_SQLITE: '''
+        select message.*, user.* from (
+            select rowid from message_search
+            where message_search match :query {cursor} order by rowid desc limit :limit) as matches,
+            message, user
+        where message.message_id = matches.rowid and user.user_id = message.author_id
+        order by message.message_id desc''',
+    DB_TYPE_MYSQL: '''
+        select message.*, user.* from message, user
+        where match (message.text) against (:query in boolean mode) and user.user_id = message.author_id {cursor}
+        order by message.message_id desc limit :limit''',
+}
+
+SEARCH_CURSOR_CONDITIONS = {
+    DB_TYPE_SQLITE: 'and rowid < :cursor_message_id',
+    DB_TYPE_MYSQL: 'and message.message_id < :cursor_message_id',
+}
+
+# Indexes the messages again, e.g. after a bulk load with the triggers dropped
+SEARCH_REBUILD_STATEMENTS = {
+    DB_TYPE_SQLITE: ["insert into message_search (message_search) values ('rebuild')",
+                     # Merges the index into one segment, a match reads a single list of messages
+                     "insert into message_search (message_search) values ('optimize')"],
+    DB_TYPE_MYSQL: ['optimize table message'],
+}
+
+# The words of the text index, runs of letters and digits as the FTS5 unicode61 tokenizer sees them
+SEARCH_WORD_PATTERN = re.compile(r'[^\W_]+', re.UNICODE)
+
+# Pages are read either older than the "before" cursor or newer than the "after" cursor.
+# The redundant pub_date range keeps the condition usable by the pub_date indexes.
+CURSOR_OLDER = 'before'
+CURSOR_NEWER = 'after'
+
+CURSOR_CONDITIONS = {
+    None: ('', 'desc'),
+    CURSOR_OLDER: ('''and {key}.pub_date <= :cursor_pub_date and (
+            {key}.pub_date < :cursor_pub_date or {key}.message_id < :cursor_message_id)''', 'desc'),
+    CURSOR_NEWER: ('''and {key}.pub_date >= :cursor_pub_date and (
+            {key}.pub_date > :cursor_pub_date or {key}.message_id > :cursor_message_id)''', 'asc'),
+}
+
+TimelinePage = namedtuple('TimelinePage', 'messages older newer')
+
+# A timeline query with its args, and the table holding its sort columns
+TimelineSource = namedtuple('TimelineSource', 'query args key', defaults=('message',))
+
+
+def timeline_query(query, direction=None, key='message'):
+    """Returns the timeline query for reading a page in the given cursor direction."""
+    condition, order = CURSOR_CONDITIONS[direction]
+    return query.format(cursor=condition.format(key=key), order=order)
+
+
+def encode_cursor(message):
+    """Returns the URL cursor pointing at the given message."""
+    return '%d-%d' % (message['pub_date'], message['message_id'])
+
+
+def decode_cursor(cursor):
+    """Returns the (pub_date, message_id) of a URL cursor, aborting on a malformed one."""
+    try:
+        pub_date, message_id = cursor.split('-')
+        return int(pub_date), int(message_id)
+    except ValueError:
+        abort(400)
+
+
+def timeline_cursor(args):
+    """Returns the direction and the query args of the cursor in the request args."""
+    for direction in (CURSOR_OLDER, CURSOR_NEWER):
+        if args.get(direction):
+            pub_date, message_id = decode_cursor(args[direction])
+            return direction, dict(cursor_pub_date=pub_date, cursor_message_id=message_id)
+    return None, {}
+
+
+def query_timeline(*sources):
+    """Reads the page of the timeline selected by the request's cursor. Each page is a
+    range read on the (pub_date, message_id) order, so it costs the same at any depth and
+    is not shifted by messages inserted meanwhile. The pages of several TimelineSources
+    are merged into one.
+    """
+    direction, cursor_args = timeline_cursor(request.args)
+
+    # One extra row tells whether there is another page in the same direction
+    messages = []
+    for source in sources:
+        messages += query_db(timeline_query(source.query, direction, source.key),
+                             dict(source.args, limit=PER_PAGE + 1, **cursor_args))
+
+    return timeline_page(messages, direction, len(sources) > 1)
+
+
+def timeline_page(messages, direction, merge=False):
+    """Returns the page made of the PER_PAGE + 1 messages read in the cursor direction,
+    sorting them first when they were read from several sources."""
+    if merge:
+        unique = {message['message_id']: message for message in messages}
+        messages = sorted(unique.values(), key=lambda message: (message['pub_date'], message['message_id']),
+                          reverse=direction != CURSOR_NEWER)
+
+    has_more = len(messages) > PER_PAGE
+    messages = messages[:PER_PAGE]
+
+    if direction == CURSOR_NEWER:
+        messages.reverse()
+        older = encode_cursor(messages[-1]) if messages else None
+        newer = encode_cursor(messages[0]) if messages and has_more else None
+    else:
+        older = encode_cursor(messages[-1]) if messages and has_more else None
+        newer = encode_cursor(messages[0]) if messages and direction == CURSOR_OLDER else None
+
+    return TimelinePage(messages, older, newer)
+
+
+def is_read_at_read_time(author_id):
+    """Whether the followers of an author read its messages at read time rather than have them written
+    to their home timelines, which is the case once it has more than FANOUT_MAX_FOLLOWERS followers.
+    """
+    author = query_db('select fanout_on_read, follower_count from user where user_id = :authorid',
+                      {'authorid': author_id}, one=True)
+    if author['fanout_on_read']:  #pylint: disable=unsubscriptable-object
+        return True
+    if author['follower_count'] <= app.config['FANOUT_MAX_FOLLOWERS']:  #pylint: disable=unsubscriptable-object
+        return False
+
+    # From now on the followers read this author's messages at read time
+    exec_db('update user set fanout_on_read = 1 where user_id = :authorid', {'authorid': author_id})
+    return True
+
+
+def fan_out_messages(author_id, message_ids, pub_date, to_followers):
+    """Pushes new messages to the home timelines of their author, and of their followers if to_followers."""
+    for message_id in message_ids:
+        exec_db('''insert into home_timeline (user_id, message_id, author_id, pub_date)
+            values (:authorid, :messageid, :authorid, :pubdate)''',
+                dict(authorid=author_id, messageid=message_id, pubdate=pub_date))
+
+    if to_followers:
+        # A user may follow themselves, their own row is already in
+        for message_id in message_ids:
+            exec_db('''insert into home_timeline (user_id, message_id, author_id, pub_date)
+                select who_id, :messageid, :authorid, :pubdate from follower
+                where whom_id = :authorid and who_id != :authorid''',
+                    dict(authorid=author_id, messageid=message_id, pubdate=pub_date))
+
+
+def bump_home_timeline_versions(author_id, to_followers):
+    """Changes the version of the home timeline of an author who wrote, and of its followers' if to_followers.
+    The followers of an author read at read time see its messages change the newest message part of the ETag.
+    """
+    bump_home_timeline_version(author_id)
+    if to_followers:
+        exec_db('''update user set home_timeline_version = home_timeline_version + 1
+            where user_id in (select who_id from follower where whom_id = :authorid and who_id != :authorid)''',
+                {'authorid': author_id})
+
+
+@lru_cache(maxsize=None)
+def has_consecutive_insert_ids():
+    """Whether the ids of a multi-row insert are consecutive. sqlite has a single writer, while InnoDB
+    only guarantees it for innodb_autoinc_lock_mode 0 or 1, not 2, the MySQL 8 default.
+    """
+    if DB_ENGINE.dialect.name == DB_TYPE_SQLITE:
+        return True
+
+    lock_mode = int(query_db('select @@innodb_autoinc_lock_mode', one=True)[0])
+    if lock_mode > 1:
+        app.logger.warning('innodb_autoinc_lock_mode=%d, messages are inserted one row at a time', lock_mode)
+    return lock_mode <= 1
+
+
+def insert_messages(author_id, texts):
+    """Records the messages of an author with a single multi-row insert, in one
+    transaction with their fan-out, and returns their ids in order.
+    """
+    pub_date = int(time.time())
+    args = dict(authorid=author_id, pubdate=pub_date)
+    rows = []
+    for index, message_text in enumerate(texts):
+        args['text%d' % index] = message_text
+        rows.append('(:authorid, :text%d, :pubdate)' % index)
+
+    with get_db().begin():
+        if not has_consecutive_insert_ids():
+            # Each insert reports its own id
+            message_ids = [
+                exec_db('insert into message (author_id, text, pub_date) values (:authorid, :text, :pubdate)',
+                        dict(authorid=author_id, text=message_text, pubdate=pub_date)).lastrowid
+                for message_text in texts]
+
+        else:
+            result = exec_db('insert into message (author_id, text, pub_date) values ' + ', '.join(rows), args)
+
+            # sqlite reports the last id of a multi-row insert, MySQL the first one
+            if DB_ENGINE.dialect.name == DB_TYPE_SQLITE:
+                first_id = result.lastrowid - len(texts) + 1
+            else:
+                first_id = result.lastrowid
+            message_ids = list(range(first_id, first_id + len(texts)))
+
+        exec_db('update user set message_count = message_count + :count where user_id = :authorid',
+                dict(count=len(texts), authorid=author_id))
+        to_followers = not is_read_at_read_time(author_id)
+        bump_home_timeline_versions(author_id, to_followers)
+        if app.config['HOME_TIMELINE_FANOUT']:
+            fan_out_messages(author_id, message_ids, pub_date, to_followers)
+
+    PUBLIC_TIMELINE_CACHE.invalidate()
+    return message_ids
+
+
+def count_follow(who_id, whom_id, delta):
+    """Adds delta to the following count of the follower and to the follower count of the followed user."""
+    exec_db('update user set following_count = following_count + :delta where user_id = :whoid',
+            dict(delta=delta, whoid=who_id))
+    exec_db('update user set follower_count = follower_count + :delta where user_id = :whomid',
+            dict(delta=delta, whomid=whom_id))
+
+
+def reconcile_counters(batch_size=1000):
+    """Counts the followers, following and messages of the users again, batch_size users per
+    transaction, and repairs the counters that drifted. Returns the number of users repaired.
+    """
+    recount = ', '.join('{} = ({})'.format(column, count) for column, count in USER_COUNTERS.items())
+    drifted = ' or '.join('{} != ({})'.format(column, count) for column, count in USER_COUNTERS.items())
+    repaired, last_id = 0, 0
+    while True:
+        users = query_db('select user_id from user where user_id > :lastid order by user_id limit :limit',
+                         {'lastid': last_id, 'limit': batch_size})
+        if not users:
+            break
+        with get_db().begin():
+            repaired += exec_db('update user set {} where user_id between :first and :last and ({})'.format(
+                recount, drifted), {'first': users[0]['user_id'], 'last': users[-1]['user_id']}).rowcount
+        last_id = users[-1]['user_id']
+    return repaired
+
+
+def bump_home_timeline_version(who_id):
+    """Changes the version of a user's home timeline, part of its ETag, after a follow or a message."""
+    exec_db('update user set home_timeline_version = home_timeline_version + 1 where user_id = :whoid',
+            {'whoid': who_id})
+
+
+def backfill_home_timeline(who_id, whom_id):
+    """Adds the messages of a newly followed author to the follower's home timeline.
+    Following oneself adds nothing, one's own messages are always there.
+    """
+    exec_db('''insert into home_timeline (user_id, message_id, author_id, pub_date)
+        select :whoid, message.message_id, message.author_id, message.pub_date from message, user
+        where message.author_id = :whomid and user.user_id = :whomid and user.fanout_on_read = 0 and
+            message.author_id != :whoid''',
+            dict(whoid=who_id, whomid=whom_id))
+
+
+def prune_home_timeline(who_id, whom_id):
+    """Removes the messages of an unfollowed author from the follower's home timeline,
+    but never the follower's own messages.
+    """
+    exec_db('delete from home_timeline where user_id = :whoid and author_id = :whomid and author_id != user_id',
+            dict(whoid=who_id, whomid=whom_id))
+
+
+def rebuild_home_timelines():
+    """Fills the home timelines of all users from their own and their followed authors' messages."""
+    with get_db().begin():
+        exec_db('''update user set fanout_on_read = case
+            when (select count(*) from follower where whom_id = user.user_id) > :maxfollowers then 1 else 0 end''',
+                {'maxfollowers': app.config['FANOUT_MAX_FOLLOWERS']})
+        exec_db('delete from home_timeline')
+        exec_db('''insert into home_timeline (user_id, message_id, author_id, pub_date)
+            select author_id, message_id, author_id, pub_date from message''')
+        exec_db('''insert into home_timeline (user_id, message_id, author_id, pub_date)
+            select follower.who_id, message.message_id, message.author_id, message.pub_date
+            from follower, message, user
+            where message.author_id = follower.whom_id and user.user_id = follower.whom_id and
+                user.fanout_on_read = 0 and follower.who_id != follower.whom_id''')
+
+
+#======================================================================
+# Synthetic data
+
+# The password of every seeded user
+SEED_PASSWORD = 'default'
+
+# Weighted draws of the followed users before the missing ones are picked uniformly
+SEED_FOLLOW_DRAWS = 10
+
+SEED_WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut '
+              'labore et dolore magna aliqua flask python twitter timeline follow cloud database').split()
+
+
+def power_law_weights(count, exponent):
+    """Returns the cumulative weights picking the item of rank r in proportion to 1 / r ** exponent."""
+    return list(itertools.accumulate(1.0 / rank ** exponent for rank in range(1, count + 1)))
+
+
+def generate_users(user_ids, pw_hash):
+    """Yields the (user_id, username, email, pw_hash, avatar_hash) rows of the seeded users."""
+    for user_id in user_ids:
+        email = 'user%d@example.com' % user_id
+        yield (user_id, 'user%d' % user_id, email, pw_hash, avatar_hash(email))
+
+
+def generate_follows(rng, user_ids, average_follows, exponent):
+    """Yields the (who_id, whom_id) rows of a follower graph whose popularity follows a power law."""
+    popularity = list(user_ids)
+    rng.shuffle(popularity)
+    cum_weights = power_law_weights(len(popularity), exponent)
+
+    for who_id in user_ids:
+        # The Pareto distribution with shape 1.5 has a mean of 3
+        wanted = min(len(user_ids) - 1, int(round(rng.paretovariate(1.5) * average_follows / 3)))
+        whom_ids = set()
+        # Repeated picks of the popular users are drawn again, so that the user follows as many as wanted
+        for _ in range(SEED_FOLLOW_DRAWS):
+            whom_ids.update(rng.choices(popularity, cum_weights=cum_weights, k=wanted - len(whom_ids)))
+            whom_ids.discard(who_id)
+            if len(whom_ids) == wanted:
+                break
+        else:
+            # Only the heaviest followers get here, they follow the rest among everyone else
+            others = [user_id for user_id in popularity if user_id != who_id and user_id not in whom_ids]
+            whom_ids.update(rng.sample(others, wanted - len(whom_ids)))
+
+        for whom_id in sorted(whom_ids):
+            yield (who_id, whom_id)
+
+
+def generate_messages(rng, user_ids, count, start, end, exponent):
+    """Yields the (author_id, text, pub_date) rows of messages spread evenly between the start and
+    end timestamps, written by authors whose activity follows a power law.
+    """
+    activity = list(user_ids)
+    rng.shuffle(activity)
+    cum_weights = power_law_weights(len(activity), exponent)
+    step = (end - start) / max(1, count)
+
+    for index in range(count):
+        yield (rng.choices(activity, cum_weights=cum_weights)[0],
+               ' '.join(rng.choices(SEED_WORDS, k=rng.randint(3, 20))),
+               start + int((index + rng.random()) * step))
+
+
+def seed_db(users, average_follows, messages, days, seed, exponent, end):
+    """Loads a synthetic social graph after the existing users, deterministic for a given seed.
+    Returns the number of users, follows and messages loaded.
+    """
+    rng = random.Random(seed)
+    first_id = (query_db('select max(user_id) from user', one=True)[0] or 0) + 1
+    user_ids = range(first_id, first_id + users)
+    the_db = get_db()
+
+    loaded_users = BulkLoader(the_db, 'user', ('user_id', 'username', 'email', 'pw_hash', 'avatar_hash')).load(
+        generate_users(user_ids, PASSWORD_HASHER.hash(SEED_PASSWORD)))
+    loaded_follows = BulkLoader(the_db, 'follower', ('who_id', 'whom_id')).load(
+        generate_follows(rng, user_ids, average_follows, exponent))
+    loaded_messages = BulkLoader(the_db, 'message', ('author_id', 'text', 'pub_date')).load(
+        generate_messages(rng, user_ids, messages, end - days * 24 * 3600, end, exponent))
+
+    # The bulk loads do not maintain the counters, nor the versions of the home timelines
+    reconcile_counters()
+    with the_db.begin():
+        exec_db('update user set home_timeline_version = home_timeline_version + 1')
+    if app.config['HOME_TIMELINE_FANOUT']:
+        rebuild_home_timelines()
+    invalidate_all_caches()
+
+    return loaded_users, loaded_follows, loaded_messages
+
+
+def load_identity(user_id):
+    """Returns the display fields of a user, without the password hash."""
+    user = query_db(IDENTITY_QUERY, {'userid': user_id}, one=True)
+    return dict(user) if user is not None else None
+
+
+def get_identity(user_id):
+    """Returns the cached display fields of a user, loading them on a miss."""
+    identity = IDENTITY_CACHE.get(user_id)
+    if identity is None:
+        identity = load_identity(user_id)
+        if identity is not None:
+            IDENTITY_CACHE.put(user_id, identity)
+    return identity
+
+
+def invalidate_identity(user_id=None):
+    """Drops the cached display fields of a user, or of all users, after they change."""
+    IDENTITY_CACHE.invalidate(user_id)
+
+
+def home_timeline_sources(user_id):
+    """Returns the TimelineSources of a user's home timeline, with the configured strategy."""
+    if app.config['HOME_TIMELINE_FANOUT']:
+        return [TimelineSource(MATERIALIZED_HOME_TIMELINE_QUERY, {'userid': user_id}, 'home_timeline'),
+                TimelineSource(FANOUT_ON_READ_HOME_TIMELINE_QUERY, {'whoid': user_id})]
+
+    return [TimelineSource(HOME_TIMELINE_QUERY, {'userid': user_id, 'whoid': user_id})]
+
+
+def query_home_timeline(user_id):
+    """Reads the requested page of a user's home timeline, with the configured strategy."""
+    return query_timeline(*home_timeline_sources(user_id))
+
+
+def query_public_timeline(version=None):
+    """Reads the requested page of the public timeline, through the cache. Pages cached
+    for a version, the newest message id, are never served for another one.
+    """
+    return PUBLIC_TIMELINE_CACHE.get_or_load(
+        (version, request.args.get(CURSOR_OLDER), request.args.get(CURSOR_NEWER)),
+        lambda: query_timeline(TimelineSource(PUBLIC_TIMELINE_QUERY, {})))
+
+
+def search_words(text_value):
+    """Returns the words of a text as the text index sees them: case folded, without diacritics."""
+    folded = unicodedata.normalize('NFD', text_value.lower())
+    return SEARCH_WORD_PATTERN.findall(''.join(char for char in folded if not unicodedata.combining(char)))
+
+
+def search_score(text_value, words):
+    """Returns how often the words occur per character of a text. Unlike bm25, it needs no count
+    of the messages holding each word, which would grow with the matches."""
+    occurrences = Counter(search_words(text_value))
+    return sum(occurrences[word] for word in words) / (len(text_value) + 20)
+
+
+def decode_search_cursor(cursor):
+    """Returns the message id of a search cursor, aborting on a malformed one."""
+    try:
+        return int(cursor)
+    except ValueError:
+        abort(400)
+
+
+def search_statement(text_query, args):
+    """Returns the statement and its args reading the page of the messages matching every
+    word of text_query selected by the cursor in the request args, or None without words."""
+    words = search_words(text_query)[:app.config['SEARCH_MAX_WORDS']]
+    if not words:
+        return None
+
+    db_type = app.config.get(CONFIG_DB_TYPE, LOCAL_DB_TYPE)
+    # Quoted, the words are never read as FTS5 operators, and the words have no boolean mode operators
+    match = ' '.join(('"%s"' if db_type == DB_TYPE_SQLITE else '+%s') % word for word in words)
+    statement_args = dict(query=match, limit=PER_PAGE + 1)
+
+    condition = ''
+    if args.get(CURSOR_OLDER):
+        condition = SEARCH_CURSOR_CONDITIONS[db_type]
+        statement_args['cursor_message_id'] = decode_search_cursor(args[CURSOR_OLDER])
+
+    return SEARCH_QUERIES[db_type].format(cursor=condition), statement_args
+
+
+def search_page(messages, text_query):
+    """Returns the page made of the PER_PAGE newest of the PER_PAGE + 1 matches read, the best
+    ranked first, with the cursor to the older matches."""
+    older = str(messages[PER_PAGE - 1]['message_id']) if len(messages) > PER_PAGE else None
+    words = search_words(text_query)
+    ranked = [dict(message, score=search_score(message['text'], words)) for message in messages[:PER_PAGE]]
+    ranked.sort(key=lambda message: (message['score'], message['message_id']), reverse=True)
+    return TimelinePage(ranked, older, None)
+
+
+def query_search(text_query):
+    """Reads the page of the newest messages matching every word of text_query selected by
+    the request's cursor, the best ranked first.
+    """
+    statement = search_statement(text_query, request.args)
+    if statement is None:
+        return TimelinePage([], None, None)
+
+    # One extra row tells whether there is another page
+    return search_page(query_db(*statement), text_query)
+
+
+def rebuild_search_index():
+    """Indexes every message for the full-text search."""
+    with get_db().begin():
+        for statement in SEARCH_REBUILD_STATEMENTS[app.config.get(CONFIG_DB_TYPE, LOCAL_DB_TYPE)]:
+            execute_db(get_db(), statement)
+
+
+def export_ndjson(what, user_id):
+    """Yields the rows of a user's export as NDJSON, EXPORT_CHUNK_SIZE rows at a time.
+    The rows are streamed from a server-side cursor on a connection of their own, so
+    the memory used does not depend on the size of the export.
+    """
+    _, the_db = READ_REPLICAS.connect() if READ_REPLICAS.replicas else (None, None)
+    the_db = the_db or POOL_TELEMETRY.connect()
+    try:
+        result = the_db.execution_options(stream_results=True).execute(
+            text(EXPORT_QUERIES[what]), userid=user_id)
+        while True:
+            rows = result.fetchmany(app.config['EXPORT_CHUNK_SIZE'])
+            if not rows:
+                break
+            yield ''.join(json.dumps(dict(row)) + '\n' for row in rows)
+    finally:
+        the_db.close()
+
+
+@app.cli.command('export')
+@click.argument('username')
+@click.option('--what', type=click.Choice(sorted(EXPORT_QUERIES)), default='messages',
+              help='What to export.')
+@click.option('--output', type=click.File('w'), default='-', help='The NDJSON file, stdout by default.')
+def export_command(username, what, output):
+    """Streams a user's messages or follower graph as NDJSON."""
+    user_id = get_user_id(username)
+    if user_id is None:
+        raise click.ClickException('Unknown user %s' % username)
+    for chunk in export_ndjson(what, user_id):
+        output.write(chunk)
 
 
 def get_user_id(username):
     """Convenience method to look up the id for a username."""
-    value = query_db('select user_id from user where username = :username',
-                     {'username': username}, one=True)
+    value = query_db(USER_ID_QUERY, {'username': username}, one=True)
     return value[0] if value else None  #pylint: disable=unsubscriptable-object
 
 
@@ -247,19 +1311,65 @@ def format_datetime(timestamp):
     return datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d @ %H:%M')
 
 
+@lru_cache(maxsize=AVATAR_HASH_CACHE_SIZE)
+def avatar_hash(email):
+    """Return the gravatar hash of the given email address."""
+    return md5(email.strip().lower().encode('utf-8')).hexdigest()
+
+
 def gravatar_url(email, size=80):
     """Return the gravatar image for the given email address."""
-    return 'https://www.gravatar.com/avatar/%s?d=identicon&s=%d' % \
-        (md5(email.strip().lower().encode('utf-8')).hexdigest(), size)
+    return GRAVATAR_URL % (avatar_hash(email), size)
+
+
+def avatar_url(user, size=80):
+    """Return the gravatar image for a user row, from its stored avatar hash."""
+    return GRAVATAR_URL % (user['avatar_hash'] or avatar_hash(user['email']), size)
+
+
+def message_list_key(view, owner, page, args):
+    """Returns the key of the rendered message list of a page: the timeline, whose it is, the
+    cursor in the args and the ids of the page's messages, the newest first. Messages are never
+    edited, so the same ids always render the same list."""
+    return (view, owner, args.get(CURSOR_OLDER), args.get(CURSOR_NEWER),
+            tuple(message['message_id'] for message in page.messages))
+
+
+def render_message_list(view, owner, page, **context):
+    """Returns the HTML of the messages of a timeline page and of its pagination, rendered
+    once for all the viewers of the same page."""
+    return MESSAGE_LIST_CACHE.get_or_render(
+        message_list_key(view, owner, page, request.args),
+        lambda: Markup(render_template('message_list.html', messages=page.messages, page=page, **context)))
+
+
+def backfill_avatar_hashes(batch_size=1000):
+    """Stores the avatar hash of the users registered before it was computed at registration."""
+    backfilled = 0
+    while True:
+        users = query_db('select user_id, email from user where avatar_hash is null limit :limit',
+                         {'limit': batch_size})
+        if not users:
+            break
+        with get_db().begin():
+            get_db().execute(text('update user set avatar_hash = :avatarhash where user_id = :userid'), [
+                dict(userid=user['user_id'], avatarhash=avatar_hash(user['email'])) for user in users])
+        backfilled += len(users)
+
+    # The cached timelines hold the rows without the hash
+    invalidate_all_caches()
+    return backfilled
 
 
 @app.before_request
 def before_request():
     """ Do before-request operations """
+    g.request_start = time.perf_counter() #pylint: disable=assigning-non-slot
+    # The first request of a worker starts its readiness checks, unless gunicorn already did
+    READINESS.start()
     g.user = None #pylint: disable=assigning-non-slot
     if 'user_id' in session:
-        g.user = query_db('select * from user where user_id = :userid', #pylint: disable=assigning-non-slot
-                          {'userid': session['user_id']}, one=True)
+        g.user = get_identity(session['user_id']) #pylint: disable=assigning-non-slot
 
 
 # https://stackoverflow.com/questions/25860304/how-do-i-set-response-headers-in-flask/59676071#59676071
@@ -271,6 +1381,31 @@ def add_header(response):
     return response
 
 
+@app.after_request
+def record_request_metrics(response):
+    """Counts the request and records its duration, by endpoint to keep the number of series bounded"""
+    endpoint = request.endpoint or 'unmatched'
+    METRICS.inc('minitwit_http_requests_total',
+                {'endpoint': endpoint, 'method': request.method, 'status': response.status_code})
+    if 'request_start' in g:
+        METRICS.observe('minitwit_http_request_duration_seconds', time.perf_counter() - g.request_start,
+                        {'endpoint': endpoint})
+    return response
+
+
+@before_render_template.connect_via(app)
+def start_template_timer(_sender, **_extra):
+    """Notes when a template starts rendering, templates rendering templates are stacked"""
+    g.setdefault('template_starts', []).append(time.perf_counter())
+
+
+@template_rendered.connect_via(app)
+def record_template_metrics(_sender, template, **_extra):
+    """Records how long the template took to render"""
+    METRICS.observe('minitwit_template_render_duration_seconds', time.perf_counter() - g.template_starts.pop(),
+                    {'template': template.name})
+
+
 @app.route('/')
 def timeline():
     """Shows a users timeline or if no user is logged in it will
@@ -279,49 +1414,45 @@ def timeline():
     """
     if not g.user:
         return redirect(url_for('public_timeline'))
-    return render_template('timeline.html', messages=query_db(
-        '''
-        select message.*, user.* from message, user
-        where message.author_id = user.user_id and (
-            user.user_id = :userid or
-            user.user_id in (select whom_id from follower
-                                    where who_id = :whoid))
-        order by message.pub_date desc limit :limit''',
-        {'userid': session['user_id'], 'whoid': session['user_id'], 'limit': PER_PAGE}),
-        secrets_used=SECRETS_USED)
+    page = query_home_timeline(session['user_id'])
+    return render_template('timeline.html', message_list=render_message_list('home', session['user_id'], page),
+                           secrets_used=SECRETS_USED)
 
 
 @app.route('/public')
 def public_timeline():
     """Displays the latest messages of all users."""
-    return render_template('timeline.html', messages=query_db('''
-        select message.*, user.* from message, user
-        where message.author_id = user.user_id
-        order by message.pub_date desc limit :limit''', {'limit': PER_PAGE}),
-        secrets_used=SECRETS_USED)
+    page = query_public_timeline()
+    return render_template('timeline.html', message_list=render_message_list('public', None, page),
+                           secrets_used=SECRETS_USED)
+
+
+@app.route('/search')
+def search():
+    """Displays the messages matching the searched words, the best ranked first."""
+    query = request.args.get('q', '')
+    page = query_search(query)
+    # Not cached, the searched words are in the pagination links
+    message_list = Markup(render_template('message_list.html', messages=page.messages, page=page, query=query))
+    return render_template('timeline.html', message_list=message_list, query=query, secrets_used=SECRETS_USED)
 
 
 @app.route('/<username>')
 def user_timeline(username):
     """Display's a users tweets."""
-    profile_user = query_db('select * from user where username = :username',
-                            {'username': username}, one=True)
+    profile_user = query_db(USER_BY_USERNAME_QUERY, {'username': username}, one=True)
     if profile_user is None:
         abort(404)
     followed = False
     if g.user:
         followed = query_db(
-            '''select 1 from follower where
-            follower.who_id = :whoid and follower.whom_id = :whomid''',
+            FOLLOWED_QUERY,
             {'whoid': session['user_id'], 'whomid': profile_user['user_id']},  #pylint: disable=unsubscriptable-object
             one=True) is not None
+    page = query_timeline(TimelineSource(USER_TIMELINE_QUERY, {'userid': profile_user['user_id']}))  #pylint: disable=unsubscriptable-object
     return render_template(
         'timeline.html',
-        messages=query_db(
-            '''select message.*, user.* from message, user where
-            user.user_id = message.author_id and user.user_id = :userid
-            order by message.pub_date desc limit :limit''',
-            {'userid': profile_user['user_id'], 'limit': PER_PAGE}),  #pylint: disable=unsubscriptable-object
+        message_list=render_message_list('user', profile_user['user_id'], page),  #pylint: disable=unsubscriptable-object
         followed=followed,
         profile_user=profile_user,
         secrets_used=SECRETS_USED)
@@ -336,9 +1467,18 @@ def follow_user(username):
     if whom_id is None:
         abort(404)
 
-    exec_db(
-        'insert into follower (who_id, whom_id) values (:whoid, :whomid)',
-        dict(whoid=session['user_id'], whomid=whom_id))
+    try:
+        with get_db().begin():
+            exec_db(
+                'insert into follower (who_id, whom_id) values (:whoid, :whomid)',
+                dict(whoid=session['user_id'], whomid=whom_id))
+            count_follow(session['user_id'], whom_id, 1)
+            bump_home_timeline_version(session['user_id'])
+            if app.config['HOME_TIMELINE_FANOUT']:
+                backfill_home_timeline(session['user_id'], whom_id)
+    except db.exc.IntegrityError:
+        # Already following, (who_id, whom_id) is the primary key
+        pass
     # db.commit()
     flash('You are now following "%s"' % username)
     return redirect(url_for('user_timeline', username=username))
@@ -353,32 +1493,232 @@ def unfollow_user(username):
     if whom_id is None:
         abort(404)
 
-    exec_db(
-        'delete from follower where who_id=:whoid and whom_id=:whomid',
-        dict(whoid=session['user_id'], whomid=whom_id))
+    with get_db().begin():
+        unfollowed = exec_db(
+            'delete from follower where who_id=:whoid and whom_id=:whomid',
+            dict(whoid=session['user_id'], whomid=whom_id)).rowcount
+        if unfollowed:
+            count_follow(session['user_id'], whom_id, -1)
+        bump_home_timeline_version(session['user_id'])
+        if app.config['HOME_TIMELINE_FANOUT']:
+            prune_home_timeline(session['user_id'], whom_id)
 
     flash('You are no longer following "%s"' % username)
     return redirect(url_for('user_timeline', username=username))
 
 
+def follow_list(username, which):
+    """Displays a page of the followers or of the followed users of a user."""
+    profile_user = query_db(USER_BY_USERNAME_QUERY, {'username': username}, one=True)
+    if profile_user is None:
+        abort(404)
+    try:
+        after = int(request.args.get(CURSOR_NEWER, 0))
+    except ValueError:
+        abort(400)
+
+    # One extra row tells whether there is another page
+    users = query_db(FOLLOW_LIST_QUERIES[which], dict(
+        userid=profile_user['user_id'], after=after, limit=PER_PAGE + 1))  #pylint: disable=unsubscriptable-object
+    return render_template('follow_list.html', users=users[:PER_PAGE], profile_user=profile_user,
+                           next_after=users[PER_PAGE - 1]['user_id'] if len(users) > PER_PAGE else None,
+                           secrets_used=SECRETS_USED)
+
+
+@app.route('/<username>/followers')
+def followers(username):
+    """Displays the followers of a user."""
+    return follow_list(username, 'followers')
+
+
+@app.route('/<username>/following')
+def following(username):
+    """Displays the users a user follows."""
+    return follow_list(username, 'following')
+
+
 @app.route('/add_message', methods=['POST'])
 def add_message():
     """Registers a new message for the user."""
     if 'user_id' not in session:
         abort(401)
     if request.form['text']:
-        exec_db(
-            '''insert into message (author_id, text, pub_date)
-            values (:authorid, :text, :pubdate)''',
-            dict(
-                authorid=session['user_id'],
-                text=request.form['text'],
-                pubdate=int(time.time())))
+        insert_messages(session['user_id'], [request.form['text']])
 
         flash('Your message was recorded')
     return redirect(url_for('timeline'))
 
 
+def api_response(payload, status=200):
+    """Returns a JSON response for the API routes."""
+    return json.dumps(payload), status, {'content-type': 'application/json'}
+
+
+def get_api_user_id():
+    """Returns the id of the user calling the API, authenticated by the session or by
+    HTTP basic auth with the minitwit username and password, or None.
+    """
+    if 'user_id' in session:
+        return session['user_id']
+
+    credentials = request.authorization
+    if credentials is None or not credentials.username or not credentials.password:
+        return None
+
+    key = (credentials.username, hmac.new(API_CREDENTIALS_KEY, credentials.password.encode('utf-8'),
+                                          hashlib.sha256).digest())
+    user_id = API_CREDENTIALS_CACHE.get(key)
+    if user_id is not None:
+        return user_id
+
+    user = query_db('select user_id, pw_hash from user where username = :username',
+                    {'username': credentials.username}, one=True)
+    if user is None or not PASSWORD_HASHER.check(user['pw_hash'], credentials.password):  #pylint: disable=unsubscriptable-object
+        return None
+
+    # Only the right passwords are remembered
+    API_CREDENTIALS_CACHE.put(key, user['user_id'])  #pylint: disable=unsubscriptable-object
+    return user['user_id']  #pylint: disable=unsubscriptable-object
+
+
+@app.route('/api/messages', methods=['POST'])
+def api_add_messages():
+    """Records a batch of messages for the user, posted as
+    {"messages": [{"text": "..."}, ...]}, and returns their ids.
+    """
+    if request.content_length is None:
+        return api_response({'error': 'The Content-Length header is required'}, 411)
+    if request.content_length > app.config['API_MAX_BODY_BYTES']:
+        return api_response({'error': 'The body is larger than %d bytes' % app.config['API_MAX_BODY_BYTES']}, 413)
+
+    author_id = get_api_user_id()
+    if author_id is None:
+        return api_response({'error': 'Authentication required'}, 401)
+
+    payload = request.get_json(silent=True)
+    messages = payload.get('messages') if isinstance(payload, dict) else None
+    if not isinstance(messages, list) or not messages:
+        return api_response({'error': 'Expected {"messages": [{"text": "..."}, ...]}'}, 400)
+    if len(messages) > app.config['API_MAX_BATCH_MESSAGES']:
+        return api_response(
+            {'error': 'At most %d messages per batch' % app.config['API_MAX_BATCH_MESSAGES']}, 413)
+
+    invalid = [index for index, message in enumerate(messages)
+               if not isinstance(message, dict) or not isinstance(message.get('text'), str) or
+               not message['text'].strip()]
+    if invalid:
+        return api_response({'error': 'Every message needs a non-empty text', 'invalid': invalid}, 400)
+
+    message_ids = insert_messages(author_id, [message['text'] for message in messages])
+    return api_response({'ids': message_ids}, 201)
+
+
+def timeline_etag(*versions):
+    """Returns a strong ETag for the requested timeline page, from the cheap version
+    lookups that change whenever the page may change, and the page cursor.
+    """
+    cursor = (request.args.get(CURSOR_OLDER), request.args.get(CURSOR_NEWER))
+    return md5(repr((versions, cursor)).encode('utf-8')).hexdigest()
+
+
+def message_json(message):
+    """Returns the fields of a message served by the API."""
+    return {
+        'message_id': message['message_id'],
+        'author_id': message['author_id'],
+        'username': message['username'],
+        'avatar_url': avatar_url(message),
+        'text': message['text'],
+        'pub_date': message['pub_date'],
+    }
+
+
+def timeline_json(etag, load_page):
+    """Returns the JSON of the page loaded by load_page(), or a 304 without loading
+    it when the client already has the page with that ETag.
+    """
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        page = load_page()
+        response = app.response_class(json.dumps({
+            'messages': [message_json(message) for message in page.messages],
+            'older': page.older,
+            'newer': page.newer,
+        }), mimetype='application/json')
+
+    response.set_etag(etag)
+    # Clients may keep the page, but must revalidate it on every poll
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@app.route('/api/timeline')
+def api_timeline():
+    """The JSON of the user's home timeline."""
+    user_id = get_api_user_id()
+    if user_id is None:
+        return api_response({'error': 'Authentication required'}, 401)
+
+    # Only a new message by the user or a followed author, or a follow, changes the ETag
+    versions = query_db(HOME_TIMELINE_VERSION_QUERY, {'userid': user_id}, one=True)
+
+    return timeline_json(
+        timeline_etag('home', user_id, tuple(versions)),
+        lambda: query_home_timeline(user_id))
+
+
+@app.route('/api/public')
+def api_public_timeline():
+    """The JSON of the public timeline."""
+    newest_id = query_db(PUBLIC_TIMELINE_VERSION_QUERY, one=True)[0]
+
+    # The page is cached for that version, so the body always matches the ETag
+    return timeline_json(
+        timeline_etag('public', newest_id),
+        lambda: query_public_timeline(newest_id))
+
+
+@app.route('/api/search')
+def api_search():
+    """The JSON of the messages matching the searched words, the best ranked first."""
+    page = query_search(request.args.get('q', ''))
+    return api_response({
+        'messages': [dict(message_json(message), score=message['score']) for message in page.messages],
+        'older': page.older,
+    })
+
+
+@app.route('/api/users/<username>/export/<what>')
+def api_export(username, what):
+    """Streams the user's own messages, followers or following as NDJSON."""
+    if what not in EXPORT_QUERIES:
+        return api_response({'error': 'Export one of %s' % ', '.join(sorted(EXPORT_QUERIES))}, 404)
+
+    user_id = get_user_id(username)
+    if user_id is None:
+        return api_response({'error': 'Unknown user'}, 404)
+    if get_api_user_id() != user_id:
+        return api_response({'error': 'Only the user can export their account'}, 403)
+
+    return app.response_class(stream_with_context(export_ndjson(what, user_id)),
+                              mimetype='application/x-ndjson')
+
+
+@app.route('/api/users/<username>')
+def api_user_timeline(username):
+    """The JSON of a user's messages."""
+    user_id = get_user_id(username)
+    if user_id is None:
+        return api_response({'error': 'Unknown user'}, 404)
+
+    newest = query_db(USER_TIMELINE_VERSION_QUERY, {'userid': user_id}, one=True)
+
+    return timeline_json(
+        timeline_etag('user', user_id, newest[0] if newest else None),
+        lambda: query_timeline(TimelineSource(USER_TIMELINE_QUERY, {'userid': user_id})))
+
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     """Logs the user in."""
@@ -386,16 +1726,21 @@ def login():
         return redirect(url_for('timeline'))
     error = None
     if request.method == 'POST':
-        user = query_db('''select * from user where
-            username = :username''', {'username': request.form['username']}, one=True)
+        user = query_db(USER_BY_USERNAME_QUERY, {'username': request.form['username']}, one=True)
         if user is None:
             error = 'Invalid username'
-        elif not check_password_hash(user['pw_hash'],  #pylint: disable=unsubscriptable-object
-                                     request.form['password']):
+        elif not PASSWORD_HASHER.check(user['pw_hash'],  #pylint: disable=unsubscriptable-object
+                                       request.form['password']):
             error = 'Invalid password'
         else:
+            if PASSWORD_HASHER.needs_rehash(user['pw_hash']):  #pylint: disable=unsubscriptable-object
+                exec_db(UPDATE_PW_HASH_QUERY, dict(
+                    pwhash=PASSWORD_HASHER.hash(request.form['password']),
+                    userid=user['user_id']))  #pylint: disable=unsubscriptable-object
             flash('You were logged in')
             session['user_id'] = user['user_id']  #pylint: disable=unsubscriptable-object
+            # The session starts from what the database has now
+            invalidate_identity(user['user_id'])  #pylint: disable=unsubscriptable-object
             return redirect(url_for('timeline'))
     return render_template('login.html', error=error)
 
@@ -420,12 +1765,12 @@ def register():
             error = 'The username is already taken'
         else:
             exec_db(
-                '''insert into user (
-                username, email, pw_hash) values (:username, :email, :pwhash)''',
+                INSERT_USER_QUERY,
                 dict(
                     username=request.form['username'],
                     email=request.form['email'],
-                    pwhash=generate_password_hash(request.form['password'])))
+                    pwhash=PASSWORD_HASHER.hash(request.form['password']),
+                    avatarhash=avatar_hash(request.form['email'])))
 
             flash('You were successfully registered and can login now')
             return redirect(url_for('login'))
@@ -444,15 +1789,24 @@ def logout():
 #pylint: disable=no-member
 app.jinja_env.filters['datetimeformat'] = format_datetime
 app.jinja_env.filters['gravatar'] = gravatar_url
+app.jinja_env.filters['avatar'] = avatar_url
 #pylint: enable=no-member
 
 # Model: https://gist.github.com/rtzll/8f0f7668c4ca9813e9380b45b932e7c2
 # https://stackoverflow.com/questions/11994325/how-to-divide-flask-app-into-multiple-py-files
 app.register_blueprint(healthcheck_api)
 app.register_blueprint(admin_api)
+app.register_blueprint(metrics_api)
 
 # So we know the available endpoints to be able to call
 ConfigService.log_available_endpoints(app)
 
+app.config['STARTUP']['cold_start_seconds'] = round(time.perf_counter() - IMPORT_STARTED_AT, 3)
+app.logger.info("Ready to serve %.3f s after the import, startup=%s",
+                app.config['STARTUP']['cold_start_seconds'], app.config['STARTUP'])
+METRICS.gauge('minitwit_startup_duration_seconds', 'Seconds from the import of the app to ready to serve.',
+              lambda: [({'mode': app.config['STARTUP']['mode'], 'source': app.config['STARTUP']['source']},
+                        app.config['STARTUP']['cold_start_seconds'])])
+
 # flask run --host=0.0.0.0 --with-threads --no-debugger --no-reload
 # server = app.run(host='0.0.0.0', threaded=True, debug=False, use_reloader=False)
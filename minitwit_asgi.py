@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+    MiniTwit ASGI
+    ~~~~~~~~~~~~~
+
+    Serves MiniTwit from an event loop, so that the requests waiting on the database
+    hold a coroutine instead of a thread. The pages and the sign in and up forms are
+    served by async views reading through async database drivers and rendering the
+    same templates; every other route, the writes, the API and the admin routes, is
+    served by the Flask app on a thread pool.
+
+    uvicorn minitwit_asgi:app --host 0.0.0.0 --port 5000
+"""
+import contextvars
+import io
+import time
+import types
+
+from a2wsgi import WSGIMiddleware
+from a2wsgi.wsgi import build_environ
+from markupsafe import Markup
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.sql import text
+from werkzeug.exceptions import HTTPException, InternalServerError, NotFound
+from werkzeug.routing import RequestRedirect
+from werkzeug.utils import redirect
+from werkzeug.wrappers import Request, Response
+
+import minitwit
+from minitwit import app as flask_app
+from viasat.platform.core.http_response_decorator import HttpResponseDecorator
+from viasat.platform.db.query_metrics import QueryMetrics
+from viasat.platform.observability.metrics import METRICS
+
+# The async driver of each database type
+ASYNC_DRIVERS = {
+    minitwit.DB_TYPE_SQLITE: 'sqlite+aiosqlite',
+    minitwit.DB_TYPE_MYSQL: 'mysql+aiomysql',
+}
+
+# Threads serving the routes without an async view
+CONFIG_ASGI_WSGI_THREADS = 'ASGI_WSGI_THREADS'
+
+# Bytes of a form body read by the async views
+MAX_FORM_BYTES = 64 * 1024
+
+# The route of the request served by the current coroutine, for the slow query log
+CURRENT_ROUTE = contextvars.ContextVar('route', default=None)
+
+
+def make_async_engine():
+    """Creates the async engine of the primary, with the pool settings of the sync one"""
+    db_type = flask_app.config.get(minitwit.CONFIG_DB_TYPE, minitwit.LOCAL_DB_TYPE)
+    options = minitwit.get_pool_options(db_type)
+    options['poolclass'] = AsyncAdaptedQueuePool
+    # aiosqlite runs every connection on its own thread
+    options.pop('connect_args', None)
+    return create_async_engine(minitwit.DB_ENGINE.url.set(drivername=ASYNC_DRIVERS[db_type]), **options)
+
+
+ASYNC_ENGINE = make_async_engine()
+
+QueryMetrics('async', ASYNC_ENGINE.sync_engine)
+# The plans of the slow statements are read on the sync engine, from the log's own thread
+minitwit.SLOW_QUERY_LOG.watch(ASYNC_ENGINE.sync_engine, explain_engine=minitwit.DB_ENGINE)
+_get_flask_route = minitwit.SLOW_QUERY_LOG.get_route
+minitwit.SLOW_QUERY_LOG.get_route = lambda: CURRENT_ROUTE.get() or _get_flask_route()
+
+# Shares the loader and the filters of the Flask templates, compiled for render_async()
+TEMPLATES = flask_app.jinja_env.overlay(enable_async=True)
+
+FLASK_APP = WSGIMiddleware(flask_app.wsgi_app, workers=flask_app.config.get(CONFIG_ASGI_WSGI_THREADS, 10))
+
+
+async def fetch_all(conn, query, args=None):
+    """Queries the connection and returns a list of dictionaries."""
+    result = await conn.execute(text(query), args or {})
+    return [dict(row._mapping) for row in result]  #pylint: disable=protected-access
+
+
+async def fetch_one(conn, query, args=None):
+    """Queries the connection and returns the first row as a dictionary, or None."""
+    rows = await fetch_all(conn, query, args)
+    return rows[0] if rows else None
+
+
+class AsyncRequest:
+    """The state of a request served by an async view, standing in for Flask's request, session and g"""
+
+    def __init__(self, request, adapter, endpoint, view_args):
+        self.request = request
+        self.adapter = adapter
+        # The templates read them from the request, like from Flask's
+        request.endpoint = endpoint
+        request.view_args = view_args
+        self.session = flask_app.session_interface.open_session(flask_app, request)
+        self.g = types.SimpleNamespace(user=None)
+        self._flashes = None
+
+
+    def url_for(self, endpoint, **values):
+        return self.adapter.build(endpoint, values)
+
+
+    def flash(self, message, category='message'):
+        self.session['_flashes'] = self.session.get('_flashes', []) + [(category, message)]
+
+
+    def get_flashed_messages(self):
+        # Read once per request, and dropped from the session like Flask does
+        if self._flashes is None:
+            self._flashes = self.session.pop('_flashes', [])
+        return [message for _, message in self._flashes]
+
+
+    def redirect(self, endpoint, **values):
+        return redirect(self.url_for(endpoint, **values))
+
+
+    async def render_template(self, template_name, **context):
+        start = time.perf_counter()
+        html = await TEMPLATES.get_template(template_name).render_async(
+            url_for=self.url_for, get_flashed_messages=self.get_flashed_messages, request=self.request,
+            session=self.session, g=self.g, **context)
+        METRICS.observe('minitwit_template_render_duration_seconds', time.perf_counter() - start,
+                        {'template': template_name})
+        return html
+
+
+    async def render(self, template_name, **context):
+        return Response(await self.render_template(template_name, **context), mimetype='text/html')
+
+
+    async def render_message_list(self, view, owner, page, **context):
+        """Returns the HTML of the messages of a timeline page, through the cache of minitwit.render_message_list()"""
+        async def render():
+            return Markup(await self.render_template('message_list.html', messages=page.messages, page=page,
+                                                     **context))
+
+        return await minitwit.MESSAGE_LIST_CACHE.get_or_render_async(
+            minitwit.message_list_key(view, owner, page, self.request.args), render)
+
+
+    async def load_user(self, conn):
+        """Loads the display fields of the signed in user, through the identity cache."""
+        if 'user_id' not in self.session:
+            return
+
+        async def load_identity():
+            return await fetch_one(conn, minitwit.IDENTITY_QUERY, {'userid': self.session['user_id']})
+
+        identity = await minitwit.IDENTITY_CACHE.get_or_load_async(self.session['user_id'], load_identity)
+        if identity is None:
+            # Not cached, so that a user created later is found
+            minitwit.invalidate_identity(self.session['user_id'])
+        self.g.user = identity
+
+
+async def read_timeline(conn, args, *sources):
+    """Reads the page of the timeline selected by the cursor in the args, like minitwit.query_timeline()"""
+    direction, cursor_args = minitwit.timeline_cursor(args)
+
+    # One extra row tells whether there is another page in the same direction
+    messages = []
+    for source in sources:
+        messages += await fetch_all(conn, minitwit.timeline_query(source.query, direction, source.key),
+                                    dict(source.args, limit=minitwit.PER_PAGE + 1, **cursor_args))
+
+    return minitwit.timeline_page(messages, direction, len(sources) > 1)
+
+
+async def timeline(state, conn):
+    """Shows the home timeline of the user, or redirects to the public timeline."""
+    if not state.g.user:
+        return state.redirect('public_timeline')
+    page = await read_timeline(conn, state.request.args, *minitwit.home_timeline_sources(state.session['user_id']))
+    return await state.render('timeline.html',
+                              message_list=await state.render_message_list('home', state.session['user_id'], page),
+                              secrets_used=minitwit.SECRETS_USED)
+
+
+async def public_timeline(state, conn):
+    """Displays the latest messages of all users, through the cache of minitwit.query_public_timeline()."""
+    args = state.request.args
+    page = await minitwit.PUBLIC_TIMELINE_CACHE.get_or_load_async(
+        (None, args.get(minitwit.CURSOR_OLDER), args.get(minitwit.CURSOR_NEWER)),
+        lambda: read_timeline(conn, args, minitwit.TimelineSource(minitwit.PUBLIC_TIMELINE_QUERY, {})))
+    return await state.render('timeline.html', message_list=await state.render_message_list('public', None, page),
+                              secrets_used=minitwit.SECRETS_USED)
+
+
+async def search(state, conn):
+    """Displays the messages matching the searched words, the best ranked first."""
+    query = state.request.args.get('q', '')
+    statement = minitwit.search_statement(query, state.request.args)
+    page = minitwit.search_page(await fetch_all(conn, *statement), query) if statement is not None \
+        else minitwit.TimelinePage([], None, None)
+    # Not cached, the searched words are in the pagination links
+    message_list = Markup(await state.render_template('message_list.html', messages=page.messages, page=page,
+                                                      query=query))
+    return await state.render('timeline.html', message_list=message_list, query=query,
+                              secrets_used=minitwit.SECRETS_USED)
+
+
+async def user_timeline(state, conn, username):
+    """Displays the messages of a user."""
+    profile_user = await fetch_one(conn, minitwit.USER_BY_USERNAME_QUERY, {'username': username})
+    if profile_user is None:
+        raise NotFound()
+    followed = False
+    if state.g.user:
+        followed = await fetch_one(conn, minitwit.FOLLOWED_QUERY, {
+            'whoid': state.session['user_id'], 'whomid': profile_user['user_id']}) is not None
+    page = await read_timeline(conn, state.request.args, minitwit.TimelineSource(
+        minitwit.USER_TIMELINE_QUERY, {'userid': profile_user['user_id']}))
+    return await state.render('timeline.html',
+                              message_list=await state.render_message_list('user', profile_user['user_id'], page),
+                              followed=followed, profile_user=profile_user, secrets_used=minitwit.SECRETS_USED)
+
+
+async def login(state, conn):
+    """Logs the user in, checking the password off the event loop."""
+    if state.g.user:
+        return state.redirect('timeline')
+    error = None
+    form = state.request.form
+    if state.request.method == 'POST':
+        user = await fetch_one(conn, minitwit.USER_BY_USERNAME_QUERY, {'username': form['username']})
+        if user is None:
+            error = 'Invalid username'
+        elif not await minitwit.PASSWORD_HASHER.check_async(user['pw_hash'], form['password']):
+            error = 'Invalid password'
+        else:
+            if minitwit.PASSWORD_HASHER.needs_rehash(user['pw_hash']):
+                await conn.execute(text(minitwit.UPDATE_PW_HASH_QUERY), dict(
+                    pwhash=await minitwit.PASSWORD_HASHER.hash_async(form['password']), userid=user['user_id']))
+                await conn.commit()
+            state.flash('You were logged in')
+            state.session['user_id'] = user['user_id']
+            # The session starts from what the database has now
+            minitwit.invalidate_identity(user['user_id'])
+            return state.redirect('timeline')
+    return await state.render('login.html', error=error)
+
+
+async def register(state, conn):
+    """Registers the user, hashing the password off the event loop."""
+    if state.g.user:
+        return state.redirect('timeline')
+    error = None
+    form = state.request.form
+    if state.request.method == 'POST':
+        if not form['username']:
+            error = 'You have to enter a username'
+        elif not form['email'] or '@' not in form['email']:
+            error = 'You have to enter a valid email address'
+        elif not form['password']:
+            error = 'You have to enter a password'
+        elif form['password'] != form['password2']:
+            error = 'The two passwords do not match'
+        elif await fetch_one(conn, minitwit.USER_ID_QUERY, {'username': form['username']}) is not None:
+            error = 'The username is already taken'
+        else:
+            await conn.execute(text(minitwit.INSERT_USER_QUERY), dict(
+                username=form['username'],
+                email=form['email'],
+                pwhash=await minitwit.PASSWORD_HASHER.hash_async(form['password']),
+                avatarhash=minitwit.avatar_hash(form['email'])))
+            await conn.commit()
+            state.flash('You were successfully registered and can login now')
+            return state.redirect('login')
+    return await state.render('register.html', error=error)
+
+
+# endpoint -> its async view, the other endpoints are served by the Flask app
+ASYNC_VIEWS = {
+    'timeline': timeline,
+    'public_timeline': public_timeline,
+    'search': search,
+    'user_timeline': user_timeline,
+    'login': login,
+    'register': register,
+}
+
+
+async def read_body(receive, max_bytes):
+    """:return: the body of the request, or None when it is larger than max_bytes"""
+    chunks, size, more_body = [], 0, True
+    while more_body:
+        message = await receive()
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > max_bytes:
+            return None
+        chunks.append(chunk)
+        more_body = message.get('more_body', False)
+    return b''.join(chunks)
+
+
+async def send_response(send, response):
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in response.headers.items()],
+    })
+    await send({'type': 'http.response.body', 'body': response.get_data()})
+
+
+async def serve_async_view(view, environ, adapter, endpoint, view_args):
+    """Runs the view with the request state, and finishes its response like the Flask app's after_request"""
+    state = AsyncRequest(Request(environ), adapter, endpoint, view_args)
+    try:
+        async with ASYNC_ENGINE.connect() as conn:
+            await state.load_user(conn)
+            response = await view(state, conn, **view_args)
+    except HTTPException as error:
+        response = error.get_response(environ)
+    except Exception:  #pylint: disable=broad-except
+        flask_app.logger.exception('Exception on %s [%s]', environ['PATH_INFO'], environ['REQUEST_METHOD'])
+        response = InternalServerError().get_response(environ)
+
+    flask_app.session_interface.save_session(flask_app, state.session, response)
+    HttpResponseDecorator.decorate_with_host_info(flask_app, response)
+    HttpResponseDecorator.decorate_with_app_info(flask_app, response)
+    return response
+
+
+async def application(scope, receive, send):
+    """The ASGI flask_app, serving the endpoints of ASYNC_VIEWS from the event loop and the others from Flask"""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                minitwit.READINESS.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await ASYNC_ENGINE.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] != 'http':
+        await FLASK_APP(scope, receive, send)
+        return
+
+    start = time.perf_counter()
+    environ = build_environ(scope, io.BytesIO())
+    adapter = flask_app.url_map.bind_to_environ(environ)
+    try:
+        endpoint, view_args = adapter.match()
+    except (HTTPException, RequestRedirect):
+        # Flask answers the unknown routes, the redirects and the wrong methods
+        endpoint = None
+
+    view = ASYNC_VIEWS.get(endpoint)
+    if view is None:
+        await FLASK_APP(scope, receive, send)
+        return
+
+    body = await read_body(receive, MAX_FORM_BYTES)
+    if body is None:
+        response = Response('Request Entity Too Large', 413)
+    else:
+        environ['wsgi.input'] = io.BytesIO(body)
+        environ['CONTENT_LENGTH'] = str(len(body))
+        route = CURRENT_ROUTE.set(endpoint)
+        try:
+            response = await serve_async_view(view, environ, adapter, endpoint, view_args)
+        finally:
+            CURRENT_ROUTE.reset(route)
+
+    METRICS.inc('minitwit_http_requests_total',
+                {'endpoint': endpoint, 'method': scope['method'], 'status': response.status_code})
+    METRICS.observe('minitwit_http_request_duration_seconds', time.perf_counter() - start, {'endpoint': endpoint})
+    await send_response(send, response)
+
+
+app = application  #pylint: disable=invalid-name
@@ -8,10 +8,32 @@
     :copyright: (c) 2015 by Armin Ronacher.
     :license: BSD, see LICENSE for more details.
 """
+import base64
+import flask
+import http.server
+import json
 import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
 import minitwit
 import tempfile
+from hashlib import md5
 import pytest
+import sqlalchemy
+
+from viasat.platform.cloud.host_service import HostService
+from viasat.platform.cloud.metadata_client import MetadataClient
+from viasat.platform.cloud.startup_service import StartupService
+from viasat.platform.core.fragment_cache import FragmentCache
+from viasat.platform.core.ttl_cache import TtlCache
+from viasat.platform.db.migration_service import MigrationService
+from viasat.platform.observability.metrics import MetricsRegistry
+from viasat.platform.observability.readiness import ReadinessProbe
 
 
 @pytest.fixture
@@ -70,6 +92,11 @@ def logout(client):
     return client.get('/logout', follow_redirects=True)
 
 
+def admin_headers():
+    """Basic auth headers for the admin endpoints"""
+    return {'Authorization': 'Basic ' + base64.b64encode(b'viasat:camper').decode()}
+
+
 def add_message(client, text):
     """Records a message"""
     rv = client.post('/add_message', data={'text': text},
@@ -157,3 +184,1104 @@ def test_timelines(client):
     rv = client.get('/')
     assert b'the message by foo' not in rv.data
     assert b'the message by bar' in rv.data
+
+
+def test_migrations(client):
+    """Make sure the schema is migrated and the hot queries use indexes"""
+    with minitwit.app.app_context():
+        the_db = minitwit.get_db()
+        assert minitwit.MigrationService.get_current_version(the_db) >= 1
+        assert minitwit.migrate_db() == []
+        assert minitwit.check_query_plans() == {}
+
+    # following twice must not fail on the follower primary key
+    register(client, 'bar', 'default')
+    register_and_login(client, 'foo', 'default')
+    client.get('/bar/follow')
+    rv = client.get('/bar/follow', follow_redirects=True)
+    assert b'You are now following &#34;bar&#34;' in rv.data
+
+
+
+def test_user_counters(client, monkeypatch):
+    """Make sure the counters on user follow the writes and are repaired by the reconciliation"""
+    def counters(username):
+        with minitwit.app.app_context():
+            return tuple(minitwit.query_db(
+                'select follower_count, following_count, message_count from user where username = :username',
+                {'username': username}, one=True))
+
+    for name in ('bar', 'baz', 'qux'):
+        register(client, name, 'default')
+    register_and_login(client, 'foo', 'default')
+    add_message(client, 'the message by foo')
+    for name in ('bar', 'baz', 'qux', 'bar'):
+        client.get('/%s/follow' % name)
+    client.get('/baz/unfollow')
+    client.get('/baz/unfollow')
+    assert counters('foo') == (0, 2, 1)
+    assert counters('bar') == (1, 0, 0)
+    assert counters('baz') == (0, 0, 0)
+    rv = client.get('/foo')
+    assert b'1 messages' in rv.data and b'2 following' in rv.data
+
+    with minitwit.app.app_context():
+        with minitwit.get_db().begin():
+            minitwit.exec_db("update user set follower_count = 7, message_count = 0 where username = 'qux'")
+        assert minitwit.reconcile_counters(batch_size=2) == 1
+        assert minitwit.reconcile_counters(batch_size=2) == 0
+    assert counters('qux') == (1, 0, 0)
+
+    # the lists are paged in user id order
+    monkeypatch.setattr(minitwit, 'PER_PAGE', 1)
+    rv = client.get('/foo/following')
+    assert b'>bar</a>' in rv.data and b'>qux</a>' not in rv.data
+    assert b'class="older"' in rv.data
+    with minitwit.app.app_context():
+        bar_id = minitwit.get_user_id('bar')
+    rv = client.get('/foo/following?after=%d' % bar_id)
+    assert b'>qux</a>' in rv.data and b'class="older"' not in rv.data
+    assert b'>foo</a>' in client.get('/bar/followers').data
+    assert client.get('/foo/following?after=x').status_code == 400
+    assert client.get('/nobody/followers').status_code == 404
+
+
+def test_split_statements():
+    """Make sure the migration scripts are split on the semicolons ending their statements only"""
+    script = """-- A trigger; with a comment
+        create trigger message_touch after insert on message begin
+          update user set follow_version = case when new.text = ';' then 1 else 2 end;
+          select 'end; begin';
+        end;
+        /* ; */ select 1;
+        select "a;b"
+    """
+    statements = MigrationService.split_statements(script)
+    assert len(statements) == 3
+    assert statements[0].startswith('-- A trigger;') and statements[0].endswith('end')
+    assert statements[2] == 'select "a;b"'
+
+
+def test_search(client, monkeypatch):
+    """Make sure the messages are found by every one of their words, ranked and paginated"""
+    register_and_login(client, 'foo', 'default')
+    add_message(client, 'apple pie')
+    add_message(client, 'apple apple apple')
+    add_message(client, 'banana bread')
+    for number in range(5):
+        add_message(client, 'Apples and an apple number %d' % number)
+
+    rv = client.get('/search?q=apple')
+    assert rv.data.index(b'apple apple apple') < rv.data.index(b'apple pie')
+    assert b'banana' not in rv.data
+    assert json.loads(client.get('/api/search?q=apple+banana').data)['messages'] == []
+    assert client.get('/api/search?q=' + '%22%20OR%20NEAR(').status_code == 200
+    assert json.loads(client.get('/api/search?q=').data)['messages'] == []
+
+    # The words are counted the way the index splits them
+    add_message(client, 'Café cafe snake_case')
+    found = json.loads(client.get('/api/search?q=CAFE').data)['messages']
+    assert len(found) == 1 and found[0]['score'] == 2 / (len('Café cafe snake_case') + 20)
+    assert len(json.loads(client.get('/api/search?q=case').data)['messages']) == 1
+
+    # Pages go from the newest matches to the oldest, each ranked, whatever is written meanwhile
+    monkeypatch.setattr(minitwit, 'PER_PAGE', 2)
+    seen, cursor = [], None
+    while True:
+        page = json.loads(client.get('/api/search', query_string=dict(q='APPLE', before=cursor or '')).data)
+        scores = [message['score'] for message in page['messages']]
+        assert scores == sorted(scores, reverse=True)
+        if seen:
+            assert max(message['message_id'] for message in page['messages']) < \
+                min(message['message_id'] for message in seen)
+        seen += page['messages']
+        cursor = page['older']
+        if cursor is None:
+            break
+        add_message(client, 'yet another apple')
+    assert len(seen) == 7 == len({message['message_id'] for message in seen})
+    assert b'q=apple' in client.get('/search?q=apple').data
+
+    # The index follows the deletes, and is rebuilt from the messages
+    with minitwit.app.app_context():
+        minitwit.execute_db(minitwit.get_db(), "delete from message where text = 'apple pie'")
+        minitwit.execute_db(minitwit.get_db(), "insert into message_search (message_search) values ('delete-all')")
+    assert json.loads(client.get('/api/search?q=apple').data)['messages'] == []
+    with minitwit.app.app_context():
+        minitwit.rebuild_search_index()
+    assert len(json.loads(client.get('/api/search?q=apple&before=').data)['messages']) == 2
+    assert client.get('/api/search?q=apple&before=nope').status_code == 400
+
+
+def test_timeline_pagination(client):
+    """Make sure older and newer pages are reachable through the cursors"""
+    register_and_login(client, 'foo', 'default')
+    with minitwit.app.app_context():
+        # all on the same second, so the message id has to break the ties
+        for i in range(minitwit.PER_PAGE + 5):
+            minitwit.exec_db(
+                'insert into message (author_id, text, pub_date) values (1, :text, 1000)',
+                {'text': 'message #%d#' % i})
+
+    rv = client.get('/public')
+    assert b'message #34#' in rv.data
+    assert b'message #5#' in rv.data
+    assert b'message #4#' not in rv.data
+    assert b'class="newer"' not in rv.data
+    older = re.search(r'class="older" href="([^"]+)"', rv.data.decode()).group(1)
+
+    # new messages do not shift the older pages
+    add_message(client, 'message #35#')
+    rv = client.get(older.replace('&amp;', '&'))
+    assert b'message #4#' in rv.data
+    assert b'message #0#' in rv.data
+    assert b'message #5#' not in rv.data
+    assert b'class="older"' not in rv.data
+    newer = re.search(r'class="newer" href="([^"]+)"', rv.data.decode()).group(1)
+
+    rv = client.get(newer.replace('&amp;', '&'))
+    assert b'message #5#' in rv.data
+    assert b'message #34#' in rv.data
+    assert b'message #35#' not in rv.data
+    assert b'class="newer"' in rv.data
+
+    assert client.get('/foo?before=garbage').status_code == 400
+
+
+@pytest.mark.parametrize('max_followers', [1000, 0])
+def test_fanout_timelines(client, monkeypatch, max_followers):
+    """Make sure the fan-out-on-write home timelines show the same messages"""
+    monkeypatch.setitem(minitwit.app.config, 'HOME_TIMELINE_FANOUT', True)
+    # With no followers allowed, every author falls back to fan-out-on-read
+    monkeypatch.setitem(minitwit.app.config, 'FANOUT_MAX_FOLLOWERS', max_followers)
+    register(client, 'foo', 'default')
+    register_and_login(client, 'bar', 'default')
+    client.get('/foo/follow')
+    logout(client)
+
+    login(client, 'foo', 'default')
+    add_message(client, 'the message by foo')
+    logout(client)
+
+    login(client, 'bar', 'default')
+    add_message(client, 'the message by bar')
+    rv = client.get('/')
+    assert b'the message by foo' in rv.data
+    assert b'the message by bar' in rv.data
+
+    client.get('/foo/unfollow')
+    rv = client.get('/')
+    assert b'the message by foo' not in rv.data
+    assert b'the message by bar' in rv.data
+
+    # following again backfills, and a rebuild gives the same result
+    client.get('/foo/follow')
+    rv = client.get('/')
+    assert b'the message by foo' in rv.data
+    with minitwit.app.app_context():
+        minitwit.rebuild_home_timelines()
+    rv = client.get('/')
+    assert b'the message by foo' in rv.data
+    assert b'the message by bar' in rv.data
+
+
+def test_fanout_self_follow(client, monkeypatch):
+    """Make sure following oneself neither breaks posting nor hides one's own messages"""
+    monkeypatch.setitem(minitwit.app.config, 'HOME_TIMELINE_FANOUT', True)
+    register_and_login(client, 'foo', 'default')
+    add_message(client, 'before following myself')
+    client.get('/foo/follow')
+    rv = client.post('/add_message', data={'text': 'after following myself'}, follow_redirects=True)
+    assert rv.status_code == 200
+    assert rv.data.count(b'after following myself') == 1
+    assert rv.data.count(b'before following myself') == 1
+    with minitwit.app.app_context():
+        assert minitwit.query_db('select count(*) from follower', one=True)[0] == 1
+
+    client.get('/foo/unfollow')
+    rv = client.get('/')
+    assert b'before following myself' in rv.data
+    assert b'after following myself' in rv.data
+
+
+def test_public_timeline_cache(client):
+    """Make sure the public timeline is cached and invalidated by new messages"""
+    register_and_login(client, 'foo', 'default')
+    add_message(client, 'the first message')
+    stats = minitwit.PUBLIC_TIMELINE_CACHE.stats()
+    client.get('/public')
+    rv = client.get('/public')
+    assert b'the first message' in rv.data
+    assert minitwit.PUBLIC_TIMELINE_CACHE.stats()['hits'] == stats['hits'] + 1
+
+    add_message(client, 'the second message')
+    rv = client.get('/public')
+    assert b'the second message' in rv.data
+
+    rv = client.get('/admin/caches', headers=admin_headers())
+    assert json.loads(rv.data)['public_timeline']['misses'] >= 2
+
+
+def test_ttl_cache_bounds():
+    """Make sure the caches evict by size and by age"""
+    cache = TtlCache('test', maxsize=2, ttl=60)
+    for key in ('a', 'b', 'c'):
+        cache.put(key, key.upper())
+    assert cache.get('a') is None
+    assert cache.get('c') == 'C'
+    assert cache.stats()['evictions'] == 1
+
+    cache.ttl = -1
+    cache.put('d', 'D')
+    assert cache.get('d') is None
+    assert cache.stats()['evictions'] == 3
+
+
+
+def test_ttl_cache_load_per_key():
+    """Make sure a slow load only holds up the misses for its own key"""
+    cache = TtlCache('test', maxsize=10, ttl=60)
+    a_loading, b_loaded = threading.Event(), threading.Event()
+    loads = []
+
+    def load_a():
+        loads.append('a')
+        a_loading.set()
+        # would time out if the load of b waited for this one
+        assert b_loaded.wait(5)
+        return 'A'
+
+    def load_b():
+        loads.append('b')
+        b_loaded.set()
+        return 'B'
+
+    threads = [threading.Thread(target=cache.get_or_load, args=('a', load_a)) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    assert a_loading.wait(5)
+    assert cache.get_or_load('b', load_b) == 'B'
+    for thread in threads:
+        thread.join()
+    assert cache.get('a') == 'A'
+    assert sorted(loads) == ['a', 'b']
+    assert not cache._loading  #pylint: disable=protected-access
+
+def test_message_list_cache(client):
+    """Make sure the rendered message lists are shared by the viewers of a page, around their own parts"""
+    register_and_login(client, 'foo', 'default')
+    add_message(client, 'the first message')
+    logout(client)
+    register_and_login(client, 'bar', 'default')
+    stats = minitwit.MESSAGE_LIST_CACHE.stats()
+    rv = client.get('/foo')
+    assert b'the first message' in rv.data
+    assert b'You are not yet following this user' in rv.data
+    rv = client.get('/foo/follow', follow_redirects=True)
+    assert b'the first message' in rv.data
+    assert b'You are now following &#34;foo&#34;' in rv.data
+    assert b'You are currently following this user' in rv.data
+    assert minitwit.MESSAGE_LIST_CACHE.stats()['hits'] == stats['hits'] + 1
+
+    # A new message is a new page
+    logout(client)
+    login(client, 'foo', 'default')
+    add_message(client, 'the second message')
+    stats = minitwit.MESSAGE_LIST_CACHE.stats()
+    rv = client.get('/foo')
+    assert b'the second message' in rv.data
+    assert b'This is you!' in rv.data
+    assert minitwit.MESSAGE_LIST_CACHE.stats()['misses'] == stats['misses'] + 1
+
+    rv = client.get('/admin/caches', headers=admin_headers())
+    assert json.loads(rv.data)['message_list']['bytes'] > 0
+
+
+def test_fragment_cache_bounds():
+    """Make sure the fragment cache evicts the least recently used fragments beyond its bytes"""
+    fragment_size = sys.getsizeof('x' * 100)
+    cache = FragmentCache('test_fragments', maxbytes=fragment_size * 2)
+    for key in ('a', 'b'):
+        cache.put(key, key * 100)
+    assert cache.get('a') == 'a' * 100
+    cache.put('c', 'c' * 100)
+    assert cache.get('b') is None
+    assert cache.get('a') == 'a' * 100
+    assert cache.stats()['bytes'] == fragment_size * 2
+    assert cache.stats()['evictions'] == 1
+
+    # Too large to be kept
+    cache.put('d', 'd' * 1000)
+    assert cache.get('d') is None
+    assert cache.get_or_render('e', lambda: 'e' * 100) == 'e' * 100
+    assert cache.get('e') == 'e' * 100
+
+
+def test_identity_cache(client):
+    """Make sure authenticated requests reuse the cached identity"""
+    register_and_login(client, 'foo', 'default')
+    stats = minitwit.IDENTITY_CACHE.stats()
+    client.get('/')
+    rv = client.get('/')
+    assert b'sign out [foo]' in rv.data
+    assert minitwit.IDENTITY_CACHE.stats()['hits'] == stats['hits'] + 2
+    with minitwit.app.app_context():
+        assert 'pw_hash' not in minitwit.get_identity(1)
+
+    # an invalidated identity is read again
+    with minitwit.app.app_context():
+        minitwit.exec_db("update user set username = 'bar' where user_id = 1")
+    minitwit.invalidate_identity(1)
+    rv = client.get('/')
+    assert b'sign out [bar]' in rv.data
+
+
+def test_avatar_hashes(client):
+    """Make sure the avatar hash is stored at registration and backfilled"""
+    register(client, 'foo', 'default', email=' Foo@Example.com')
+    expected = md5(b'foo@example.com').hexdigest()
+    with minitwit.app.app_context():
+        assert minitwit.query_db('select avatar_hash from user', one=True)[0] == expected
+        minitwit.exec_db('update user set avatar_hash = null')
+        assert minitwit.backfill_avatar_hashes() == 1
+        assert minitwit.query_db('select avatar_hash from user', one=True)[0] == expected
+
+    login(client, 'foo', 'default')
+    add_message(client, 'the message by foo')
+    rv = client.get('/public')
+    assert ('https://www.gravatar.com/avatar/%s?d=identicon&amp;s=48' % expected).encode() in rv.data
+
+
+def test_password_rehash(client, monkeypatch):
+    """Make sure outdated password hashes are upgraded on login"""
+    monkeypatch.setattr(minitwit.PASSWORD_HASHER, 'method', 'pbkdf2:sha256:1000')
+    register(client, 'foo', 'default')
+    with minitwit.app.app_context():
+        assert minitwit.query_db('select pw_hash from user', one=True)[0].startswith('pbkdf2:sha256:1000$')
+
+    monkeypatch.setattr(minitwit.PASSWORD_HASHER, 'method', 'pbkdf2:sha256:2000')
+    rv = login(client, 'foo', 'default')
+    assert b'You were logged in' in rv.data
+    with minitwit.app.app_context():
+        assert minitwit.query_db('select pw_hash from user', one=True)[0].startswith('pbkdf2:sha256:2000$')
+    logout(client)
+    rv = login(client, 'foo', 'default')
+    assert b'You were logged in' in rv.data
+
+
+def test_password_rehash_method(client, monkeypatch):
+    """Make sure werkzeug's default scrypt hashes move to the configured method, and costlier hashes are kept"""
+    register(client, 'foo', 'default')
+    with minitwit.app.app_context():
+        assert minitwit.query_db('select pw_hash from user', one=True)[0].startswith('scrypt:')
+    assert not minitwit.PASSWORD_HASHER.needs_rehash(minitwit.PASSWORD_HASHER.hash('default'))
+
+    monkeypatch.setattr(minitwit.PASSWORD_HASHER, 'method', 'pbkdf2:sha256:1000')
+    assert b'You were logged in' in login(client, 'foo', 'default').data
+    logout(client)
+    with minitwit.app.app_context():
+        assert minitwit.query_db('select pw_hash from user', one=True)[0].startswith('pbkdf2:sha256:1000$')
+
+    hasher = minitwit.PasswordHasher('pbkdf2:sha256:500', 0)
+    assert not hasher.needs_rehash('pbkdf2:sha256:1000$salt$hash')
+    assert hasher.needs_rehash('pbkdf2:sha256:100$salt$hash')
+    assert hasher.needs_rehash('pbkdf2:sha512:1000$salt$hash')
+    assert not minitwit.PasswordHasher('pbkdf2:sha256', 0).needs_rehash(
+        minitwit.PasswordHasher('pbkdf2:sha256', 0).hash('default'))
+
+
+def test_db_pool_telemetry(client):
+    """Make sure the pool telemetry is reported on the admin blueprint"""
+    client.get('/public?before=1-1')
+    rv = client.get('/admin/db/pool', headers=admin_headers())
+    primary = json.loads(rv.data)['primary']
+    assert primary['pool'] == 'QueuePool'
+    assert primary['checked_out'] == 0
+    assert primary['checkouts'] >= 1
+    assert primary['checkout_latency_ms']['count'] >= 1
+    assert primary['checkout_latency_ms']['buckets']['+Inf'] == primary['checkout_latency_ms']['count']
+
+
+def test_read_replicas(client, monkeypatch):
+    """Make sure reads go to the healthy replicas unless the user just wrote"""
+    register(client, 'foo', 'default')
+    replica_dir = tempfile.mkdtemp()
+    shutil.copy(minitwit.app.config['LOCAL_DATABASE_URL'][len('sqlite:///'):],
+                os.path.join(replica_dir, 'replica.db'))
+    router = minitwit.ReplicaRouter('test_replica', [
+        sqlalchemy.create_engine('sqlite:////nonexistent/replica.db'),
+        sqlalchemy.create_engine('sqlite:///' + os.path.join(replica_dir, 'replica.db'))])
+    monkeypatch.setattr(minitwit, 'READ_REPLICAS', router)
+    monkeypatch.setattr(minitwit.PUBLIC_TIMELINE_CACHE, 'ttl', 0)
+
+    # the writer reads its own writes from the primary
+    login(client, 'foo', 'default')
+    add_message(client, 'the message by foo')
+    rv = client.get('/public')
+    assert b'the message by foo' in rv.data
+
+    # once the window is over, the reads go to the stale replica
+    monkeypatch.setitem(minitwit.app.config, 'READ_YOUR_WRITES_SECONDS', -1)
+    with client.session_transaction() as session:
+        session.pop(minitwit.PRIMARY_PIN)
+    add_message(client, 'another message by foo')
+    rv = client.get('/public')
+    assert b'the message by foo' not in rv.data
+    assert b'sign out [foo]' in rv.data
+
+    # the API writes pin no session, so they get no cookie
+    logout(client)
+    auth = {'Authorization': 'Basic ' + base64.b64encode(b'foo:default').decode()}
+    rv = client.post('/api/messages', json={'messages': [{'text': 'by the API'}]}, headers=auth)
+    assert rv.status_code == 201
+    assert 'Set-Cookie' not in rv.headers
+
+    stats = router.stats()
+    assert not stats['test_replica-0']['healthy']
+    assert stats['test_replica-1']['healthy']
+    assert stats['test_replica-1']['checkouts'] >= 1
+
+
+def test_api_add_messages(client, monkeypatch):
+    """Make sure batches of messages are recorded through the JSON API"""
+    register(client, 'foo', 'default')
+    auth = {'Authorization': 'Basic ' + base64.b64encode(b'foo:default').decode()}
+    rv = client.post('/api/messages', json={'messages': [{'text': 'first'}, {'text': 'second'}]}, headers=auth)
+    assert rv.status_code == 201
+    first_id, second_id = json.loads(rv.data)['ids']
+    assert second_id == first_id + 1
+    with minitwit.app.app_context():
+        assert minitwit.query_db('select text from message where message_id = :id',
+                                 {'id': second_id}, one=True)[0] == 'second'
+    rv = client.get('/public')
+    assert b'first' in rv.data
+    assert b'second' in rv.data
+
+    rv = client.post('/api/messages', json={'messages': [{'text': 'x'}]},
+                     headers={'Authorization': 'Basic ' + base64.b64encode(b'foo:wrong').decode()})
+    assert rv.status_code == 401
+    rv = client.post('/api/messages', json={'messages': [{'text': 'ok'}, {'text': ' '}, {}]}, headers=auth)
+    assert rv.status_code == 400
+    assert json.loads(rv.data)['invalid'] == [1, 2]
+    monkeypatch.setitem(minitwit.app.config, 'API_MAX_BATCH_MESSAGES', 1)
+    rv = client.post('/api/messages', json={'messages': [{'text': 'a'}, {'text': 'b'}]}, headers=auth)
+    assert rv.status_code == 413
+
+
+def test_insert_messages_row_by_row(client, monkeypatch):
+    """Make sure the ids are right when the database does not hand out consecutive ids"""
+    monkeypatch.setattr(minitwit, 'has_consecutive_insert_ids', lambda: False)
+    monkeypatch.setitem(minitwit.app.config, 'HOME_TIMELINE_FANOUT', True)
+    register(client, 'foo', 'default')
+    with minitwit.app.test_request_context('/'):
+        message_ids = minitwit.insert_messages(1, ['one', 'two', 'three'])
+        assert [minitwit.query_db('select text from message where message_id = :id', {'id': message_id}, one=True)[0]
+                for message_id in message_ids] == ['one', 'two', 'three']
+        assert minitwit.query_db('select count(*) from home_timeline', one=True)[0] == 3
+
+
+def test_api_timelines_etag(client):
+    """Make sure the JSON timelines answer 304 until the timeline changes"""
+    register(client, 'bar', 'default')
+    register_and_login(client, 'foo', 'default')
+    add_message(client, 'the message by foo')
+
+    for url in ('/api/timeline', '/api/public', '/api/users/foo'):
+        rv = client.get(url)
+        assert rv.status_code == 200
+        assert json.loads(rv.data)['messages'][0]['text'] == 'the message by foo'
+        etag = rv.headers['ETag']
+        rv = client.get(url, headers={'If-None-Match': etag})
+        assert rv.status_code == 304
+        assert rv.data == b''
+
+    # a message by an author not followed leaves the home timeline alone, following changes it
+    rv = client.get('/api/timeline')
+    etag = rv.headers['ETag']
+    with minitwit.app.test_request_context('/'):
+        minitwit.exec_db("insert into message (author_id, text, pub_date) values (1, 'by bar', 1)")
+    assert client.get('/api/timeline', headers={'If-None-Match': etag}).status_code == 304
+    client.get('/bar/follow')
+    assert client.get('/api/timeline', headers={'If-None-Match': etag}).status_code == 200
+
+    # so does a message by a followed author, written to the followers or read at read time
+    for fanout_on_read in (0, 1):
+        with minitwit.app.test_request_context('/'):
+            minitwit.exec_db('update user set fanout_on_read = :flag where user_id = 1', {'flag': fanout_on_read})
+        etag = client.get('/api/timeline').headers['ETag']
+        with minitwit.app.test_request_context('/'):
+            minitwit.insert_messages(1, ['another message by bar'])
+            assert minitwit.query_db('select fanout_on_read from user where user_id = 1', one=True)[0] == fanout_on_read
+        assert client.get('/api/timeline', headers={'If-None-Match': etag}).status_code == 200
+
+    rv = client.get('/api/users/foo')
+    etag = rv.headers['ETag']
+    add_message(client, 'another message by foo')
+    rv = client.get('/api/users/foo', headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert json.loads(rv.data)['messages'][0]['text'] == 'another message by foo'
+
+    logout(client)
+    assert client.get('/api/timeline').status_code == 401
+    assert client.get('/api/users/nobody').status_code == 404
+
+
+def test_api_public_etag_across_workers(client):
+    """Make sure a message recorded by another worker, which can't invalidate this worker's cache,
+    is served along with the new ETag"""
+    register_and_login(client, 'foo', 'default')
+    add_message(client, 'the first message')
+    etag = client.get('/api/public').headers['ETag']
+
+    with minitwit.app.test_request_context('/'):
+        minitwit.exec_db("insert into message (author_id, text, pub_date) values (1, 'from another worker', 2000000000)")
+    rv = client.get('/api/public', headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert json.loads(rv.data)['messages'][0]['text'] == 'from another worker'
+
+
+def test_api_credentials_cache(client, monkeypatch):
+    """Make sure API pollers authenticated by basic auth only pay one password check"""
+    register(client, 'foo', 'default')
+    checks = []
+    check = minitwit.PASSWORD_HASHER.check
+    monkeypatch.setattr(minitwit.PASSWORD_HASHER, 'check', lambda *args: checks.append(args) or check(*args))
+
+    auth = {'Authorization': 'Basic ' + base64.b64encode(b'foo:default').decode()}
+    for _ in range(3):
+        assert client.get('/api/timeline', headers=auth).status_code == 200
+    assert len(checks) == 1
+
+    wrong = {'Authorization': 'Basic ' + base64.b64encode(b'foo:wrong').decode()}
+    assert client.get('/api/timeline', headers=wrong).status_code == 401
+    assert client.get('/api/timeline', headers=wrong).status_code == 401
+    assert len(checks) == 3
+
+
+def test_export_ndjson(client, monkeypatch):
+    """Make sure a user's account is exported as NDJSON, chunk by chunk"""
+    monkeypatch.setitem(minitwit.app.config, 'EXPORT_CHUNK_SIZE', 2)
+    register(client, 'bar', 'default')
+    register_and_login(client, 'foo', 'default')
+    client.get('/bar/follow')
+    for i in range(5):
+        add_message(client, 'message %d' % i)
+
+    rv = client.get('/api/users/foo/export/messages')
+    assert rv.mimetype == 'application/x-ndjson'
+    rows = [json.loads(line) for line in rv.data.decode().splitlines()]
+    assert [row['text'] for row in rows] == ['message %d' % i for i in range(5)]
+
+    rv = client.get('/api/users/foo/export/following')
+    assert [json.loads(line)['username'] for line in rv.data.decode().splitlines()] == ['bar']
+    assert client.get('/api/users/bar/export/messages').status_code == 403
+    assert client.get('/api/users/foo/export/passwords').status_code == 404
+
+    result = minitwit.app.test_cli_runner().invoke(args=['export', 'bar', '--what', 'followers'])
+    assert json.loads(result.output) == {'user_id': 2, 'username': 'foo'}
+
+
+def test_seed(client, monkeypatch):
+    """Make sure the synthetic data is the same for a given seed and loads in small batches"""
+    monkeypatch.setattr(minitwit.BulkLoader, 'MAX_PARAMETERS', 10)
+    register_and_login(client, 'foo', 'default')
+
+    def seed():
+        result = minitwit.app.test_cli_runner().invoke(
+            args=['seed', '--users', '30', '--follows', '5', '--messages', '200', '--seed', '7'])
+        assert result.exit_code == 0, result.output
+        with minitwit.app.app_context():
+            return (minitwit.query_db('select who_id, whom_id from follower order by who_id, whom_id'),
+                    minitwit.query_db('select author_id, text, pub_date from message order by message_id'))
+
+    follows, messages = seed()
+    assert len(messages) == 200
+    assert all(who_id != whom_id for who_id, whom_id in follows)
+    assert [pub_date for _, _, pub_date in messages] == sorted(pub_date for _, _, pub_date in messages)
+
+    with minitwit.app.app_context():
+        minitwit.init_db()
+    register(client, 'foo', 'default')
+    assert seed() == (follows, messages)
+
+    logout(client)
+    assert b'You were logged in' in login(client, 'user2', minitwit.SEED_PASSWORD).data
+
+    result = minitwit.app.test_cli_runner().invoke(args=['seed', '--users', '0', '--messages', '1'])
+    assert result.exit_code == 2
+    assert '--users' in result.output
+
+
+def test_seed_follows_average():
+    """Make sure the users follow as many others as asked on average, popular users included"""
+    follows = list(minitwit.generate_follows(random.Random(1), range(1, 2001), 20, 1.1))
+    assert len(set(follows)) == len(follows)
+    assert 18 <= len(follows) / 2000 <= 22
+
+
+def test_metrics(client):
+    """Make sure the request, query, template and pool metrics are exposed in the Prometheus format"""
+    register_and_login(client, 'foo', 'default')
+    client.get('/public')
+    client.get('/public')
+
+    assert client.get('/metrics').status_code == 401
+    rv = client.get('/metrics', headers=admin_headers())
+    assert rv.mimetype == 'text/plain'
+    metrics = rv.data.decode()
+    requests_line = re.search(
+        r'^minitwit_http_requests_total\{endpoint="public_timeline",method="GET",status="200"\} (\d+)$',
+        metrics, re.MULTILINE)
+    assert requests_line and int(requests_line.group(1)) >= 2
+    assert re.search(r'^minitwit_http_request_duration_seconds_bucket\{endpoint="public_timeline",le="\+Inf"\} \d+$',
+                     metrics, re.MULTILINE)
+    assert re.search(r'^minitwit_db_queries_total\{engine="primary",operation="select",outcome="ok"\} \d+$',
+                     metrics, re.MULTILINE)
+    assert 'minitwit_template_render_duration_seconds_count{template="timeline.html"}' in metrics
+    assert 'minitwit_db_pool_connections{pool="primary",state="checked_out"}' in metrics
+
+
+def test_metrics_thread_aggregation():
+    """Make sure the metrics recorded by several threads, alive or ended, add up"""
+    registry = MetricsRegistry()
+    registry.counter('hits_total', 'Hits.')
+    registry.histogram('latency_seconds', 'Latency.', buckets=(0.1, 1))
+
+    def record():
+        for _ in range(1000):
+            registry.inc('hits_total', {'route': 'a'})
+            registry.observe('latency_seconds', 0.5)
+
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    record()
+
+    # The shards of the ended threads were folded without waiting for a scrape
+    assert len(registry._shards) == 1  #pylint: disable=protected-access
+
+    text = registry.render()
+    assert 'hits_total{route="a"} 5000' in text
+    assert 'latency_seconds_bucket{le="0.1"} 0' in text
+    assert 'latency_seconds_bucket{le="1"} 5000' in text
+    assert 'latency_seconds_count 5000' in text
+    assert 'hits_total{route="a"} 5000' in registry.render()
+
+
+def test_slow_query_log(client, monkeypatch):
+    """Make sure the slow statements are logged with their parameter shapes and query plans"""
+    monkeypatch.setattr(minitwit.SLOW_QUERY_LOG, 'threshold_ms', 0)
+    register_and_login(client, 'foo', 'secret password')
+    client.get('/public')
+    with minitwit.app.test_request_context('/search/messages'):
+        minitwit.query_db("select * from message where text = :text limit 5", {'text': 'needle'})
+
+    # Streamed exports bypass query_db, they are timed all the same
+    client.get('/api/users/foo/export/messages')
+
+    minitwit.SLOW_QUERY_LOG.wait_for_plans()
+    rv = client.get('/admin/db/slow-queries', headers=admin_headers())
+    entries = json.loads(rv.data)['queries']['entries']
+    assert entries[0]['route'] == 'api_export'
+    search = [entry for entry in entries if entry['route'] == '/search/messages'][0]
+    assert search['statement'] == 'select * from message where text = ? limit ?'
+    assert search['parameters'] == ['str(6)']
+    assert search['plan']['full_scan']
+    assert not any('secret password' in json.dumps(entry) for entry in entries)
+
+    public = [entry for entry in entries if entry['route'] == 'public_timeline']
+    assert public and not public[0]['plan']['full_scan']
+
+    monkeypatch.setattr(minitwit.SLOW_QUERY_LOG, 'threshold_ms', None)
+    recorded = json.loads(client.get('/admin/db/slow-queries', headers=admin_headers()).data)['queries']['recorded']
+    client.get('/public')
+    assert json.loads(client.get('/admin/db/slow-queries', headers=admin_headers()).data)['queries']['recorded'] == recorded
+
+
+def test_readiness(client, monkeypatch):
+    """Make sure the readiness probe serves the state refreshed in the background, without touching the database"""
+    minitwit.READINESS.refresh()
+    rv = client.get('/healthcheck/readiness')
+    assert rv.status_code == 200
+    readiness = json.loads(rv.data)
+    assert readiness['database']['latency_ms'] >= 0
+    assert readiness['database']['type'] == 'sqlite'
+    assert readiness['schema']['version'] == readiness['schema']['expected_version'] > 0
+
+    # Served from memory: no statement runs but the background ones, and it is fast enough to be probed every second
+    connect = minitwit.DB_ENGINE.connect
+
+    def connect_in_background(*args, **kwargs):
+        assert threading.current_thread().name == 'readiness-refresher'
+        return connect(*args, **kwargs)
+
+    monkeypatch.setattr(minitwit.DB_ENGINE, 'connect', connect_in_background)
+    start = time.perf_counter()
+    for _ in range(200):
+        assert client.get('/healthcheck/readiness').status_code == 200
+    assert (time.perf_counter() - start) / 200 < 0.005
+    monkeypatch.undo()
+
+    # A schema missing its latest migration, or a state nobody refreshes, is not ready
+    with minitwit.app.app_context():
+        minitwit.execute_db(minitwit.get_db(), 'delete from schema_version where version = (select max(version) from schema_version)')
+    minitwit.READINESS.refresh()
+    rv = client.get('/healthcheck/readiness')
+    assert rv.status_code == 503
+    assert json.loads(rv.data)['schema']['status'] == 503
+
+    probe = ReadinessProbe()
+    probe.add_check('database', minitwit.check_database_readiness)
+    probe.interval = 0.01
+    probe.refresh()
+    assert probe.response()[1] == 200
+    time.sleep(0.05)
+    body, status = probe.response()
+    assert status == 503 and json.loads(body)['state'] == 'stale'
+
+    # Importing the app, like the pre-fork master and the flask commands do, runs no check
+    threads = subprocess.run(
+        [sys.executable, '-c', 'import threading, minitwit; print([t.name for t in threading.enumerate()])'],
+        cwd=os.path.dirname(os.path.abspath(minitwit.__file__)),
+        stdout=subprocess.PIPE, check=True, timeout=60).stdout
+    assert b'readiness-refresher' not in threads
+
+
+def test_profile(client, monkeypatch):
+    """Make sure the profiler samples the next requests to an endpoint, and leaves no hook behind"""
+    register_and_login(client, 'foo', 'default')
+    add_message(client, 'the message by foo')
+    query_public_timeline = minitwit.query_public_timeline
+
+    def slow_public_timeline(*args, **kwargs):
+        time.sleep(0.02)
+        return query_public_timeline(*args, **kwargs)
+
+    monkeypatch.setattr(minitwit, 'query_public_timeline', slow_public_timeline)
+    profile = {}
+
+    def run_profile():
+        rv = minitwit.app.test_client().get('/admin/profile?seconds=10&endpoint=public_timeline&requests=20&top=5',
+                                            headers=admin_headers())
+        profile.update(json.loads(rv.data))
+
+    profiler = threading.Thread(target=run_profile)
+    profiler.start()
+    while profiler.is_alive():
+        client.get('/public')
+        client.get('/')
+    profiler.join()
+
+    assert profile['requests'] == 20
+    assert profile['samples'] > 0 and len(profile['top']) <= 5
+    lines = profile['collapsed'].splitlines()
+    assert sum(int(line.rsplit(' ', 1)[1]) for line in lines) == profile['samples']
+    assert all('full_dispatch_request' in line for line in lines)
+    assert any('slow_public_timeline' in line for line in lines)
+    assert not any(re.search(r':timeline[; ]', line) for line in lines)
+    assert not flask.request_started.receivers and not flask.request_finished.receivers
+
+    rv = client.get('/admin/profile?seconds=0.05&format=collapsed', headers=admin_headers())
+    assert rv.status_code == 200 and rv.content_type == 'text/plain'
+    assert client.get('/admin/profile?endpoint=nope', headers=admin_headers()).status_code == 400
+
+
+async def asgi_request(app, method, path, query_string=b'', data=b'', cookie=None):
+    """Helper function sending one request to an ASGI app, returning its status, headers and body"""
+    headers = [(b'host', b'localhost'), (b'content-length', str(len(data)).encode())]
+    if data:
+        headers.append((b'content-type', b'application/x-www-form-urlencoded'))
+    if cookie:
+        headers.append((b'cookie', cookie.encode()))
+    scope = {'type': 'http', 'method': method, 'path': path, 'root_path': '', 'query_string': query_string,
+             'headers': headers, 'http_version': '1.1', 'scheme': 'http', 'server': ('localhost', 80)}
+    messages = [{'type': 'http.request', 'body': data, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    response_headers = {name.decode(): value.decode() for name, value in sent[0]['headers']}
+    return sent[0]['status'], response_headers, b''.join(message.get('body', b'') for message in sent[1:])
+
+
+def test_asgi(client, monkeypatch):
+    """Make sure the ASGI app serves the pages from the event loop and the other routes from Flask"""
+    import asyncio
+    import minitwit_asgi
+
+    # The passwords are hashed and checked off the event loop
+    monkeypatch.setattr(minitwit.PASSWORD_HASHER, 'hash', None)
+    monkeypatch.setattr(minitwit.PASSWORD_HASHER, 'check', None)
+
+    async def scenario():
+        try:
+            await pages(minitwit_asgi.app)
+        finally:
+            # The async connections are open on threads of their own
+            await minitwit_asgi.ASYNC_ENGINE.dispose()
+
+    async def pages(app):
+        status, headers, _ = await asgi_request(
+            app, 'POST', '/register', data=b'username=foo&email=foo%40example.com&password=x&password2=x')
+        assert status == 302 and headers['location'] == '/login'
+        status, _, body = await asgi_request(app, 'GET', '/login', cookie=headers['set-cookie'].split(';')[0])
+        assert b'You were successfully registered and can login now' in body
+
+        status, _, body = await asgi_request(app, 'POST', '/login', data=b'username=foo&password=wrong')
+        assert b'Invalid password' in body
+        status, headers, _ = await asgi_request(app, 'POST', '/login', data=b'username=foo&password=x')
+        assert status == 302
+        cookie = headers['set-cookie'].split(';')[0]
+
+        # Served by Flask, with the same session
+        status, headers, _ = await asgi_request(app, 'POST', '/add_message', data=b'text=hello+loop', cookie=cookie)
+        assert status == 302
+        cookie = headers['set-cookie'].split(';')[0]
+
+        status, headers, body = await asgi_request(app, 'GET', '/', cookie=cookie)
+        assert status == 200 and 'host' in headers
+        assert b'Your message was recorded' in body
+        assert b'hello loop' in body
+        assert b'sign out [foo]' in body
+
+        status, _, body = await asgi_request(app, 'GET', '/foo', cookie=cookie)
+        assert b'This is you!' in body
+        status, _, body = await asgi_request(app, 'GET', '/search', query_string=b'q=loop')
+        assert b'hello loop' in body
+        status, _, body = await asgi_request(app, 'GET', '/public')
+        assert b'hello loop' in body
+        assert (await asgi_request(app, 'GET', '/nobody'))[0] == 404
+        assert (await asgi_request(app, 'GET', '/static/style.css'))[0] == 200
+
+    asyncio.run(scenario())
+    # Read through the async driver, and counted like the Flask requests
+    metrics = client.get('/metrics', headers=admin_headers()).data.decode()
+    assert re.search(r'^minitwit_db_queries_total\{engine="async",operation="select",outcome="ok"\} \d+$',
+                     metrics, re.MULTILINE)
+    assert 'minitwit_http_requests_total{endpoint="user_timeline",method="GET",status="200"}' in metrics
+
+
+def test_fork_safety(client):
+    """Make sure a forked worker serves requests from pools and metadata sessions of its own"""
+    assert client.get('/public').status_code == 200
+    parent_pool, parent_session = minitwit.DB_ENGINE.pool, HostService.METADATA_CLIENT.session
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # The child reports through the pipe, and never returns into pytest
+        try:
+            HostService.METADATA_CLIENT.get_many([])
+            ok = minitwit.DB_ENGINE.pool is not parent_pool and \
+                HostService.METADATA_CLIENT.session is not parent_session and \
+                minitwit.app.test_client().get('/public').status_code == 200
+            os.write(write_fd, b'1' if ok else b'0')
+        finally:
+            os._exit(0)
+
+    os.close(write_fd)
+    assert os.read(read_fd, 1) == b'1'
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    # The parent's pool was left alone
+    assert minitwit.DB_ENGINE.pool is parent_pool
+    assert client.get('/public').status_code == 200
+
+
+class MetadataRoutes(dict):
+    """The (status, body, delay) of each path served by the stub metadata service, and what it was asked"""
+
+    def __init__(self, base_url):
+        super().__init__()
+        self.base_url = base_url
+        self.require_token = False
+        self.tokens = set()
+        # The (status, delay) of the token requests, 403 on IMDSv1 only hosts
+        self.token_reply = (200, 0)
+        # (method, path, token, client port) of every request
+        self.requests = []
+
+
+@pytest.fixture
+def metadata_server(monkeypatch):
+    """A local stand-in for the instance metadata service, IMDSv2 tokens included, that the app's metadata
+    client points to"""
+    routes = None
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        # Keep-alive, like the real service, so that connection reuse shows
+        protocol_version = 'HTTP/1.1'
+
+        def _reply(self, status, body):
+            body = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_PUT(self):  #pylint: disable=invalid-name
+            routes.requests.append(('PUT', self.path, None, self.client_address[1]))
+            if self.path != '/latest/api/token' or not self.headers.get('X-aws-ec2-metadata-token-ttl-seconds'):
+                self._reply(400, '')
+                return
+            status, delay = routes.token_reply
+            time.sleep(delay)
+            if status != 200:
+                self._reply(status, '')
+                return
+            token = 'token-%d' % len(routes.requests)
+            routes.tokens.add(token)
+            self._reply(200, token)
+
+        def do_GET(self):  #pylint: disable=invalid-name
+            token = self.headers.get('X-aws-ec2-metadata-token')
+            routes.requests.append(('GET', self.path, token, self.client_address[1]))
+            if routes.require_token and token not in routes.tokens:
+                self._reply(401, '')
+                return
+            status, body, delay = routes.get(self.path, (404, '', 0))
+            time.sleep(delay)
+            self._reply(status, body)
+
+        def log_message(self, *_args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    routes = MetadataRoutes('http://127.0.0.1:%d/latest/' % server.server_port)
+    monkeypatch.setattr(HostService, 'METADATA_CLIENT', MetadataClient(routes.base_url))
+    yield routes
+    server.shutdown()
+
+
+def test_metadata_client(metadata_server):
+    """Make sure the metadata client fetches concurrently over pooled connections, and caches the IMDSv2 token
+    and the answers until they expire"""
+    metadata_server.require_token = True
+    metadata_server.update({
+        '/latest/meta-data/': (200, 'ami-id', 0),
+        '/latest/meta-data/local-hostname': (200, 'ip-10-0-0-3.ec2.internal\n', 0.3),
+        '/latest/meta-data/public-hostname': (200, 'ec2-1-2-3-4.compute.amazonaws.com', 0.3),
+        '/latest/meta-data/instance-id': (200, 'i-0123', 0),
+    })
+    client = MetadataClient(metadata_server.base_url, ttl=60, token_ttl=1)
+
+    start = time.perf_counter()
+    answers = client.get_many(['meta-data/', 'meta-data/local-hostname', 'meta-data/public-hostname'])
+    assert time.perf_counter() - start < 0.55
+    assert answers == {'meta-data/': 'ami-id', 'meta-data/local-hostname': 'ip-10-0-0-3.ec2.internal',
+                       'meta-data/public-hostname': 'ec2-1-2-3-4.compute.amazonaws.com'}
+    puts = [request for request in metadata_server.requests if request[0] == 'PUT']
+    assert len(puts) == 1
+    assert all(request[2] for request in metadata_server.requests if request[0] == 'GET')
+
+    # Answered from the cache, absent paths included
+    asked = len(metadata_server.requests)
+    assert client.get('meta-data/local-hostname') == 'ip-10-0-0-3.ec2.internal'
+    assert client.get('meta-data/missing') is None
+    assert client.get('meta-data/missing') is None
+    assert len(metadata_server.requests) == asked + 1
+
+    # The token is renewed before it expires, and again when the service forgets it
+    time.sleep(0.6)
+    assert client.get('meta-data/instance-id') == 'i-0123'
+    metadata_server.tokens.clear()
+    client.invalidate()
+    client._token, client._token_expires_at = 'forgotten', time.monotonic() + 60
+    assert client.get('meta-data/instance-id') == 'i-0123'
+    assert len([request for request in metadata_server.requests if request[0] == 'PUT']) == 3
+
+    # Every request went over the few pooled connections
+    ports = {request[3] for request in metadata_server.requests}
+    assert len(ports) <= client.max_workers < len(metadata_server.requests)
+
+    # HostService shares a client, which a fixture points to the stub
+    app = minitwit.Flask('metadata')
+    app.config['IN_CLOUD'] = None
+    assert HostService.is_running_in_the_cloud(app)
+    assert HostService.get_hostname(app) == 'ip-10-0-0-3.ec2.internal'
+
+
+def test_metadata_client_imdsv1(metadata_server):
+    """Make sure a host without IMDSv2 is asked for a token once, not before every request"""
+    metadata_server.token_reply = (403, 0.5)
+    paths = ['meta-data/', 'meta-data/local-hostname', 'meta-data/public-hostname', 'meta-data/instance-id']
+    metadata_server.update({'/latest/' + path: (200, path, 0) for path in paths})
+    client = MetadataClient(metadata_server.base_url, ttl=60)
+
+    start = time.perf_counter()
+    assert client.get_many(paths) == {path: path for path in paths}
+    assert time.perf_counter() - start < 1
+    assert client.get('meta-data/missing') is None
+    assert len([request for request in metadata_server.requests if request[0] == 'PUT']) == 1
+    assert not any(request[2] for request in metadata_server.requests if request[0] == 'GET')
+
+
+def test_startup_probe_deadline(metadata_server):
+    """Make sure the probes run concurrently within the deadline, and survive a bad identity document"""
+    metadata_server.update({
+        '/latest/meta-data/': (200, 'ami-id', 0),
+        '/latest/dynamic/instance-identity/document': (200, '<html>not json</html>', 0),
+        '/latest/meta-data/local-hostname': (200, 'ip-10-0-0-1.ec2.internal', 0.5),
+        '/latest/meta-data/public-hostname': (200, 'never read', 3),
+    })
+    start = time.perf_counter()
+    results = StartupService.probe(1)
+    assert time.perf_counter() - start < 1.5
+    assert results['IN_CLOUD']['status']
+    assert results['IN_CLOUD']['metadata'] == {}
+    assert results['HOSTNAME'] == 'ip-10-0-0-1.ec2.internal'
+
+    metadata_server.clear()
+    HostService.METADATA_CLIENT.invalidate()
+    assert not StartupService.probe(1)['IN_CLOUD']['status']
+
+
+def test_startup_cache(metadata_server, tmp_path):
+    """Make sure the next workers reuse the probes of the first one, and background probes land later"""
+    metadata_server.update({
+        '/latest/meta-data/': (200, 'ami-id', 0),
+        '/latest/dynamic/instance-identity/document': (200, '{"region": "us-west-2"}', 0),
+        '/latest/meta-data/local-hostname': (200, 'ip-10-0-0-2.ec2.internal', 0.2),
+    })
+    cache_file = str(tmp_path / 'startup.json')
+
+    first = minitwit.Flask('first')
+    StartupService.bootstrap(first, 'concurrent', 1, cache_file, 60)
+    assert first.config['STARTUP']['source'] == 'probe'
+    assert first.config['HOSTNAME'] == 'ip-10-0-0-2.ec2.internal'
+
+    metadata_server.clear()
+    second = minitwit.Flask('second')
+    StartupService.bootstrap(second, 'concurrent', 1, cache_file, 60)
+    assert second.config['STARTUP']['source'] == 'cache'
+    assert second.config['IN_CLOUD']['metadata'] == {'region': 'us-west-2'}
+
+    # Only a file of the current user, that nobody else can write, is trusted
+    assert os.stat(cache_file).st_mode & 0o777 == 0o600
+    os.chmod(cache_file, 0o666)
+    assert StartupService.load_cache(cache_file, 60) is None
+    os.chmod(cache_file, 0o600)
+    if os.getuid() == 0:
+        os.chown(cache_file, 12345, -1)
+        assert StartupService.load_cache(cache_file, 60) is None
+        os.chown(cache_file, 0, -1)
+    assert StartupService.load_cache(cache_file, 60) is not None
+
+    # An expired cache is probed again, in the background the worker starts as off-cloud
+    metadata_server['/latest/meta-data/'] = (200, 'ami-id', 0.2)
+    HostService.METADATA_CLIENT.invalidate()
+    third = minitwit.Flask('third')
+    StartupService.bootstrap(third, 'background', 1, cache_file, 0)
+    assert not third.config['IN_CLOUD']['status']
+    StartupService.wait()
+    assert third.config['IN_CLOUD']['status']
+    assert 'probe_seconds' in third.config['STARTUP']
+    assert minitwit.app.config['STARTUP']['cold_start_seconds'] > 0
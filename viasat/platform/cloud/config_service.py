@@ -1,6 +1,5 @@
 import json
 import os
-import requests
 
 from viasat.platform.cloud.host_service import HostService
 
@@ -43,8 +42,11 @@ class ConfigService:
             return
 
         # https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/instancedata-data-retrieval.html
-        cloud_metadata = requests.get('http://169.254.169.254/latest/dynamic/instance-identity/document').text
-        app.config['IN_CLOUD']["metadata"] = json.loads(cloud_metadata)
+        cloud_metadata = HostService.METADATA_CLIENT.get('dynamic/instance-identity/document')
+        try:
+            app.config['IN_CLOUD']["metadata"] = json.loads(cloud_metadata or '{}')
+        except ValueError:
+            app.logger.warning("Can't parse the instance identity document: %s", cloud_metadata)
 
         ConfigService.log_current_config(app)
 
@@ -1,24 +1,13 @@
-import requests
 import os
-from requests.exceptions import RequestException
-from requests.adapters import HTTPAdapter
+
+from viasat.platform.cloud.metadata_client import MetadataClient
 
 
 class HostService:
     """Implements host discovery capabilities"""
 
-    @staticmethod
-    def __make_single_request(url):
-        session = requests.Session()
-        # https://stackoverflow.com/questions/15431044/can-i-set-max-retries-for-requests-request/15431343#15431343
-        retries = HTTPAdapter(max_retries=1)
-        session.mount('http://', retries)
-
-        # Making sure we timeout very quickly for the single request
-        # https://requests.readthedocs.io/en/stable/user/advanced/#timeouts
-        # https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/instancedata-data-retrieval.html
-        response = session.get(url, timeout=1)
-        return response
+    # The instance metadata client of the process, so that its connections, token and answers are reused
+    METADATA_CLIENT = MetadataClient()
 
 
     @staticmethod
@@ -37,16 +26,11 @@ class HostService:
             "metadata": {},
             "type": "local"
         }
-        try:
-            response = HostService.__make_single_request('http://169.254.169.254/latest/meta-data/')
-            app.config['IN_CLOUD']["status"] = response.status_code == 200
-            app.config['IN_CLOUD']["type"] = "ec2" if response.status_code == 200 else "compute"
+        if HostService.METADATA_CLIENT.get('meta-data/') is not None:
+            app.config['IN_CLOUD']["status"] = True
+            app.config['IN_CLOUD']["type"] = "ec2"
             app.logger.info("Running in the Cloud...")
 
-        except (RequestException, TimeoutError, ConnectionError):
-            # Just to repeat the metadata section
-            app.config['IN_CLOUD']["metadata"]: {}
-
         # Just return the cached value
         return app.config['IN_CLOUD']["status"]
 
@@ -70,16 +54,14 @@ class HostService:
         # From the public to the private zone. The http response returned a 404 http error, resolved into a multi-space
         # The exception was from setting this hostname to the HTTP response header
         # "ValueError: Detected newline in header value.  This is a potential security problem"
-        aws_api_url = "http://169.254.169.254/latest/meta-data"
-        response = HostService.__make_single_request(aws_api_url + '/public-hostname')
-        if response.status_code == 200:
-            hostname = response.text
+        answers = HostService.METADATA_CLIENT.get_many(['meta-data/public-hostname', 'meta-data/local-hostname'])
+        if answers['meta-data/public-hostname'] is not None:
+            hostname = answers['meta-data/public-hostname']
             app.logger.info("We are running at the public zone at %s", hostname)
 
         # If not, let's try the private, as chances are we are here...
-        response = HostService.__make_single_request(aws_api_url + '/local-hostname')
-        if response.status_code == 200:
-            hostname = response.text
+        if answers['meta-data/local-hostname'] is not None:
+            hostname = answers['meta-data/local-hostname']
             app.logger.info("We are running at the private zone at %s", hostname)
 
         else:
@@ -92,4 +74,4 @@ class HostService:
             app.logger.warning("Can't determine the hostname. Setting as undetermined!")
             hostname = "unknown"
 
-        return hostname
\ No newline at end of file
+        return hostname
@@ -0,0 +1,165 @@
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+
+# https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/instancedata-data-retrieval.html
+METADATA_URL = 'http://169.254.169.254/latest/'
+
+TOKEN_HEADER = 'X-aws-ec2-metadata-token'
+TOKEN_TTL_HEADER = 'X-aws-ec2-metadata-token-ttl-seconds'
+
+
+class MetadataClient:
+    """Implements a client of the EC2 instance metadata service over one pooled session, with the IMDSv2
+    session token and the answers cached until they expire"""
+
+    def __init__(self, base_url=METADATA_URL, timeout=1, ttl=300, token_ttl=21600, token_retry=60, max_workers=4):
+        """
+        :param timeout: seconds to wait for each answer, the metadata service is local and fast
+        :param ttl: seconds the answers, or their absence, are cached
+        :param token_ttl: seconds the IMDSv2 session token is valid
+        :param token_retry: seconds IMDSv1 is used after a failed token request, before asking again
+        """
+        self.base_url = base_url
+        self.timeout = timeout
+        self.ttl = ttl
+        self.token_ttl = token_ttl
+        self.token_retry = token_retry
+        self.max_workers = max_workers
+        self._answers = {}
+        self._token = None
+        self._token_expires_at = 0
+        # The token request in flight, that the threads needing a token wait for
+        self._token_request = None
+        self._pid = None
+        self._check_fork()
+
+
+    def _check_fork(self):
+        # A forked child keeps the answers and the token, but not the parent's sockets, threads and held locks
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.session = requests.Session()
+            # https://stackoverflow.com/questions/15431044/can-i-set-max-retries-for-requests-request/15431343#15431343
+            self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers,
+                                                      max_retries=1))
+            self._lock = threading.Lock()
+            self._token_lock = threading.Lock()
+            self._token_request = None
+            self._executor = None
+
+
+    def _get_token(self):
+        # The token, or its absence, is valid until it expires
+        with self._token_lock:
+            if self._token_expires_at > time.monotonic():
+                return self._token
+            # One thread asks for the token, outside of the lock, while the others wait for its answer
+            request = self._token_request
+            asking = request is None
+            if asking:
+                request = self._token_request = Future()
+
+        if not asking:
+            return request.result()
+
+        try:
+            response = self.session.put(self.base_url + 'api/token', timeout=self.timeout,
+                                        headers={TOKEN_TTL_HEADER: str(self.token_ttl)})
+            token = response.text if response.status_code == 200 else None
+        except RequestException:
+            token = None
+
+        with self._token_lock:
+            self._token = token
+            if token is not None:
+                # Renewed a bit before the service expires it
+                self._token_expires_at = time.monotonic() + self.token_ttl - min(60, self.token_ttl / 2)
+            else:
+                # Without a token, e.g. on IMDSv1 only hosts or past the hop limit, IMDSv1 is used until then
+                self._token_expires_at = time.monotonic() + self.token_retry
+            self._token_request = None
+        request.set_result(token)
+        return token
+
+
+    def _fetch(self, path):
+        for attempt in range(2):
+            token = self._get_token()
+            try:
+                response = self.session.get(self.base_url + path, timeout=self.timeout,
+                                            headers={TOKEN_HEADER: token} if token else {})
+            except RequestException:
+                return None
+
+            # The service forgot the token, e.g. after a restart: get a new one, once
+            if response.status_code == 401 and attempt == 0 and token is not None:
+                with self._token_lock:
+                    if self._token == token:
+                        self._token, self._token_expires_at = None, 0
+                continue
+            return response.text.strip() if response.status_code == 200 else None
+        return None
+
+
+    def _cached(self, path):
+        with self._lock:
+            entry = self._answers.get(path)
+            if entry is not None and entry[0] > time.monotonic():
+                return True, entry[1]
+        return False, None
+
+
+    def get(self, path):
+        """
+        :return: the answer to the metadata path, e.g. meta-data/local-hostname, or None if there is none
+        """
+        self._check_fork()
+        cached, value = self._cached(path)
+        if cached:
+            return value
+
+        value = self._fetch(path)
+        with self._lock:
+            self._answers[path] = (time.monotonic() + self.ttl, value)
+        return value
+
+
+    def get_many(self, paths, deadline=None):
+        """
+        Requests the paths that are not cached concurrently
+        :return: dict of path -> answer, None for the paths that have none or did not answer within the deadline
+        """
+        self._check_fork()
+        answers, missing = {}, []
+        for path in paths:
+            cached, value = self._cached(path)
+            if cached:
+                answers[path] = value
+            else:
+                missing.append(path)
+
+        if missing:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                        thread_name_prefix='instance-metadata')
+            futures = {path: self._executor.submit(self.get, path) for path in missing}
+            wait(futures.values(), timeout=deadline)
+            # The stragglers still cache their answers when they arrive
+            answers.update({path: future.result() if future.done() else None for path, future in futures.items()})
+
+        return answers
+
+
+    def invalidate(self):
+        """Forgets the answers and the token"""
+        with self._lock:
+            self._answers.clear()
+        with self._token_lock:
+            self._token, self._token_expires_at = None, 0
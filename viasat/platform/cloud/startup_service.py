@@ -0,0 +1,162 @@
+import json
+import os
+import threading
+import time
+
+from viasat.platform.cloud.config_service import ConfigService
+from viasat.platform.cloud.host_service import HostService
+
+# The instance metadata paths read at startup, fetched all at once
+PROBE_PATHS = {
+    'meta-data': 'meta-data/',
+    'identity': 'dynamic/instance-identity/document',
+    'public-hostname': 'meta-data/public-hostname',
+    'local-hostname': 'meta-data/local-hostname',
+}
+
+# Probe each instance metadata url one after the other, the original behavior
+STARTUP_MODE_SYNC = 'sync'
+# Probe them all at once, waiting up to the deadline
+STARTUP_MODE_CONCURRENT = 'concurrent'
+# Serve as off-cloud right away while they are probed in the background
+STARTUP_MODE_BACKGROUND = 'background'
+
+
+class StartupService:
+    """Implements the bootstrap of the cloud metadata within a deadline, cached on disk for the next workers"""
+
+    # The probe running in the background, so that code needing the metadata can wait for it
+    _background = None
+
+
+    @staticmethod
+    def parse_identity(document):
+        """
+        :return: the instance identity document as a dict, empty if it is missing or not a JSON object
+        """
+        try:
+            identity = json.loads(document or '{}')
+        except ValueError:
+            return {}
+        return identity if isinstance(identity, dict) else {}
+
+
+    @staticmethod
+    def probe(deadline):
+        """
+        Requests the instance metadata concurrently, none of the answers arriving after the deadline is waited for
+        :return: the IN_CLOUD and HOSTNAME config values
+        """
+        # The stragglers end on their own request timeout, and are cached for HostService when they do
+        fetched = HostService.METADATA_CLIENT.get_many(PROBE_PATHS.values(), deadline)
+        answers = {name: fetched[path] for name, path in PROBE_PATHS.items()}
+
+        in_cloud = {"status": False, "metadata": {}, "type": "local"}
+        hostname = os.uname().nodename.strip()
+        if answers['meta-data'] is not None:
+            in_cloud = {"status": True, "metadata": StartupService.parse_identity(answers['identity']), "type": "ec2"}
+            # The private hostname wins over the public one, like HostService.get_hostname
+            hostname = answers['local-hostname'] or answers['public-hostname'] or hostname
+
+        return {"IN_CLOUD": in_cloud, "HOSTNAME": hostname}
+
+
+    @staticmethod
+    def load_cache(cache_file, ttl):
+        """
+        :return: the results of a probe made on this host less than ttl seconds ago, or None. The file is only
+        trusted if it is owned by the current user and nobody else can write it, as it sets the hostname and region
+        """
+        try:
+            cache_fd = os.open(cache_file, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+        except OSError:
+            return None
+        try:
+            status = os.fstat(cache_fd)
+            if status.st_uid != os.getuid() or status.st_mode & 0o022:
+                os.close(cache_fd)
+                return None
+            with os.fdopen(cache_fd, mode='r') as cache:
+                cached = json.load(cache)
+        except (OSError, ValueError):
+            return None
+
+        if cached.get('nodename') != os.uname().nodename or cached.get('probed_at', 0) + ttl < time.time():
+            return None
+        return cached['results']
+
+
+    @staticmethod
+    def save_cache(cache_file, results):
+        """Writes the results of a probe for the next workers, atomically so that they never read half of it, in a
+        directory created for the current user only if missing, and readable by the current user only"""
+        temporary_file = '{}.{}'.format(cache_file, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(cache_file)), mode=0o700, exist_ok=True)
+            if os.path.lexists(temporary_file):
+                os.unlink(temporary_file)
+            cache_fd = os.open(temporary_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(cache_fd, mode='w') as cache:
+                json.dump({"nodename": os.uname().nodename, "probed_at": time.time(), "results": results}, cache)
+            os.replace(temporary_file, cache_file)
+        except OSError as error:
+            # Only the next workers are slower without it
+            return str(error)
+        return None
+
+
+    @staticmethod
+    def __probe_and_apply(app, deadline, cache_file):
+        start = time.perf_counter()
+        results = StartupService.probe(deadline)
+        app.config.update(results)
+        app.config['STARTUP']['probe_seconds'] = round(time.perf_counter() - start, 3)
+
+        error = StartupService.save_cache(cache_file, results)
+        if error is not None:
+            app.logger.warning("Can't cache the startup probes to %s: %s", cache_file, error)
+        app.logger.info("Probed the cloud metadata in %.3f s: in the cloud=%s hostname=%s",
+                        app.config['STARTUP']['probe_seconds'], results['IN_CLOUD']['status'], results['HOSTNAME'])
+
+
+    @staticmethod
+    def bootstrap(app, mode, deadline, cache_file, cache_ttl):
+        """
+        Sets the IN_CLOUD and HOSTNAME config values from the cache file, or by probing the instance metadata as
+        the mode says, and records how in the STARTUP config value
+        """
+        app.config['STARTUP'] = {"mode": mode, "source": "probe"}
+
+        if mode == STARTUP_MODE_SYNC:
+            ConfigService.bootstrap_cloud_metadata(app)
+            return
+
+        app.logger.info("Bootstrapping app server...")
+        cached = StartupService.load_cache(cache_file, cache_ttl)
+        if cached is not None:
+            app.config.update(cached)
+            app.config['STARTUP']['source'] = "cache"
+            app.logger.info("Loaded the cloud metadata probed by a previous worker from %s", cache_file)
+
+        elif mode == STARTUP_MODE_BACKGROUND:
+            # Off-cloud values until the probes answer, so that nothing probes synchronously meanwhile
+            app.config['IN_CLOUD'] = {"status": False, "metadata": {}, "type": "local"}
+            app.config['HOSTNAME'] = os.uname().nodename.strip()
+            StartupService._background = threading.Thread(
+                target=StartupService.__probe_and_apply, args=(app, deadline, cache_file),
+                name='startup-probes', daemon=True)
+            StartupService._background.start()
+
+        else:
+            StartupService.__probe_and_apply(app, deadline, cache_file)
+
+        ConfigService.log_current_config(app)
+
+
+    @staticmethod
+    def wait(timeout=None):
+        """
+        Waits for the probes running in the background, for code that can't do without the cloud metadata
+        """
+        if StartupService._background is not None:
+            StartupService._background.join(timeout)
@@ -0,0 +1,123 @@
+from collections import OrderedDict
+import sys
+import threading
+
+from viasat.platform.core.ttl_cache import CACHES
+
+
+class FragmentCache:
+    """Implements a thread-safe LRU cache of rendered HTML fragments, bounded by the bytes they hold rather than by
+    their number, as one page of long messages weighs as much as several of short ones. A fragment is keyed by what
+    it was rendered from, so it never expires."""
+
+    def __init__(self, name, maxbytes):
+        self.name = name
+        self.maxbytes = maxbytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by every invalidation, so that a render racing with it is not cached
+        self._generation = 0
+        CACHES[name] = self
+
+
+    def get(self, key):
+        """
+        :return: the cached fragment for the key, or None
+        """
+        with self._lock:
+            fragment = self._entries.get(key)
+            if fragment is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return fragment
+
+
+    def put(self, key, fragment, generation=None):
+        """
+        Caches the fragment, evicting the least recently used ones until it fits. A fragment larger than the
+        whole cache, or rendered before an invalidation since the given generation, is not kept.
+        """
+        size = sys.getsizeof(fragment)
+        with self._lock:
+            if size > self.maxbytes or (generation is not None and generation != self._generation):
+                return
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= sys.getsizeof(previous)
+            while self._entries and self.bytes + size > self.maxbytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= sys.getsizeof(evicted)
+                self.evictions += 1
+            self._entries[key] = fragment
+            self.bytes += size
+
+
+    def generation(self):
+        """
+        :return: the generation to pass to put() for a fragment about to be rendered
+        """
+        with self._lock:
+            return self._generation
+
+
+    def get_or_render(self, key, render):
+        """
+        :return: the cached fragment for the key, calling render() to fill it on a miss
+        """
+        generation = self.generation()
+        fragment = self.get(key)
+        if fragment is None:
+            fragment = render()
+            self.put(key, fragment, generation)
+        return fragment
+
+
+    async def get_or_render_async(self, key, render):
+        """
+        :return: the cached fragment for the key, awaiting render() to fill it on a miss
+        """
+        generation = self.generation()
+        fragment = self.get(key)
+        if fragment is None:
+            fragment = await render()
+            self.put(key, fragment, generation)
+        return fragment
+
+
+    def invalidate(self, key=None):
+        """
+        Drops the fragment for the key, or every fragment if no key is given.
+        """
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+            if key is None:
+                self._entries.clear()
+                self.bytes = 0
+            elif key in self._entries:
+                self.bytes -= sys.getsizeof(self._entries.pop(key))
+
+
+    def stats(self):
+        """
+        :return: the counters and the occupancy of the cache
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "bytes": self.bytes,
+                "maxbytes": self.maxbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
@@ -7,7 +7,8 @@ class HttpResponseDecorator:
     def decorate_with_host_info(app, response):
         response.headers['Host'] = app.config['HOSTNAME']
         if app.config['IN_CLOUD']["status"]:
-            response.headers['X-Host-AZ'] = app.config['IN_CLOUD']["metadata"]["availabilityZone"]
+            # The identity document may not have been read within the startup deadline
+            response.headers['X-Host-AZ'] = app.config['IN_CLOUD']["metadata"].get("availabilityZone", "unknown")
 
 
     @staticmethod
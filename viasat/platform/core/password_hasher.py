@@ -0,0 +1,136 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import inspect
+import multiprocessing
+import os
+import threading
+
+from werkzeug import security
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# The method and costs werkzeug uses when none is given, they go up with the werkzeug releases
+DEFAULT_METHOD = inspect.signature(generate_password_hash).parameters['method'].default
+DEFAULT_PBKDF2_ITERATIONS = getattr(security, 'DEFAULT_PBKDF2_ITERATIONS', 260000)
+DEFAULT_SCRYPT_COST = (2 ** 15, 8, 1)
+
+
+class PasswordHasher:
+    """Implements password hashing and checking on a bounded pool of worker processes, so that
+    the CPU-bound key derivation does not hold the request threads of the app server"""
+
+    def __init__(self, method, pool_size, max_pending=None):
+        """
+        :param method: the werkzeug hash method, e.g. scrypt or pbkdf2:sha256:1000000, None for werkzeug's default
+        :param pool_size: number of worker processes, 0 hashes on the calling thread
+        :param max_pending: number of hashes queued or running at once before callers wait
+        """
+        self.method = method or DEFAULT_METHOD
+        self.pool_size = pool_size
+        self.max_pending = max_pending or max(1, pool_size) * 4
+        self._pending = threading.BoundedSemaphore(self.max_pending)
+        # The same bound for the coroutines, as (event loop, semaphore) created in the loop using it
+        self._async_pending = None
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+
+    def _get_executor(self):
+        # The pool is created on first use, and again in a forked child, which can't use its parent's
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                # spawn: forking a threaded app server may copy locks held by other threads
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.pool_size, mp_context=multiprocessing.get_context('spawn'))
+                self._executor_pid = os.getpid()
+            return self._executor
+
+
+    def _run(self, function, *args):
+        if self.pool_size == 0:
+            return function(*args)
+
+        with self._pending:
+            return self._get_executor().submit(function, *args).result()
+
+
+    async def _run_async(self, function, *args):
+        loop = asyncio.get_running_loop()
+        if self.pool_size == 0:
+            # Still off the event loop, on its default thread pool
+            return await loop.run_in_executor(None, function, *args)
+
+        if self._async_pending is None or self._async_pending[0] is not loop:
+            self._async_pending = (loop, asyncio.Semaphore(self.max_pending))
+        async with self._async_pending[1]:
+            return await asyncio.wrap_future(self._get_executor().submit(function, *args))
+
+
+    def hash(self, password):
+        """
+        :return: the hash of the password, using the configured method and cost
+        """
+        return self._run(generate_password_hash, password, self.method)
+
+
+    def check(self, pw_hash, password):
+        """
+        :return: Whether the password matches the hash
+        """
+        return self._run(check_password_hash, pw_hash, password)
+
+
+    async def hash_async(self, password):
+        """
+        :return: the hash of the password, awaited without blocking the event loop
+        """
+        return await self._run_async(generate_password_hash, password, self.method)
+
+
+    async def check_async(self, pw_hash, password):
+        """
+        :return: Whether the password matches the hash, awaited without blocking the event loop
+        """
+        return await self._run_async(check_password_hash, pw_hash, password)
+
+
+    @staticmethod
+    def parse_method(method):
+        """
+        :return: the (algorithm, parameters, cost) of a werkzeug hash method, with werkzeug's defaults filled in,
+        or None if it is not one werkzeug makes
+        """
+        algorithm, *args = method.split(':')
+        try:
+            if algorithm == 'scrypt':
+                cost, block_size, parallelism = [int(arg) for arg in args] or DEFAULT_SCRYPT_COST
+                return algorithm, (block_size, parallelism), cost
+            if algorithm == 'pbkdf2':
+                hash_name = args[0] if args else 'sha256'
+                iterations = int(args[1]) if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+                return algorithm, (hash_name,), iterations
+        except ValueError:
+            pass
+        return None
+
+
+    def needs_rehash(self, pw_hash):
+        """
+        :return: Whether the hash was made with another algorithm or parameters than the configured method,
+        or with a lower cost. Hashes costlier than the configured method are kept.
+        """
+        stored = PasswordHasher.parse_method(pw_hash.split('$', 1)[0])
+        configured = PasswordHasher.parse_method(self.method)
+        if stored is None or configured is None:
+            return stored != configured
+        return stored[:2] != configured[:2] or stored[2] < configured[2]
+
+
+    def shutdown(self):
+        """
+        Stops the worker processes, a new pool is created on the next use
+        """
+        with self._lock:
+            if self._executor is not None and self._executor_pid == os.getpid():
+                self._executor.shutdown()
+            self._executor = None
@@ -0,0 +1,163 @@
+from collections import OrderedDict
+import threading
+import time
+
+# All the caches created in the process, by name, so that /admin can report them
+CACHES = {}
+
+_MISSING = object()
+
+
+class TtlCache:
+    """Implements a thread-safe, size-bounded LRU cache whose entries expire after a TTL"""
+
+    def __init__(self, name, maxsize, ttl):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # The lock of each key being loaded, with the number of threads holding or awaiting it
+        self._loading = {}
+        # Bumped by every invalidation, so that a load racing with a write is not cached
+        self._generation = 0
+        CACHES[name] = self
+
+
+    def get(self, key, default=None):
+        """
+        :return: the cached value for the key, or the default if it is missing or expired
+        """
+        value = self._lookup(key)
+        with self._lock:
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return _MISSING
+
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.evictions += 1
+                return _MISSING
+
+            self._entries.move_to_end(key)
+            return value
+
+
+    def put(self, key, value, generation=None):
+        """
+        Caches the value, evicting the least recently used entry when full. The value is dropped if
+        the cache was invalidated since the given generation was read.
+        """
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+
+    def get_or_load(self, key, loader):
+        """
+        :return: the cached value for the key, calling loader() to fill it on a miss. Concurrent misses
+        for the same key wait for a single load instead of all going to the backend, while the misses for
+        other keys load in parallel.
+        """
+        value = self._lookup(key)
+        if value is not _MISSING:
+            with self._lock:
+                self.hits += 1
+            return value
+
+        with self._lock:
+            loading = self._loading.setdefault(key, [threading.Lock(), 0])
+            loading[1] += 1
+        try:
+            with loading[0]:
+                # Another thread may have loaded it while we waited
+                value = self._lookup(key)
+                with self._lock:
+                    if value is not _MISSING:
+                        self.hits += 1
+                        return value
+                    self.misses += 1
+                    generation = self._generation
+
+                value = loader()
+                self.put(key, value, generation)
+                return value
+        finally:
+            with self._lock:
+                loading[1] -= 1
+                if not loading[1]:
+                    del self._loading[key]
+
+
+    async def get_or_load_async(self, key, loader):
+        """
+        :return: the cached value for the key, awaiting loader() to fill it on a miss. Concurrent misses are not
+        coalesced, the event loop serving them is never blocked on a lock.
+        """
+        value = self._lookup(key)
+        with self._lock:
+            if value is not _MISSING:
+                self.hits += 1
+                return value
+            self.misses += 1
+            generation = self._generation
+
+        value = await loader()
+        self.put(key, value, generation)
+        return value
+
+
+    def invalidate(self, key=None):
+        """
+        Drops the entry for the key, or every entry if no key is given.
+        """
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+    def stats(self):
+        """
+        :return: the counters and the occupancy of the cache
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+def invalidate_all_caches():
+    """Drops the entries of every cache, for instance when the database is re-initialized"""
+    for cache in CACHES.values():
+        cache.invalidate()
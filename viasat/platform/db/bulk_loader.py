@@ -0,0 +1,65 @@
+import itertools
+
+from sqlalchemy.sql import text
+
+
+class BulkLoader:
+    """Implements bulk loading of rows into a table with multi-row inserts and periodic commits"""
+
+    # sqlite before 3.32 accepts at most 999 bound parameters per statement
+    MAX_PARAMETERS = 999
+
+    def __init__(self, conn, table, columns, commit_every=50000):
+        """
+        :param conn: the SQLAlchemy connection, not in a transaction
+        :param columns: the columns of the rows, in order
+        :param commit_every: number of rows committed at a time
+        """
+        self.conn = conn
+        self.table = table
+        self.columns = tuple(columns)
+        self.commit_every = commit_every
+        self.rows_per_statement = max(1, BulkLoader.MAX_PARAMETERS // len(self.columns))
+        self._statements = {}
+
+
+    def _statement(self, row_count):
+        # The statement of a full batch is built once and reused
+        if row_count not in self._statements:
+            values = ', '.join(
+                '(' + ', '.join(':p{}'.format(row * len(self.columns) + column)
+                                for column in range(len(self.columns))) + ')'
+                for row in range(row_count))
+            self._statements[row_count] = text('insert into {} ({}) values {}'.format(
+                self.table, ', '.join(self.columns), values))
+        return self._statements[row_count]
+
+
+    def load(self, rows):
+        """
+        Inserts the rows, tuples in the order of the columns, from any iterable
+        :return: the number of rows inserted
+        """
+        rows = iter(rows)
+        loaded = 0
+        transaction = self.conn.begin()
+        try:
+            while True:
+                batch = list(itertools.islice(rows, self.rows_per_statement))
+                if not batch:
+                    break
+
+                self.conn.execute(self._statement(len(batch)), {
+                    'p{}'.format(index): value for index, value in enumerate(itertools.chain.from_iterable(batch))})
+
+                previous, loaded = loaded, loaded + len(batch)
+                if loaded // self.commit_every != previous // self.commit_every:
+                    transaction.commit()
+                    transaction = self.conn.begin()
+
+            transaction.commit()
+        except Exception:  #pylint: disable=broad-except
+            transaction.rollback()
+            raise
+
+        return loaded
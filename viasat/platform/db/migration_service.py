@@ -0,0 +1,113 @@
+import os
+import re
+import time
+
+from sqlalchemy.sql import text
+
+
+class MigrationService:
+    """Implements versioned, in-place schema migrations"""
+
+    # Keeps track of which migrations have been applied to the database
+    VERSION_TABLE = 'schema_version'
+
+    # Migration scripts are named <version>_<name>.sql, for instance 0001_timeline_indexes.sql
+    SCRIPT_NAME_PATTERN = re.compile(r'^(\d+)_(\w+)\.sql$')
+
+
+    # What the splitter looks at: the quoted strings and comments to skip, the block keywords and the semicolons
+    SQL_TOKEN_PATTERN = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?\*/|\b(?:begin|case|end)\b|;",
+                                   re.IGNORECASE | re.DOTALL)
+
+    # The statements whose body is a begin ... end block of statements
+    BLOCK_STATEMENT_PATTERN = re.compile(r'^(?:\s|--[^\n]*|/\*.*?\*/)*create\s+(?:temp\s+|temporary\s+)?trigger\b',
+                                         re.IGNORECASE | re.DOTALL)
+
+
+    @staticmethod
+    def split_statements(script):
+        """
+        :return: the list of non-empty statements from a sql script, split on the ';' outside of the quoted strings,
+        the comments and the begin ... end body of the triggers
+        """
+        statements = []
+        start = 0
+        depth = 0
+        for match in MigrationService.SQL_TOKEN_PATTERN.finditer(script):
+            token = match.group(0).lower()
+            if token == ';':
+                if depth == 0:
+                    statements.append(script[start:match.end() - 1])
+                    start = match.end()
+            elif token in ('begin', 'case'):
+                # A case expression ends with end too, but only counts inside of a trigger
+                if token == 'case' and depth > 0 or \
+                        token == 'begin' and MigrationService.BLOCK_STATEMENT_PATTERN.match(script[start:]):
+                    depth += 1
+            elif token == 'end' and depth > 0:
+                depth -= 1
+        statements.append(script[start:])
+
+        return [statement.strip() for statement in statements if len(statement.strip()) > 0]
+
+
+    @staticmethod
+    def list_migrations(migrations_dir, db_type):
+        """
+        :return: the sorted list of (version, name, path) of the migration scripts for the given db type
+        """
+        scripts_dir = os.path.join(migrations_dir, db_type)
+        migrations = []
+        for file_name in os.listdir(scripts_dir):
+            match = MigrationService.SCRIPT_NAME_PATTERN.match(file_name)
+            if match:
+                migrations.append((int(match.group(1)), match.group(2), os.path.join(scripts_dir, file_name)))
+
+        return sorted(migrations)
+
+
+    @staticmethod
+    def get_current_version(conn):
+        """
+        :return: the latest migration version applied to the database, 0 when none has been applied
+        """
+        conn.execute(text('''create table if not exists {} (
+            version integer primary key,
+            name varchar(255) not null,
+            applied_at integer not null)'''.format(MigrationService.VERSION_TABLE)))
+
+        version = conn.execute(text('select max(version) from {}'.format(MigrationService.VERSION_TABLE))).scalar()
+        return version or 0
+
+
+    @staticmethod
+    def migrate(app, conn, db_type, migrations_dir, target_version=None):
+        """
+        Applies, in order, every migration newer than the current version of the database, up to target_version.
+        Each migration and its version record are committed together. Note that MySQL commits DDL implicitly.
+        :return: the list of (version, name) applied
+        """
+        current_version = MigrationService.get_current_version(conn)
+        app.logger.info("Database schema is at version %d", current_version)
+
+        applied = []
+        for version, name, path in MigrationService.list_migrations(migrations_dir, db_type):
+            if version <= current_version or (target_version is not None and version > target_version):
+                continue
+
+            app.logger.info("Applying migration %04d_%s", version, name)
+            with open(path, mode='r') as script:
+                statements = MigrationService.split_statements(script.read())
+
+            with conn.begin():
+                for statement in statements:
+                    conn.execute(text(statement))
+
+                conn.execute(
+                    text('insert into {} (version, name, applied_at) values (:version, :name, :applied_at)'.format(
+                        MigrationService.VERSION_TABLE)),
+                    dict(version=version, name=name, applied_at=int(time.time())))
+
+            applied.append((version, name))
+
+        return applied
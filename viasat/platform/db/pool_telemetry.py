@@ -0,0 +1,95 @@
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from viasat.platform.observability.histogram import Histogram
+
+# The telemetry of every engine pool in the process, by name, so that /admin can report them
+POOLS = {}
+
+
+class PoolTelemetry:
+    """Implements the checkout telemetry of the connection pool of a SQLAlchemy engine"""
+
+    def __init__(self, name, engine):
+        self.name = name
+        self.engine = engine
+        self.checkout_latency = Histogram()
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidations = 0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+        event.listen(engine, 'connect', self._on_connect)
+        event.listen(engine, 'checkout', self._on_checkout)
+        event.listen(engine, 'checkin', self._on_checkin)
+        event.listen(engine, 'invalidate', self._on_invalidate)
+        POOLS[name] = self
+
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+    def _on_connect(self, _dbapi_connection, _connection_record):
+        self._count('connects')
+
+
+    def _on_checkout(self, _dbapi_connection, _connection_record, _connection_proxy):
+        self._count('checkouts')
+
+
+    def _on_checkin(self, _dbapi_connection, _connection_record):
+        self._count('checkins')
+
+
+    def _on_invalidate(self, _dbapi_connection, _connection_record, _exception):
+        self._count('invalidations')
+
+
+    def connect(self):
+        """
+        :return: a connection from the engine, recording how long the checkout took, including the time
+        spent waiting for a free connection, the pre-ping and any new connection
+        """
+        start = time.perf_counter()
+        try:
+            return self.engine.connect()
+        except PoolTimeoutError:
+            self._count('timeouts')
+            raise
+        finally:
+            self.checkout_latency.observe((time.perf_counter() - start) * 1000)
+
+
+    def stats(self):
+        """
+        :return: the pool occupancy, the event counters and the checkout latency histogram in milliseconds
+        """
+        pool = self.engine.pool
+        stats = {"pool": pool.__class__.__name__, "status": pool.status()}
+
+        # Only the queue pools have a size, the others open a connection per checkout
+        if hasattr(pool, 'checkedout'):
+            stats.update({
+                "size": pool.size(),
+                "checked_in": pool.checkedin(),
+                "checked_out": pool.checkedout(),
+                "overflow": pool.overflow(),
+            })
+
+        with self._lock:
+            stats.update({
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "invalidations": self.invalidations,
+                "timeouts": self.timeouts,
+            })
+        stats["checkout_latency_ms"] = self.checkout_latency.snapshot()
+        return stats
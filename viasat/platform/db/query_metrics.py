@@ -0,0 +1,57 @@
+import time
+
+from sqlalchemy import event
+
+from viasat.platform.observability.metrics import METRICS
+
+QUERIES_METRIC = 'minitwit_db_queries_total'
+QUERY_DURATION_METRIC = 'minitwit_db_query_duration_seconds'
+
+
+class QueryMetrics:
+    """Implements the count and duration metrics of the statements run on a SQLAlchemy engine, by operation"""
+
+    def __init__(self, name, engine, registry=METRICS):
+        self.name = name
+        self.registry = registry
+
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        event.listen(engine, 'handle_error', self._handle_error)
+
+
+    @staticmethod
+    def declare(registry=METRICS):
+        """Declares the metrics, once for every engine"""
+        registry.counter(QUERIES_METRIC, 'Statements run on the database, by engine, operation and outcome.')
+        registry.histogram(QUERY_DURATION_METRIC, 'Duration of the statements run on the database, in seconds.')
+
+
+    @staticmethod
+    def operation(statement):
+        """
+        :return: the lower-cased first keyword of the statement, e.g. select
+        """
+        words = statement.lstrip().split(None, 1)
+        return words[0].lower() if words else 'unknown'
+
+
+    def _before_cursor_execute(self, conn, _cursor, _statement, _parameters, _context, _executemany):
+        # The connection info is per connection, so nested or concurrent statements do not mix
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+    def _after_cursor_execute(self, conn, _cursor, statement, _parameters, _context, _executemany):
+        self._record(conn, statement, 'ok')
+
+
+    def _handle_error(self, context):
+        if context.connection is not None and context.connection.info.get('query_start'):
+            self._record(context.connection, context.statement or '', 'error')
+
+
+    def _record(self, conn, statement, outcome):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        operation = QueryMetrics.operation(statement)
+        self.registry.inc(QUERIES_METRIC, {'engine': self.name, 'operation': operation, 'outcome': outcome})
+        self.registry.observe(QUERY_DURATION_METRIC, elapsed, {'engine': self.name, 'operation': operation})
@@ -0,0 +1,65 @@
+from sqlalchemy.sql import text
+
+
+class QueryPlanService:
+    """Inspects the database query plans to find statements that need indexes"""
+
+    @staticmethod
+    def explain(conn, db_type, query, args=None):
+        """
+        :return: the list of plan steps for the query, as plain strings
+        """
+        prefix = 'explain query plan ' if db_type == 'sqlite' else 'explain '
+        return QueryPlanService.plan_steps(db_type, conn.execute(text(prefix + query), **(args or {})))
+
+
+    @staticmethod
+    def explain_statement(conn, db_type, statement, parameters=()):
+        """
+        :return: the list of plan steps for a statement as sent to the driver, with its driver parameters
+        """
+        prefix = 'explain query plan ' if db_type == 'sqlite' else 'explain '
+        # SQLAlchemy 1.3 runs plain strings as driver sql, 1.4 has a method for it
+        execute = getattr(conn, 'exec_driver_sql', conn.execute)
+        return QueryPlanService.plan_steps(db_type, execute(prefix + statement, parameters))
+
+
+    @staticmethod
+    def plan_steps(db_type, rows):
+        """
+        :return: the plan steps of the rows of an explain, as plain strings
+        """
+        if db_type == 'sqlite':
+            return [row['detail'] for row in rows]
+
+        return ['{} type={} key={}'.format(row['table'], row['type'], row['key']) for row in rows]
+
+
+    @staticmethod
+    def is_full_scan(db_type, step):
+        """
+        :return: Whether the plan step reads a whole table instead of using an index
+        """
+        if db_type == 'sqlite':
+            # e.g. "SCAN message" is a full scan while "SCAN message USING INDEX message_pub_date" is not,
+            # nor is the single row of a select without a table
+            return step.startswith('SCAN ') and ' USING ' not in step and step != 'SCAN CONSTANT ROW'
+
+        # MySQL reports full table scans as the access type ALL
+        return ' type=ALL ' in step
+
+
+    @staticmethod
+    def find_full_scans(conn, db_type, queries):
+        """
+        :param queries: dict of name -> (query, args)
+        :return: dict of name -> list of plan steps that are full table scans, only for the offending queries
+        """
+        offenders = {}
+        for name, (query, args) in queries.items():
+            full_scans = [step for step in QueryPlanService.explain(conn, db_type, query, args)
+                          if QueryPlanService.is_full_scan(db_type, step)]
+            if full_scans:
+                offenders[name] = full_scans
+
+        return offenders
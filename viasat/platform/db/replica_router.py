@@ -0,0 +1,69 @@
+import threading
+import time
+
+from sqlalchemy.exc import DBAPIError
+
+from viasat.platform.db.pool_telemetry import PoolTelemetry
+
+# The replica routers of the process, by name, so that /admin can report them
+ROUTERS = {}
+
+
+class ReplicaRouter:
+    """Implements health-aware round robin over the engines of the read replicas"""
+
+    def __init__(self, name, engines, retry_after=30):
+        """
+        :param engines: the SQLAlchemy engines of the replicas
+        :param retry_after: seconds a failed replica is left out of the rotation
+        """
+        self.name = name
+        self.retry_after = retry_after
+        self.replicas = [PoolTelemetry('{}-{}'.format(name, index), engine) for index, engine in enumerate(engines)]
+        self._down_until = {replica.name: 0 for replica in self.replicas}
+        self._next = 0
+        self._lock = threading.Lock()
+        ROUTERS[name] = self
+
+
+    def _candidates(self):
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % max(1, len(self.replicas))
+            now = time.monotonic()
+            rotation = self.replicas[start:] + self.replicas[:start]
+            return [replica for replica in rotation if self._down_until[replica.name] <= now]
+
+
+    def connect(self):
+        """
+        :return: the (name, connection) of the next healthy replica, or (None, None) if none is available
+        """
+        for replica in self._candidates():
+            try:
+                return replica.name, replica.connect()
+            except DBAPIError:
+                self.mark_down(replica.name)
+
+        return None, None
+
+
+    def mark_down(self, name):
+        """
+        Leaves the replica out of the rotation for retry_after seconds
+        """
+        with self._lock:
+            self._down_until[name] = time.monotonic() + self.retry_after
+
+
+    def stats(self):
+        """
+        :return: the health and pool telemetry of each replica
+        """
+        now = time.monotonic()
+        with self._lock:
+            down_until = dict(self._down_until)
+
+        return {replica.name: dict(replica.stats(), healthy=down_until[replica.name] <= now,
+                                   retry_in=round(max(0, down_until[replica.name] - now), 3))
+                for replica in self.replicas}
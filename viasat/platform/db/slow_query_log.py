@@ -0,0 +1,202 @@
+from collections import OrderedDict, deque
+import os
+import queue
+import re
+import threading
+import time
+
+from sqlalchemy import event
+
+from viasat.platform.db.query_plan_service import QueryPlanService
+
+# The slow query logs of the process, by name, so that /admin can report them
+SLOW_QUERY_LOGS = {}
+
+_WHITESPACE = re.compile(r'\s+')
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+class SlowQueryLog:
+    """Implements a log of the statements slower than a threshold, keeping the most recent ones in a ring
+    buffer along with the query plan of each distinct statement. The statements are timed from the cursor
+    events of the watched engines, and explained on a connection of their own by a background thread, so that
+    neither the slow request nor its transaction wait for the plan."""
+
+    # Distinct statements whose plan is kept, the statements of the app are a handful
+    MAX_PLANS = 1000
+
+    # Statements waiting to be explained, more new slow statements than that are explained when seen again
+    MAX_PENDING_PLANS = 100
+
+
+    def __init__(self, name, threshold_ms, size, logger, get_route=lambda: None):
+        """
+        :param threshold_ms: statements taking longer are logged, None disables the log
+        :param size: number of recent slow statements kept
+        :param get_route: returns what ran the statement, e.g. the Flask endpoint
+        """
+        self.name = name
+        self.threshold_ms = threshold_ms
+        self.logger = logger
+        self.get_route = get_route
+        self.recorded = 0
+        self._entries = deque(maxlen=size)
+        # statement -> plan, or None while it is being explained
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending = queue.Queue(SlowQueryLog.MAX_PENDING_PLANS)
+        self._explainer = None
+        self._explainer_pid = None
+        # watched engine -> the engine explaining its statements
+        self._explain_engines = {}
+        SLOW_QUERY_LOGS[name] = self
+
+
+    def watch(self, engine, explain_engine=None):
+        """
+        Times the statements run on the engine, whatever runs them
+        :param explain_engine: explains them instead of the engine, e.g. the sync engine of an async one
+        """
+        self._explain_engines[engine] = explain_engine or engine
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+
+    @staticmethod
+    def normalize(query):
+        """
+        :return: the statement on one line, with its literals replaced by ?
+        """
+        return _LITERALS.sub('?', _WHITESPACE.sub(' ', query).strip())
+
+
+    @staticmethod
+    def parameter_shapes(parameters):
+        """
+        :return: the type of each bound parameter, and the length of strings, without their values.
+        Only the first row of an executemany is described.
+        """
+        if isinstance(parameters, (list, tuple)) and parameters and isinstance(parameters[0], (dict, list, tuple)):
+            parameters = parameters[0]
+
+        def shape(value):
+            if isinstance(value, (str, bytes)):
+                return '{}({})'.format(type(value).__name__, len(value))
+            return type(value).__name__
+
+        if isinstance(parameters, dict):
+            return {name: shape(value) for name, value in parameters.items()}
+        return [shape(value) for value in parameters or ()]
+
+
+    def is_slow(self, duration_ms):
+        """
+        :return: Whether a statement that took this long must be recorded
+        """
+        return self.threshold_ms is not None and duration_ms >= self.threshold_ms
+
+
+    def _before_cursor_execute(self, conn, _cursor, _statement, _parameters, _context, _executemany):
+        conn.info.setdefault('slow_query_start', []).append(time.perf_counter())
+
+
+    def _after_cursor_execute(self, conn, _cursor, statement, parameters, _context, executemany):
+        duration_ms = (time.perf_counter() - conn.info['slow_query_start'].pop()) * 1000
+        # The explains of the log are not logged themselves
+        if self.is_slow(duration_ms) and threading.current_thread() is not self._explainer:
+            self.record(self._explain_engines.get(conn.engine, conn.engine), statement, parameters, duration_ms,
+                        self.get_route(), executemany)
+
+
+    def record(self, engine, statement, parameters, duration_ms, route, executemany=False):
+        """
+        Logs the statement, and has it explained on the engine the first time it is seen
+        """
+        normalized = SlowQueryLog.normalize(statement)
+        entry = {
+            "timestamp": int(time.time()),
+            "duration_ms": round(duration_ms, 3),
+            "statement": normalized,
+            "parameters": SlowQueryLog.parameter_shapes(parameters),
+            "route": route,
+        }
+
+        with self._lock:
+            self._entries.append(entry)
+            self.recorded += 1
+            # The slot is taken before explaining, so that a statement is explained once
+            new_statement = normalized not in self._plans
+            if new_statement:
+                self._plans[normalized] = None
+                while len(self._plans) > SlowQueryLog.MAX_PLANS:
+                    self._plans.popitem(last=False)
+            else:
+                self._plans.move_to_end(normalized)
+
+        self.logger.warning("Slow query took %.1f ms on %s: %s parameters=%s",
+                            duration_ms, route, normalized, entry["parameters"])
+
+        if new_statement:
+            first_parameters = parameters[0] if executemany and parameters else parameters
+            try:
+                self._pending.put_nowait((engine, normalized, statement, first_parameters))
+                self._start_explainer()
+            except queue.Full:
+                with self._lock:
+                    self._plans.pop(normalized, None)
+
+
+    def _start_explainer(self):
+        # Started on first use, and again in a forked child, which doesn't have its parent's threads
+        with self._lock:
+            if self._explainer is None or self._explainer_pid != os.getpid():
+                self._explainer = threading.Thread(target=self._explain_pending, name='slow-query-explainer',
+                                                   daemon=True)
+                self._explainer_pid = os.getpid()
+                self._explainer.start()
+
+
+    def _explain_pending(self):
+        while True:
+            engine, normalized, statement, parameters = self._pending.get()
+            try:
+                plan = self._explain(engine, statement, parameters)
+                with self._lock:
+                    if normalized in self._plans:
+                        self._plans[normalized] = plan
+                self.logger.warning("Plan of the slow query %s: %s", normalized, plan)
+            finally:
+                self._pending.task_done()
+
+
+    @staticmethod
+    def _explain(engine, statement, parameters):
+        db_type = engine.dialect.name
+        try:
+            with engine.connect() as conn:
+                steps = QueryPlanService.explain_statement(conn, db_type, statement, parameters)
+            return {"steps": steps,
+                    "full_scan": any(QueryPlanService.is_full_scan(db_type, step) for step in steps)}
+        except Exception as error:  #pylint: disable=broad-except
+            # Some statements can't be explained, e.g. DDL, but they are still worth logging
+            return {"error": str(error).split('\n', 1)[0]}
+
+
+    def wait_for_plans(self):
+        """Waits until the pending statements are explained"""
+        self._pending.join()
+
+
+    def stats(self):
+        """
+        :return: the threshold and the recent slow statements with their plans, the newest first
+        """
+        with self._lock:
+            return {
+                "threshold_ms": self.threshold_ms,
+                "size": self._entries.maxlen,
+                "recorded": self.recorded,
+                "pending_plans": self._pending.qsize(),
+                "entries": [dict(entry, plan=self._plans.get(entry["statement"]))
+                            for entry in reversed(self._entries)],
+            }
@@ -1,5 +1,5 @@
 # https://stackoverflow.com/questions/18214612/how-to-access-app-config-in-a-blueprint/38262792#38262792
-from flask import Blueprint, current_app as app
+from flask import Blueprint, current_app as app, request
 import os
 import json
 
@@ -7,6 +7,11 @@ admin_api = Blueprint('admin_api', __name__, url_prefix='/admin')
 
 from viasat.platform.core.http_auth_basic import auth
 from viasat.platform.cloud.config_service import ConfigService
+from viasat.platform.core.ttl_cache import CACHES
+from viasat.platform.db.pool_telemetry import POOLS
+from viasat.platform.db.replica_router import ROUTERS
+from viasat.platform.db.slow_query_log import SLOW_QUERY_LOGS
+from viasat.platform.observability.profiler import PROFILER, ProfilerBusy, StackProfiler
 
 @admin_api.route('/env')
 @auth.login_required
@@ -55,4 +60,82 @@ def admin_endpoints():
     endpoints = ConfigService.get_current_endpoints(app)
     endpoints_json = json.dumps(endpoints, default=str)
 
-    return endpoints_json, 200, {'content-type':'application/json'}
\ No newline at end of file
+    return endpoints_json, 200, {'content-type':'application/json'}
+
+
+@admin_api.route('/caches')
+@auth.login_required
+def admin_caches():
+    """
+    :return: Show the hit, miss and eviction counters of the in-process caches
+    """
+    caches_json = json.dumps({name: cache.stats() for name, cache in CACHES.items()})
+
+    return caches_json, 200, {'content-type':'application/json'}
+
+
+@admin_api.route('/db/pool')
+@auth.login_required
+def admin_db_pool():
+    """
+    :return: Show the connection pools occupancy, counters and checkout latency histograms
+    """
+    pools_json = json.dumps({name: pool.stats() for name, pool in POOLS.items()})
+
+    return pools_json, 200, {'content-type':'application/json'}
+
+
+@admin_api.route('/db/replicas')
+@auth.login_required
+def admin_db_replicas():
+    """
+    :return: Show the health of the read replicas, with their pool telemetry
+    """
+    replicas_json = json.dumps({name: router.stats() for name, router in ROUTERS.items()})
+
+    return replicas_json, 200, {'content-type':'application/json'}
+
+
+@admin_api.route('/db/slow-queries')
+@auth.login_required
+def admin_db_slow_queries():
+    """
+    :return: Show the most recent statements slower than the threshold, with their query plans
+    """
+    slow_queries_json = json.dumps({name: log.stats() for name, log in SLOW_QUERY_LOGS.items()})
+
+    return slow_queries_json, 200, {'content-type':'application/json'}
+
+
+@admin_api.route('/profile')
+@auth.login_required
+def admin_profile():
+    """
+    :return: Samples the stacks of the requests served over the next ?seconds=N, or only of the next ?requests=K to
+    ?endpoint=E, and shows the ?top=N functions with the collapsed stacks, or only the stacks with ?format=collapsed
+    """
+    seconds = max(0, min(request.args.get('seconds', 10, type=float), app.config['PROFILE_MAX_SECONDS']))
+    endpoint = request.args.get('endpoint')
+    if endpoint is not None and endpoint not in app.view_functions:
+        return json.dumps({"error": "Unknown endpoint: {}".format(endpoint)}), 400, {'content-type':'application/json'}
+
+    try:
+        stacks, profiled = PROFILER.profile(app._get_current_object(), seconds, endpoint,  #pylint: disable=protected-access
+                                            request.args.get('requests', type=int))
+    except ProfilerBusy as error:
+        return json.dumps({"error": str(error)}), 409, {'content-type':'application/json'}
+
+    if request.args.get('format') == 'collapsed':
+        return StackProfiler.render_collapsed(stacks), 200, {'content-type':'text/plain'}
+
+    profile_json = json.dumps({
+        "seconds": seconds,
+        "endpoint": endpoint,
+        "requests": profiled,
+        "interval_ms": PROFILER.interval * 1000,
+        "samples": sum(stacks.values()),
+        "top": StackProfiler.top_functions(stacks, request.args.get('top', 20, type=int)),
+        "collapsed": StackProfiler.render_collapsed(stacks),
+    })
+
+    return profile_json, 200, {'content-type':'application/json'}
@@ -0,0 +1,44 @@
+import bisect
+import threading
+
+
+class Histogram:
+    """Implements a thread-safe histogram with fixed upper bounds, Prometheus style"""
+
+    # Upper bounds in milliseconds, suitable for latencies
+    DEFAULT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+
+    def observe(self, value):
+        """
+        Records a value in the first bucket whose upper bound is greater than or equal to it
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._max = max(self._max, value)
+
+
+    def snapshot(self):
+        """
+        :return: the count, sum, max and cumulative bucket counts keyed by upper bound
+        """
+        with self._lock:
+            counts = list(self._counts)
+            total, maximum = self._sum, self._max
+
+        cumulative = {}
+        running = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], counts):
+            running += count
+            cumulative[str(bound)] = running
+
+        return {"count": running, "sum": round(total, 3), "max": round(maximum, 3), "buckets": cumulative}
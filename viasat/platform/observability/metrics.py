@@ -0,0 +1,172 @@
+import bisect
+import threading
+import weakref
+
+# Upper bounds in seconds, the Prometheus client defaults
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+
+class _Shard:
+    """The metrics recorded by a single thread, only ever written by that thread"""
+
+    def __init__(self):
+        # (name, labels) -> value
+        self.counters = {}
+        # (name, labels) -> [count per bucket..., count above the last bucket, sum]
+        self.histograms = {}
+
+
+class _ShardOwner:
+    """Kept in the thread-local storage only, so that it goes away when its thread ends"""
+
+    def __init__(self, shard):
+        self.shard = shard
+
+
+class MetricsRegistry:
+    """Implements counters and histograms in the Prometheus text format. Every thread records into its own
+    shard without taking a lock, and the shards are only merged when the metrics are scraped. The shard of a
+    thread that ends is folded right away, so that a thread per request does not pile them up."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._gauge_callbacks = {}
+        self._local = threading.local()
+        # Reentrant, as a thread may end, and fold its shard, while the collecting thread holds it
+        self._lock = threading.RLock()
+        self._shards = []
+        # Where the shards of the threads that ended are folded, so that their counts are kept
+        self._retired = _Shard()
+
+
+    def counter(self, name, documentation):
+        """Declares a counter, which only goes up"""
+        self._metrics[name] = ('counter', documentation, None)
+
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        """Declares a histogram with fixed upper bounds"""
+        self._metrics[name] = ('histogram', documentation, tuple(buckets))
+
+
+    def gauge(self, name, documentation, callback):
+        """Declares a gauge read at scrape time. callback() returns a list of (labels dict, value)"""
+        self._metrics[name] = ('gauge', documentation, None)
+        self._gauge_callbacks[name] = callback
+
+
+    def _shard(self):
+        owner = getattr(self._local, 'owner', None)
+        if owner is None:
+            owner = self._local.owner = _ShardOwner(_Shard())
+            # The thread-local storage of a thread is dropped when it ends, and the owner with it
+            weakref.finalize(owner, self._retire, owner.shard)
+            with self._lock:
+                self._shards.append(owner.shard)
+        return owner.shard
+
+
+    def _retire(self, shard):
+        # The thread that wrote the shard has ended, so it can be folded safely
+        with self._lock:
+            _merge(self._retired, shard.counters, shard.histograms)
+            self._shards.remove(shard)
+
+
+    def inc(self, name, labels=None, value=1):
+        """Adds the value to the counter with the given labels"""
+        key = (name, _label_key(labels))
+        counters = self._shard().counters
+        counters[key] = counters.get(key, 0) + value
+
+
+    def observe(self, name, value, labels=None):
+        """Records the value in the histogram with the given labels"""
+        key = (name, _label_key(labels))
+        histograms = self._shard().histograms
+        slots = histograms.get(key)
+        if slots is None:
+            buckets = self._metrics[name][2]
+            slots = histograms[key] = [0] * (len(buckets) + 2)
+        slots[bisect.bisect_left(self._metrics[name][2], value)] += 1
+        slots[-1] += value
+
+
+    def collect(self):
+        """
+        :return: the counters and histograms of every thread merged, as two dicts keyed by (name, labels)
+        """
+        with self._lock:
+            merged = _Shard()
+            _merge(merged, self._retired.counters, self._retired.histograms)
+            for shard in list(self._shards):
+                # Copying is atomic, while the owner thread may be adding keys
+                _merge(merged, dict(shard.counters), dict(shard.histograms))
+
+        return merged.counters, merged.histograms
+
+
+    def render(self):
+        """
+        :return: every metric in the Prometheus text exposition format, version 0.0.4
+        """
+        counters, histograms = self.collect()
+        lines = []
+        for name in sorted(self._metrics):
+            kind, documentation, buckets = self._metrics[name]
+            lines.append('# HELP {} {}'.format(name, documentation))
+            lines.append('# TYPE {} {}'.format(name, kind))
+
+            if kind == 'counter':
+                for (_, labels), value in sorted(item for item in counters.items() if item[0][0] == name):
+                    lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+
+            elif kind == 'gauge':
+                values = {_label_key(labels): value for labels, value in self._gauge_callbacks[name]()}
+                for labels, value in sorted(values.items()):
+                    lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+
+            else:
+                for (_, labels), slots in sorted(item for item in histograms.items() if item[0][0] == name):
+                    running = 0
+                    for bound, count in zip(list(buckets) + ['+Inf'], slots[:-1]):
+                        running += count
+                        lines.append('{}_bucket{} {}'.format(
+                            name, _format_labels(labels + (('le', _format_value(bound)),)), running))
+                    lines.append('{}_sum{} {}'.format(name, _format_labels(labels), _format_value(slots[-1])))
+                    lines.append('{}_count{} {}'.format(name, _format_labels(labels), running))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _label_key(labels):
+    return tuple(sorted((labels or {}).items()))
+
+
+def _merge(target, counters, histograms):
+    for key, value in counters.items():
+        target.counters[key] = target.counters.get(key, 0) + value
+    for key, slots in histograms.items():
+        merged = target.histograms.setdefault(key, [0] * len(slots))
+        for index, value in enumerate(list(slots)):
+            merged[index] += value
+
+
+def _format_value(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+# The metrics of the process, reported on /metrics
+METRICS = MetricsRegistry()
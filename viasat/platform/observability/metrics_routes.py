@@ -0,0 +1,15 @@
+from flask import Blueprint
+
+from viasat.platform.core.http_auth_basic import auth
+from viasat.platform.observability.metrics import METRICS
+
+metrics_api = Blueprint('metrics_api', __name__)
+
+
+@metrics_api.route('/metrics')
+@auth.login_required
+def metrics():
+    """
+    :return: The request, database, pool and template metrics of the process in the Prometheus text format
+    """
+    return METRICS.render(), 200, {'content-type': 'text/plain; version=0.0.4; charset=utf-8'}
@@ -0,0 +1,147 @@
+from collections import Counter
+import os
+import sys
+import threading
+import time
+
+from flask import request, request_finished, request_started
+
+# Seconds between two samples of the stacks
+DEFAULT_INTERVAL = 0.005
+
+
+class ProfilerBusy(Exception):
+    """Raised when a profile is asked for while another one runs"""
+
+
+class _Session:
+    """The requests of one profile, tracked through the Flask request signals while it runs"""
+
+    def __init__(self, endpoint, max_requests):
+        self.endpoint = endpoint
+        self.remaining = max_requests
+        self.profiled = 0
+        # thread id -> the endpoint it is serving
+        self.active = {}
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+
+    def started(self, _sender, **_extra):
+        if self.endpoint is not None and request.endpoint != self.endpoint:
+            return
+        with self._lock:
+            if self.remaining is not None and self.remaining <= 0:
+                return
+            if self.remaining is not None:
+                self.remaining -= 1
+            self.active[threading.get_ident()] = request.endpoint
+
+
+    def finished(self, _sender, **_extra):
+        with self._lock:
+            if self.active.pop(threading.get_ident(), None) is None:
+                return
+            self.profiled += 1
+            if self.remaining == 0 and not self.active:
+                self.done.set()
+
+
+class StackProfiler:
+    """Implements a sampling profiler of the threads serving requests. Their stacks are sampled every interval from
+    sys._current_frames() by the thread asking for the profile, and aggregated as collapsed stacks, the input of
+    flamegraph.pl, and per function. Nothing is hooked into the app outside of a profile, so that it costs
+    nothing when it is not running."""
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self._running = threading.Lock()
+        self._names = {}
+
+
+    def _frame_name(self, code):
+        name = self._names.get(code)
+        if name is None:
+            file_name = code.co_filename
+            if 'site-packages' + os.sep in file_name:
+                file_name = file_name.rsplit('site-packages' + os.sep, 1)[1]
+            elif file_name.startswith(os.getcwd() + os.sep):
+                file_name = os.path.relpath(file_name)
+            else:
+                file_name = os.path.basename(file_name)
+            name = self._names[code] = '{}:{}'.format(file_name, code.co_name)
+        return name
+
+
+    def _collapse(self, frame):
+        names = []
+        while frame is not None:
+            names.append(self._frame_name(frame.f_code))
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+
+    def profile(self, app, seconds, endpoint=None, max_requests=None):
+        """
+        Samples the requests served for up to the given seconds, only those to the endpoint if given, and stops
+        early once max_requests of them are served
+        :return: the collapsed stacks with their number of samples, and the number of requests profiled
+        """
+        if not self._running.acquire(blocking=False):
+            raise ProfilerBusy('A profile is already running')
+
+        session = _Session(endpoint, max_requests)
+        stacks = Counter()
+        request_started.connect(session.started, app, weak=False)
+        request_finished.connect(session.finished, app, weak=False)
+        try:
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline and not session.done.is_set():
+                time.sleep(self.interval)
+                frames = sys._current_frames()  #pylint: disable=protected-access
+                for thread_id in list(session.active):
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stacks[self._collapse(frame)] += 1
+        finally:
+            # From every sender, as blinker only forgets the receivers disconnected that way
+            request_started.disconnect(session.started)
+            request_finished.disconnect(session.finished)
+            self._running.release()
+
+        return stacks, session.profiled
+
+
+    @staticmethod
+    def render_collapsed(stacks):
+        """
+        :return: one 'frame;frame;frame count' line per distinct stack, the format of flamegraph.pl
+        """
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in stacks.most_common())
+
+
+    @staticmethod
+    def top_functions(stacks, limit):
+        """
+        :return: the functions taking the most samples, on their own (self) and with their callees (total)
+        """
+        total_samples = sum(stacks.values())
+        own, inclusive = Counter(), Counter()
+        for stack, count in stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            # Recursive functions are counted once per sample
+            for frame in set(frames):
+                inclusive[frame] += count
+
+        return [{
+            "function": function,
+            "self": own[function],
+            "total": inclusive[function],
+            "self_percent": round(100.0 * own[function] / total_samples, 1),
+            "total_percent": round(100.0 * inclusive[function] / total_samples, 1),
+        } for function in sorted(inclusive, key=lambda function: (-own[function], -inclusive[function]))[:limit]]
+
+
+# The profiler of the process, run from /admin/profile
+PROFILER = StackProfiler()
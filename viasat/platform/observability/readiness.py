@@ -0,0 +1,112 @@
+from collections import OrderedDict
+import json
+import os
+import threading
+import time
+
+
+class ReadinessProbe:
+    """Implements a readiness state computed by a background thread on an interval, so that serving a probe only
+    reads the last response from memory. A state older than a few intervals, e.g. because a check hangs, is
+    reported as not ready."""
+
+    # Intervals without a refresh after which the state is stale
+    STALE_INTERVALS = 3
+
+
+    def __init__(self):
+        # name -> check() returning a dict with an http "status", and details
+        self._checks = OrderedDict()
+        self.interval = None
+        self.logger = None
+        self._refreshed_at = None
+        self._ready = None
+        # (body, status) of the last refresh, and what to serve when it is stale
+        self._response = (json.dumps({"overall": 503, "server": 200, "state": "starting"}), 503)
+        self._stale_response = None
+        self._refresher = None
+        self._refresher_pid = None
+        self._lock = threading.Lock()
+
+
+    def add_check(self, name, check):
+        """Adds a check, whose exceptions are reported as a 503"""
+        self._checks[name] = check
+
+
+    def configure(self, interval, logger):
+        """Sets how often the state is refreshed once started, and the logger of its changes"""
+        self.interval = interval
+        self.logger = logger
+
+
+    def start(self):
+        """Refreshes the state every interval seconds in a daemon thread of the current process, unless one already
+        does. Called by the processes serving the probes rather than at import, so that neither a pre-fork master
+        nor a command line tool runs the checks"""
+        if self._refresher_pid != os.getpid():
+            self._start_refresher()
+
+
+    def _start_refresher(self):
+        # Started again in a forked child, which doesn't have its parent's threads
+        with self._lock:
+            if self._refresher_pid != os.getpid():
+                self._refresher_pid = os.getpid()
+                self._refresher = threading.Thread(target=self._refresh_forever, name='readiness-refresher',
+                                                   daemon=True)
+                self._refresher.start()
+
+
+    def _refresh_forever(self):
+        while True:
+            self.refresh()
+            time.sleep(self.interval)
+
+
+    def refresh(self):
+        """Runs every check and keeps the response to serve until the next refresh"""
+        readiness_check = {"overall": 200, "server": 200}
+        for name, check in self._checks.items():
+            start = time.perf_counter()
+            try:
+                result = check()
+            except Exception as error:  #pylint: disable=broad-except
+                result = {"status": 503, "error": str(error).split('\n', 1)[0]}
+            result["check_ms"] = round((time.perf_counter() - start) * 1000, 3)
+            readiness_check[name] = result
+            if result["status"] != 200:
+                readiness_check["overall"] = 503
+
+        readiness_check["refreshed_at"] = int(time.time())
+        ready = readiness_check["overall"] == 200
+        stale_check = dict(readiness_check, overall=503, state="stale")
+
+        self._response = (json.dumps(readiness_check), readiness_check["overall"])
+        self._stale_response = (json.dumps(stale_check), 503)
+        self._refreshed_at = time.monotonic()
+
+        # Only the changes are logged, the state is refreshed every few seconds
+        if ready != self._ready and self.logger is not None:
+            if ready:
+                self.logger.info("The app is ready: readiness_check=%s", self._response[0])
+            else:
+                self.logger.warning("The app is not ready! readiness_check=%s", self._response[0])
+        self._ready = ready
+
+
+    def response(self):
+        """
+        :return: the body and http status of the last refresh, without running any check
+        """
+        if self._refresher_pid is not None and self._refresher_pid != os.getpid():
+            self._start_refresher()
+
+        if self._refreshed_at is not None and self.interval is not None \
+                and time.monotonic() - self._refreshed_at > ReadinessProbe.STALE_INTERVALS * self.interval:
+            return self._stale_response
+        return self._response
+
+
+# The readiness of the process, served on /healthcheck/readiness
+READINESS = ReadinessProbe()